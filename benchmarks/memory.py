@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark
+Renders resizes of generated originals, comparing peak memory estimated
+from image headers with peak actually measured (rss growth and python
+allocations), in full and in draft decoding mode. Run from project root:
+
+    python benchmarks/memory.py
+"""
+import os, sys, shutil, tempfile
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + '/../'))
+
+from PIL import Image
+from shiftmedia.budget import measure
+from shiftmedia.resizer import Resizer
+
+MB = 1024 * 1024
+
+# original format, size and frames, target size
+CASES = [
+    ('JPEG', (6000, 4000), 1, (400, 300)),
+    ('JPEG', (6000, 4000), 1, (1600, 1200)),
+    ('PNG', (3000, 2000), 1, (400, 300)),
+    ('GIF', (800, 600), 20, (400, 300)),
+]
+
+
+def generate(path, format, size, frames):
+    """ Write a noisy original, so that encoders can't cheat """
+    noise = Image.effect_noise(size, 64).convert('RGB')
+    if format == 'GIF':
+        images = [noise.rotate(i * 5).convert('P') for i in range(frames)]
+        images[0].save(
+            path,
+            save_all=True,
+            append_images=images[1:],
+            duration=100,
+            loop=0
+        )
+    else:
+        noise.save(path, format=format)
+
+
+def run(src, dst, size, scale):
+    """ Render a resize, measuring its peak memory """
+    draft = size if scale > 1 else None
+    with measure() as measurement:
+        img = Resizer.open(src, draft=draft)
+        Resizer.auto_crop(img, dst, size, Resizer.RESIZE_TO_FILL)
+        del img
+    return measurement
+
+
+if __name__ == '__main__':
+    root = tempfile.mkdtemp(prefix='shiftmedia-memory-')
+    try:
+        header = '{:<5} {:>10} {:>9} {:>6} {:>10} {:>10} {:>10}'
+        row = '{:<5} {:>10} {:>9} {:>6} {:>9.1f}M {:>9.1f}M {:>9.1f}M'
+        print(header.format(
+            'fmt', 'original', 'target', 'draft', 'estimate', 'rss', 'traced'
+        ))
+        for index, case in enumerate(CASES):
+            format, src_size, frames, size = case
+            extension = format.lower().replace('jpeg', 'jpg')
+            src = os.path.join(root, '{}.{}'.format(index, extension))
+            dst = os.path.join(root, '{}-resize.{}'.format(index, extension))
+            generate(src, format, src_size, frames)
+            info = Resizer.probe(src)
+
+            scales = [1]
+            if format == 'JPEG':
+                scales.append(Resizer.draft_scale(src_size, size))
+            for scale in scales:
+                estimate = Resizer.estimate_memory(info, size, scale=scale)
+                measurement = run(src, dst, size, scale)
+                print(row.format(
+                    format,
+                    '{}x{}'.format(*src_size),
+                    '{}x{}'.format(*size),
+                    scale,
+                    estimate / MB,
+                    (measurement.rss or 0) / MB,
+                    measurement.traced / MB
+                ))
+    finally:
+        shutil.rmtree(root)
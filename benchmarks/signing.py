@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Signing benchmark
+Measures sign and verify throughput of available signers. Run from
+project root:
+
+    python benchmarks/signing.py
+"""
+import os, sys, timeit
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + '/../'))
+
+from shiftmedia import utils
+from shiftmedia.signing import Md5Signer, HmacSigner, Blake2Signer
+
+NUMBER = 100000
+ID = utils.generate_id('product.jpg')
+FILENAME = '640x480-fill-65-upscale.jpg'
+KEY = 'e1f2c1a3d4b5e6f7a8b9c0d1e2f3a4b5'
+
+SIGNERS = [
+    ('md5 (legacy)', Md5Signer(KEY)),
+    ('hmac-sha256', HmacSigner(KEY)),
+    ('hmac-sha256/32', HmacSigner(KEY, length=32)),
+    ('blake2b', Blake2Signer(KEY)),
+    ('blake2b/32', Blake2Signer(KEY, length=32)),
+    ('blake2b 2 keys', Blake2Signer([KEY, KEY[::-1]], length=32)),
+]
+
+
+def rate(fn):
+    """ Get best calls per second """
+    best = min(timeit.repeat(fn, number=NUMBER, repeat=3))
+    return NUMBER / best
+
+
+if __name__ == '__main__':
+    header = '{:<16} {:>12} {:>12} {:>14}'
+    row = '{:<16} {:>12.0f} {:>12.0f} {:>14.0f}'
+    print(header.format('signer', 'sign/s', 'verify/s', 'reject len/s'))
+    for name, signer in SIGNERS:
+        signature = signer.sign(ID, FILENAME)
+        print(row.format(
+            name,
+            rate(lambda: signer.sign(ID, FILENAME)),
+            rate(lambda: signer.verify(ID, FILENAME, signature)),
+            rate(lambda: signer.verify(ID, FILENAME, 'bad')),
+        ))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Srcset benchmark
+Compares building urls for a product listing one call at a time against
+the bulk srcset api. Run from project root:
+
+    python benchmarks/srcset.py
+"""
+import os, sys, timeit
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + '/../'))
+
+from shiftmedia import Storage, BackendLocal, utils
+
+IDS = 1000
+SIZES = ['320x240', '640x480', '960x720', '1280x960', '1600x1200', '1920x1440']
+REPEAT = 5
+
+storage = Storage(
+    BackendLocal('/tmp/shiftmedia-benchmark', url='https://media.example.com'),
+    secret_key='benchmark-secret',
+    local_temp='/tmp/shiftmedia-benchmark-tmp'
+)
+ids = [utils.generate_id('product.jpg') for i in range(IDS)]
+
+
+def per_call():
+    for id in ids:
+        urls = []
+        for size in SIZES:
+            url = storage.get_auto_crop_url(id, size, 'fill')
+            urls.append(url + ' ' + size.split('x')[0] + 'w')
+        ', '.join(urls)
+
+
+def bulk():
+    for id in ids:
+        storage.get_srcset(id, SIZES)
+
+
+if __name__ == '__main__':
+    # results must be identical
+    for id in ids[:10]:
+        expected = ', '.join(
+            storage.get_auto_crop_url(id, size, 'fill') + ' ' +
+            size.split('x')[0] + 'w' for size in SIZES
+        )
+        assert expected == storage.get_srcset(id, SIZES)
+
+    urls = IDS * len(SIZES)
+    for name, fn in [('per call', per_call), ('bulk srcset', bulk)]:
+        best = min(timeit.repeat(fn, number=1, repeat=REPEAT))
+        msg = '{:<12} {:8.1f} ms  {:8.0f} urls/s'
+        print(msg.format(name, best * 1000, urls / best))
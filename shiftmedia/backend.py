@@ -1,8 +1,30 @@
-import os, shutil, mimetypes, boto3
+import os, shutil, functools, mimetypes, boto3
 from pprint import PrettyPrinter
 from abc import ABCMeta, abstractmethod
 from botocore import exceptions as bx
 from shiftmedia import exceptions as x
+from shiftmedia import metrics, tracing
+
+
+def timed_io(operation):
+    """
+    Timed I/O
+    Decorator reporting duration of backend operation to metrics sink,
+    labelled with backend name, and recording it as a trace span
+    :param operation: string - operation name
+    :return: decorator
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            label = self.metrics_label
+            labels = dict(backend=label, operation=operation)
+            timer = metrics.current().timer(metrics.BACKEND_SECONDS, labels)
+            span = tracing.span('backend.' + operation, backend=label)
+            with timer, span:
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class Backend(metaclass=ABCMeta):
@@ -11,6 +33,10 @@ class Backend(metaclass=ABCMeta):
     This defines methods your backend must implement in order to
     work with media storage
     """
+
+    # backend name to report metrics under
+    metrics_label = 'custom'
+
     @abstractmethod
     def __init__(self, url='http://localhost'):
         """
@@ -27,6 +53,24 @@ class Backend(metaclass=ABCMeta):
         """
         return self._url
 
+    def count_bytes(self, operation, path=None, size=None):
+        """
+        Count bytes
+        Reports size of a transferred file to metrics sink and current
+        trace span
+        :param operation: string - operation name
+        :param path: string - path to local file
+        :param size: int - transferred bytes, if not read into a file
+        :return: None
+        """
+        if not metrics.enabled() and not tracing.enabled():
+            return
+        if size is None:
+            size = os.path.getsize(path)
+        labels = dict(backend=self.metrics_label, operation=operation)
+        metrics.current().increment(metrics.BACKEND_BYTES, size, labels)
+        tracing.set_attributes(bytes=size)
+
     @abstractmethod
     def put(self, src, id, force=False):
         """
@@ -63,6 +107,30 @@ class Backend(metaclass=ABCMeta):
         """
         pass
 
+    def list_variants(self, id):
+        """
+        List variants
+        Returns filenames of all files stored under given id, including
+        the original, in a single listing operation. Backends that can't
+        list return None, and variant index then only knows about
+        variants put by this process.
+        :param id: string - storage id
+        :return: list or None
+        """
+        return None
+
+    def get_variant(self, id, filename):
+        """
+        Get variant
+        Returns bytes of a file stored under given id. Backends that
+        can't read variants back return None, and storage then renders
+        variants it needs bytes of again, without storing them.
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bytes or None
+        """
+        return None
+
     @abstractmethod
     def parse_url(self, url):
         """
@@ -92,6 +160,7 @@ class BackendLocal(Backend):
     Local backend
     Stores file locally in a directory without transferring to remote storage
     """
+    metrics_label = 'local'
 
     def __init__(self, local_path=None, url='http://localhost'):
         """
@@ -156,6 +225,7 @@ class BackendLocal(Backend):
         filename = '-'.join(id.split('-')[5:])
         return self.put_variant(src, id, filename, force)
 
+    @timed_io('put_variant')
     def put_variant(self, src, id, filename, force=False):
         """
         Put file variant to storage
@@ -176,10 +246,10 @@ class BackendLocal(Backend):
             msg += 'Use force option to overwrite.'
             raise x.FileExists(msg)
         shutil.copyfile(src, dst)
-
-
+        self.count_bytes('put_variant', dst)
         return id
 
+    @timed_io('delete')
     def delete(self, id):
         """
         Delete
@@ -190,6 +260,39 @@ class BackendLocal(Backend):
         shutil.rmtree(path)
         return True
 
+    @timed_io('list_variants')
+    def list_variants(self, id):
+        """
+        List variants
+        Returns filenames of all files stored under given id, including
+        the original, in a single listing operation.
+        :param id: string - storage id
+        :return: list
+        """
+        path = os.path.join(self.path, *self.id_to_path(id))
+        if not os.path.isdir(path):
+            return []
+        return [file.name for file in os.scandir(path) if file.is_file()]
+
+    @timed_io('get_variant')
+    def get_variant(self, id, filename):
+        """
+        Get variant
+        Returns bytes of a file stored under given id
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bytes or None if there is no such file
+        """
+        path = os.path.join(self.path, *self.id_to_path(id), filename)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        self.count_bytes('get_variant', size=len(data))
+        return data
+
+    @timed_io('retrieve_original')
     def retrieve_original(self, id, local_path):
         """
         Retrieve original
@@ -203,6 +306,7 @@ class BackendLocal(Backend):
         if not os.path.exists(dst_dir):
             os.makedirs(dst_dir, exist_ok=True)
         shutil.copyfile(src, dst)
+        self.count_bytes('retrieve_original', dst)
         return dst
 
     def clear_variants(self):
@@ -227,6 +331,8 @@ class BackendS3(Backend):
     Amazon S3 backend
     Stores files in an amazon s3 bucket
     """
+    metrics_label = 's3'
+
     def __init__(
         self,
         key_id,
@@ -288,6 +394,7 @@ class BackendS3(Backend):
         filename = url[-1]
         return id, filename
 
+    @timed_io('exists')
     def exists(self, object):
         """
         Exists
@@ -363,6 +470,7 @@ class BackendS3(Backend):
             encoding
         )
 
+    @timed_io('put_variant')
     def put_variant(
         self,
         src,
@@ -413,8 +521,10 @@ class BackendS3(Backend):
             if encoding: params['ContentEncoding'] = encoding
             client.put_object(**params)
 
+        self.count_bytes('put_variant', src.name)
         return id
 
+    @timed_io('delete')
     def delete(self, id):
         """
         Delete
@@ -424,6 +534,54 @@ class BackendS3(Backend):
         path = '/'.join(self.id_to_path(id))
         self.recursive_delete(path)
 
+    @timed_io('list_variants')
+    def list_variants(self, id):
+        """
+        List variants
+        Returns filenames of all files stored under given id, including
+        the original. Uses a single prefix listing rather than checking
+        every key for existence.
+        :param id: string - storage id
+        :return: list
+        """
+        path = '/'.join(self.id_to_path(id)) + '/'
+        client = boto3.client('s3', **self.credentials)
+        paginator = client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self.bucket_name, Prefix=path)
+
+        filenames = []
+        for item in pages.search('Contents'):
+            if not item: continue
+            filename = str(item['Key'])[len(path):]
+            if filename and '/' not in filename:
+                filenames.append(filename)
+
+        return filenames
+
+    @timed_io('get_variant')
+    def get_variant(self, id, filename):
+        """
+        Get variant
+        Returns bytes of a file stored under given id
+
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bytes or None if there is no such file
+        """
+        key = '/'.join(self.id_to_path(id)) + '/' + filename
+        client = boto3.client('s3', **self.credentials)
+        try:
+            response = client.get_object(Bucket=self.bucket_name, Key=key)
+        except bx.ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('404', 'NoSuchKey'): return None
+            else: raise e
+
+        data = response['Body'].read()
+        self.count_bytes('get_variant', size=len(data))
+        return data
+
+    @timed_io('retrieve_original')
     def retrieve_original(self, id, local_path):
         """
         Retrieve original
@@ -451,6 +609,7 @@ class BackendS3(Backend):
                 Fileobj=data
             )
 
+        self.count_bytes('retrieve_original', dst)
         return dst
 
     def clear_variants(self):
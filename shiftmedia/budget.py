@@ -0,0 +1,147 @@
+import os, time, threading, tracemalloc
+from contextlib import contextmanager
+from shiftmedia import metrics, tracing, profiling
+from shiftmedia import exceptions as x
+from shiftmedia.resizer import Resizer
+
+
+class MemoryBudget:
+    """
+    Memory budget
+    Caps memory a single resize may take. Peak memory is estimated from
+    the header of the original (dimensions, mode and frame count) before
+    anything is decoded. Over budget JPEGs are decoded in draft mode at
+    1/2, 1/4 or 1/8 scale instead, if that still covers target size and
+    brings the estimate under budget. Anything else is rejected.
+    """
+
+    def __init__(self, max_bytes, draft=True):
+        """
+        Memory budget constructor
+        :param max_bytes: int - peak memory a resize may take
+        :param draft: bool - downgrade over budget JPEGs to draft decoding
+        """
+        if max_bytes <= 0:
+            err = 'Memory budget must be positive'
+            raise x.ConfigurationException(err)
+        self.max_bytes = max_bytes
+        self.draft = draft
+
+    def check(self, info, size, upscale=True):
+        """
+        Check
+        Decides how an original should be decoded to stay within budget.
+        Returns estimated peak memory and draft scale (1 to decode in
+        full), or raises if there's no way to stay within budget.
+
+        :param info: dict - original description, see Resizer.probe
+        :param size: tuple - target width and height
+        :param upscale: bool - whether output may be bigger than original
+        :return: dict
+        """
+        estimate = Resizer.estimate_memory(info, size, upscale)
+        plan = dict(estimate=estimate, scale=1)
+        if estimate > self.max_bytes and self.draft:
+            src_size = (info['width'], info['height'])
+            scale = Resizer.draft_scale(src_size, size)
+            if info.get('format') == 'JPEG' and scale > 1:
+                estimate = Resizer.estimate_memory(info, size, upscale, scale)
+                plan = dict(estimate=estimate, scale=scale)
+
+        if plan['estimate'] > self.max_bytes:
+            metrics.increment(metrics.MEMORY_BUDGET, result='rejected')
+            err = 'Resizing {}x{} {} image to {}x{} needs about {} bytes, '
+            err += 'memory budget is {} bytes'
+            raise x.MemoryBudgetExceeded(err.format(
+                info['width'],
+                info['height'],
+                info.get('format'),
+                size[0],
+                size[1],
+                plan['estimate'],
+                self.max_bytes
+            ))
+
+        result = 'draft' if plan['scale'] > 1 else 'ok'
+        metrics.increment(metrics.MEMORY_BUDGET, result=result)
+        tracing.set_attributes(
+            memory_estimate=plan['estimate'],
+            draft_scale=plan['scale']
+        )
+        profiling.annotate(memory=plan)
+        return plan
+
+
+class Measurement:
+    """
+    Measurement
+    Peak memory of a measured block: python allocations traced by
+    tracemalloc and growth of resident set size of the process. Pixel
+    buffers are allocated by Pillow outside of python allocator, so only
+    rss shows them.
+    """
+
+    def __init__(self):
+        self.traced = None
+        self.rss = None
+        self.elapsed = None
+
+
+def rss():
+    """
+    Rss
+    Returns current resident set size of the process
+    :return: int - bytes or None where unknown (outside Linux)
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+@contextmanager
+def measure(interval=0.001):
+    """
+    Measure
+    Context manager measuring actual peak memory of a block for
+    benchmarks. Samples rss in a background thread and traces python
+    allocations, both of which slow the block down, so never use it to
+    serve requests.
+    :param interval: float - seconds between rss samples
+    :return: shiftmedia.budget.Measurement
+    """
+    measurement = Measurement()
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    traced = tracemalloc.get_traced_memory()[0]
+
+    baseline = rss()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], rss())
+
+    sampler = None
+    if baseline is not None:
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+
+    start = time.perf_counter()
+    try:
+        yield measurement
+    finally:
+        measurement.elapsed = time.perf_counter() - start
+        measurement.traced = tracemalloc.get_traced_memory()[1] - traced
+        if started_tracing:
+            tracemalloc.stop()
+        if sampler:
+            done.set()
+            sampler.join()
+            peak[0] = max(peak[0], rss())
+            measurement.rss = peak[0] - baseline
@@ -0,0 +1,440 @@
+import os, time, shutil, uuid, hashlib, threading
+from collections import OrderedDict
+
+
+class OriginalsCache:
+    """
+    Originals cache
+    Size-bounded on-disk LRU cache of originals retrieved from backend.
+    Entries are populated atomically via a staging directory and handed
+    out to readers as hard links, so that evicting an entry never affects
+    the readers that already got it. Recency is tracked with file mtime,
+    which lets several processes share one cache directory.
+    """
+
+    STAGING = '.staging'
+
+    def __init__(self, path, max_bytes):
+        """
+        Originals cache constructor
+        :param path: string - cache directory
+        :param max_bytes: int - cache size budget in bytes
+        """
+        self._path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    @property
+    def path(self):
+        """
+        Get path
+        Returns path to cache directory and creates one if necessary
+        """
+        if not os.path.exists(self._path):
+            os.makedirs(self._path, exist_ok=True)
+        return self._path
+
+    def id_to_path(self, id):
+        """
+        Id to path
+        Returns path to cached entry for given storage id
+        :param id: string - storage id
+        :return: string
+        """
+        name = hashlib.sha1(bytes(id, 'utf-8')).hexdigest()
+        return os.path.join(self.path, name)
+
+    def entries(self):
+        """
+        Entries
+        Returns a list of (mtime, size, path) tuples for every cached entry
+        :return: list
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name == self.STAGING or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    @property
+    def size(self):
+        """
+        Get size
+        Returns total size of cached entries in bytes
+        """
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry[1] for entry in self.entries())
+            return self._size
+
+    def retrieve_original(self, backend, id, local_path):
+        """
+        Retrieve original
+        Puts the original to local temp path the same way backend does,
+        serving it from cache when possible and populating cache otherwise.
+
+        :param backend: shiftmedia.backend.Backend - backend to download from
+        :param id: string - storage object id
+        :param local_path: string - local path to download to
+        :return: path to local original
+        """
+        filename = backend.id_to_path(id)[5]
+        dst_dir = os.path.join(local_path, id)
+        dst = os.path.join(dst_dir, filename)
+        os.makedirs(dst_dir, exist_ok=True)
+
+        entry = self.id_to_path(id)
+        if self.link(entry, dst):
+            with self._lock:
+                self.hits += 1
+            return dst
+
+        with self._lock:
+            self.misses += 1
+
+        staging = os.path.join(self.path, self.STAGING, uuid.uuid4().hex)
+        try:
+            downloaded = backend.retrieve_original(id, staging)
+            size = os.path.getsize(downloaded)
+            if size > self.max_bytes:
+                shutil.move(downloaded, dst)
+                return dst
+
+            os.replace(downloaded, entry)
+            with self._lock:
+                if self._size is not None:
+                    self._size += size
+            if not self.link(entry, dst):
+                backend.retrieve_original(id, local_path)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        if self.size > self.max_bytes:
+            self.evict()
+        return dst
+
+    def link(self, entry, dst):
+        """
+        Link
+        Hands cached entry out to a reader by hard linking (or copying if
+        linking is not possible) and marks entry as recently used.
+        :param entry: string - path to cached entry
+        :param dst: string - path to destination
+        :return: bool - whether entry was found
+        """
+        try:
+            if os.path.exists(dst):
+                os.remove(dst)
+            try:
+                os.link(entry, dst)
+            except OSError as error:
+                if isinstance(error, FileNotFoundError):
+                    raise
+                shutil.copyfile(entry, dst)
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def evict(self):
+        """
+        Evict
+        Removes least recently used entries until the cache fits within
+        its byte budget.
+        :return: int - number of entries evicted
+        """
+        with self._lock:
+            entries = sorted(self.entries())
+            total = sum(entry[1] for entry in entries)
+            evicted = 0
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+            self._size = total
+            self.evictions += evicted
+            return evicted
+
+    def invalidate(self, id):
+        """
+        Invalidate
+        Removes cached original for given id
+        :param id: string - storage id
+        :return: None
+        """
+        try:
+            size = os.path.getsize(self.id_to_path(id))
+            os.remove(self.id_to_path(id))
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def stats(self):
+        """
+        Stats
+        Returns cache counters
+        :return: dict
+        """
+        size = self.size
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                bytes=size,
+                max_bytes=self.max_bytes,
+            )
+
+
+class DecodedCache:
+    """
+    Decoded cache
+    Per-process LRU cache of decoded, orientation-fixed originals bounded
+    by total pixel count. Lets bursts of different resizes of the same hot
+    image skip decoding altogether. Cached images must be treated as
+    read-only by consumers.
+    """
+
+    def __init__(self, max_pixels):
+        """
+        Decoded cache constructor
+        :param max_pixels: int - cache budget in pixels
+        """
+        self.max_pixels = max_pixels
+        self.pixels = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def count_pixels(img):
+        """
+        Count pixels
+        Returns pixel count of an image
+        :param img: PIL.Image
+        :return: int
+        """
+        return img.size[0] * img.size[1]
+
+    def get(self, key):
+        """
+        Get
+        Returns cached image for given key or None
+        :param key: hashable - cache key, e.g. storage id
+        :return: PIL.Image or None
+        """
+        with self._lock:
+            img = self._items.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def set(self, key, img):
+        """
+        Set
+        Puts decoded image to cache, evicting least recently used images
+        to stay within pixel budget. Images larger than the whole budget
+        are not cached.
+        :param key: hashable - cache key, e.g. storage id
+        :param img: PIL.Image - decoded image
+        :return: bool - whether image was cached
+        """
+        pixels = self.count_pixels(img)
+        if pixels > self.max_pixels:
+            return False
+
+        with self._lock:
+            if key in self._items:
+                self.pixels -= self.count_pixels(self._items.pop(key))
+            self._items[key] = img
+            self.pixels += pixels
+            while self.pixels > self.max_pixels:
+                evicted_key, evicted = self._items.popitem(last=False)
+                self.pixels -= self.count_pixels(evicted)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, key):
+        """
+        Invalidate
+        Removes image from cache
+        :param key: hashable - cache key
+        :return: None
+        """
+        with self._lock:
+            img = self._items.pop(key, None)
+            if img is not None:
+                self.pixels -= self.count_pixels(img)
+
+    def stats(self):
+        """
+        Stats
+        Returns cache counters
+        :return: dict
+        """
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                items=len(self._items),
+                pixels=self.pixels,
+                max_pixels=self.max_pixels,
+            )
+
+
+class VariantCache:
+    """
+    Variant cache
+    Per-process LRU cache of encoded variant bytes keyed by storage id and
+    variant filename. Bounded by total byte size with optional time to live
+    for entries, so that a colocated server can answer repeat requests for
+    rendered variants straight from memory.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        """
+        Variant cache constructor
+        :param max_bytes: int - cache budget in bytes
+        :param ttl: float - entry time to live in seconds, None for no expiry
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._items = OrderedDict()
+        self._ids = dict()
+        self._lock = threading.Lock()
+
+    def get(self, id, filename):
+        """
+        Get
+        Returns cached variant bytes or None if missing or expired
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bytes or None
+        """
+        key = (id, filename)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self.ttl is not None:
+                if item[1] <= time.monotonic():
+                    self._remove(key)
+                    self.expirations += 1
+                    item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, id, filename, data):
+        """
+        Set
+        Puts variant bytes to cache, evicting least recently used entries
+        to stay within byte budget. Variants larger than the whole budget
+        are not cached.
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :param data: bytes - encoded variant
+        :return: bool - whether variant was cached
+        """
+        size = len(data)
+        if size > self.max_bytes:
+            return False
+
+        key = (id, filename)
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (data, expires)
+            self._ids.setdefault(id, set()).add(filename)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+        return True
+
+    def _remove(self, key):
+        """
+        Remove
+        Removes entry and updates accounting. Must be called under lock.
+        :param key: tuple - (id, filename)
+        :return: None
+        """
+        data, expires = self._items.pop(key)
+        self.bytes -= len(data)
+        id, filename = key
+        filenames = self._ids.get(id)
+        if filenames is not None:
+            filenames.discard(filename)
+            if not filenames:
+                del self._ids[id]
+
+    def invalidate(self, id, filename=None):
+        """
+        Invalidate
+        Removes a single variant or all variants of given id from cache
+        :param id: string - storage id
+        :param filename: string - variant filename, None for all variants
+        :return: None
+        """
+        with self._lock:
+            filenames = [filename] if filename else self._ids.get(id, ())
+            for filename in list(filenames):
+                if (id, filename) in self._items:
+                    self._remove((id, filename))
+
+    def clear(self):
+        """
+        Clear
+        Removes everything from cache
+        :return: None
+        """
+        with self._lock:
+            self._items.clear()
+            self._ids.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Stats
+        Returns cache counters
+        :return: dict
+        """
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+                items=len(self._items),
+                bytes=self.bytes,
+                max_bytes=self.max_bytes,
+            )
@@ -23,4 +23,166 @@ def test(nose_argsuments):
     from nose import run
     params = ['__main__', '-c', 'nose.ini']
     params.extend(nose_argsuments)
-    run(argv=params)
\ No newline at end of file
+    run(argv=params)
+
+@cli.command(name='worker')
+@click.argument('factory')
+@click.option(
+    '--concurrency', '-c',
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help='Number of worker processes'
+)
+@click.option(
+    '--poll',
+    default=1.0,
+    show_default=True,
+    help='Seconds to sleep when queue is empty'
+)
+@click.option(
+    '--lease',
+    default=300.0,
+    show_default=True,
+    help='Seconds a job is reserved for before it is retried'
+)
+@click.option(
+    '--grace',
+    default=30.0,
+    show_default=True,
+    help='Seconds to let running jobs finish on shutdown'
+)
+@click.option(
+    '--pipeline',
+    is_flag=True,
+    help='Overlap downloads, rendering and uploads in every process'
+)
+@click.option(
+    '--fetchers',
+    default=4,
+    show_default=True,
+    help='Threads retrieving originals per process, with --pipeline'
+)
+@click.option(
+    '--storers',
+    default=4,
+    show_default=True,
+    help='Threads uploading variants per process, with --pipeline'
+)
+def worker(factory, concurrency, poll, lease, grace, pipeline, fetchers,
+           storers):
+    """
+    Run resize workers
+    FACTORY is an import path to a callable returning configured storage
+    with a job queue, e.g. myapp.media:get_storage
+    """
+    from shiftmedia.worker import Worker, load_factory
+    sys.path.insert(0, os.getcwd())
+    factory = load_factory(factory)
+    msg = 'Starting {} worker process(es) for {}'
+    echo(green(msg.format(concurrency, factory.__name__)))
+    worker = Worker(
+        factory,
+        concurrency=concurrency,
+        poll=poll,
+        lease=lease,
+        grace=grace,
+        pipeline=dict(
+            fetchers=fetchers,
+            computers=1,
+            storers=storers
+        ) if pipeline else None
+    )
+    from shiftmedia.exceptions import WorkerCrashed
+    try:
+        worker.run()
+    except WorkerCrashed as error:
+        echo(red(str(error)))
+        sys.exit(1)
+    echo(yellow('Workers stopped'))
+
+@cli.command(name='serve')
+@click.argument('factory')
+@click.option(
+    '--host',
+    default='127.0.0.1',
+    show_default=True,
+    help='Interface to bind to'
+)
+@click.option(
+    '--port', '-p',
+    default=8000,
+    show_default=True,
+    help='Port to listen on'
+)
+@click.option(
+    '--prefix',
+    default='',
+    help='Path prefix to strip from requests'
+)
+@click.option(
+    '--metrics', 'expose_metrics',
+    is_flag=True,
+    help='Collect metrics and expose them at /metrics'
+)
+@click.option(
+    '--previews',
+    is_flag=True,
+    help='Answer cold resizes with quick previews'
+)
+@click.option(
+    '--quiet', '-q',
+    is_flag=True,
+    help='Do not log requests'
+)
+def serve(factory, host, port, prefix, expose_metrics, previews, quiet):
+    """
+    Run resize server
+    FACTORY is an import path to a callable returning configured storage,
+    e.g. myapp.media:get_storage
+    """
+    from shiftmedia.server import ResizeServer, serve as run_server
+    from shiftmedia.worker import load_factory
+    from shiftmedia import metrics
+    sys.path.insert(0, os.getcwd())
+    storage = load_factory(factory)()
+    metrics_path = None
+    if expose_metrics:
+        metrics.set_sink(metrics.Registry())
+        metrics_path = '/metrics'
+    app = ResizeServer(
+        storage,
+        prefix=prefix,
+        metrics_path=metrics_path,
+        previews=previews
+    )
+    echo(green('Serving storage on http://{}:{}'.format(host, port)))
+    try:
+        run_server(app, host=host, port=port, quiet=quiet)
+    except KeyboardInterrupt:
+        echo(yellow('Server stopped'))
+    finally:
+        storage.close()
+
+@cli.command(name='replay-profile')
+@click.argument('report')
+@click.argument('factory')
+@click.option(
+    '--memory',
+    is_flag=True,
+    help='Trace memory allocations'
+)
+def replay_profile(report, factory, memory):
+    """
+    Replay profiled resize
+    Renders resize from REPORT again under profiler, writing a new report
+    next to it. FACTORY is an import path to a callable returning
+    configured storage, e.g. myapp.media:get_storage
+    """
+    from shiftmedia.profiling import Profiler
+    from shiftmedia.worker import load_factory
+    sys.path.insert(0, os.getcwd())
+    storage = load_factory(factory)()
+    path = os.path.dirname(os.path.abspath(report))
+    profiler = Profiler(path=path, memory=memory)
+    replayed = profiler.replay(report, storage)
+    echo(green('Replay report written to {}'.format(replayed)))
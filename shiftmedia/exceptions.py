@@ -42,3 +42,37 @@ class InvalidResizeFormat(MediaException, NameError):
     of parameters. It means that either it is malformed or signature is wrong.
     """
     pass
+
+
+class LockTimeout(MediaException, TimeoutError):
+    """
+    Lock timeout
+    Raised when a lock could not be acquired within given time
+    """
+    pass
+
+
+class QuotaExceeded(MediaException, OSError):
+    """
+    Quota exceeded
+    Raised when local scratch space usage goes over configured quota
+    """
+    pass
+
+
+class MemoryBudgetExceeded(MediaException, MemoryError):
+    """
+    Memory budget exceeded
+    Raised when resizing an original would need more memory than allowed
+    by configured memory budget
+    """
+    pass
+
+
+class WorkerCrashed(MediaException, RuntimeError):
+    """
+    Worker crashed
+    Raised when worker processes keep dying right after they are started,
+    e.g. because storage factory or its configuration is broken
+    """
+    pass
@@ -0,0 +1,149 @@
+import time, threading
+from collections import OrderedDict
+
+
+class VariantIndex:
+    """
+    Variant index
+    Answers whether a variant exists in storage without going to backend
+    for every key. Filenames under an id are fetched with a single listing
+    the first time the id is asked about and kept in a bounded LRU of
+    per-id sets. The index must be kept in sync by telling it about new
+    variants, deletes and clearing variants.
+
+    Other processes sharing the backend may delete or clear variants
+    behind the index's back, so listings expire after ttl seconds and
+    the id is listed again the next time it is asked about.
+    """
+
+    def __init__(self, backend, max_ids=10000, ttl=60):
+        """
+        Variant index constructor
+        :param backend: shiftmedia.backend.Backend - backend to list
+        :param max_ids: int - number of listed ids to remember
+        :param ttl: float - seconds listings are trusted for, None to
+                    trust them until invalidated
+        """
+        self.backend = backend
+        self.max_ids = max_ids
+        self.ttl = ttl
+        self.lists = 0
+        self.negatives = 0
+        self._ids = OrderedDict()
+        self._listed = dict()
+        self._lock = threading.RLock()
+
+    def _remember(self, id, filenames):
+        """ Remember filenames of a listed id. Must be called under lock """
+        self._ids[id] = set(filenames)
+        self._ids.move_to_end(id)
+        self._listed[id] = time.monotonic()
+        while len(self._ids) > self.max_ids:
+            forgotten, _ = self._ids.popitem(last=False)
+            self._listed.pop(forgotten, None)
+
+    def load(self, id):
+        """
+        Load
+        Lists filenames under id from backend and remembers them. If the
+        backend can't list, only variants added later are known to exist,
+        anything else is rendered again.
+        :param id: string - storage id
+        :return: set of filenames
+        """
+        filenames = self.backend.list_variants(id) or []
+        with self._lock:
+            self.lists += 1
+            self._remember(id, filenames)
+            return self._ids[id]
+
+    def expired(self, id):
+        """
+        Expired
+        Checks whether listing of id is older than ttl. Must be called
+        under lock.
+        :param id: string - storage id
+        :return: bool
+        """
+        if self.ttl is None:
+            return False
+        return time.monotonic() - self._listed[id] > self.ttl
+
+    def exists(self, id, filename):
+        """
+        Exists
+        Checks whether a file exists under id, listing the id on first use
+        and again once the listing expires
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bool
+        """
+        with self._lock:
+            filenames = self._ids.get(id)
+            if filenames is not None and not self.expired(id):
+                self._ids.move_to_end(id)
+                if filename not in filenames:
+                    self.negatives += 1
+                    return False
+                return True
+
+        return filename in self.load(id)
+
+    def add(self, id, filename):
+        """
+        Add
+        Records a file put to storage under id
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: None
+        """
+        with self._lock:
+            if id in self._ids:
+                self._ids[id].add(filename)
+
+    def mark_new(self, id):
+        """
+        Mark new
+        Records that nothing exists under a freshly generated id yet, so
+        that asking about it doesn't require a listing.
+        :param id: string - storage id
+        :return: None
+        """
+        with self._lock:
+            self._remember(id, [])
+
+    def invalidate(self, id):
+        """
+        Invalidate
+        Forgets everything known about id, e.g. when it's deleted
+        :param id: string - storage id
+        :return: None
+        """
+        with self._lock:
+            self._ids.pop(id, None)
+            self._listed.pop(id, None)
+
+    def clear_variants(self):
+        """
+        Clear variants
+        Keeps only originals of remembered ids after all variants were
+        removed from storage.
+        :return: None
+        """
+        with self._lock:
+            for id in self._ids:
+                original = self.backend.id_to_path(id)[5]
+                self._ids[id] &= {original}
+
+    def stats(self):
+        """
+        Stats
+        Returns index counters
+        :return: dict
+        """
+        with self._lock:
+            return dict(
+                ids=len(self._ids),
+                lists=self.lists,
+                negatives=self.negatives,
+            )
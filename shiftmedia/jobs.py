@@ -0,0 +1,257 @@
+import os, json, time, sqlite3, threading
+from abc import ABCMeta, abstractmethod
+
+
+class Job:
+    """
+    Job
+    A unit of work reserved from a job queue
+    """
+    def __init__(self, id, kind, payload, attempts=0, max_attempts=3):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+
+    def __repr__(self):
+        return '<Job {} {} attempt {}/{}>'.format(
+            self.id,
+            self.kind,
+            self.attempts,
+            self.max_attempts
+        )
+
+
+class JobQueue(metaclass=ABCMeta):
+    """
+    Abstract job queue
+    This defines methods your job queue must implement in order to offload
+    resize and warmup work from the request path to workers.
+    """
+
+    @abstractmethod
+    def put(self, kind, payload, max_attempts=None):
+        """
+        Put
+        Enqueues a job
+        :param kind: string - job kind, e.g. 'resize'
+        :param payload: dict - json-serializable job parameters
+        :param max_attempts: int - attempts before job is failed for good
+        :return: job id
+        """
+        pass
+
+    @abstractmethod
+    def reserve(self, lease=300):
+        """
+        Reserve
+        Takes next available job off the queue for the duration of a lease.
+        Jobs whose lease expired (e.g. their worker crashed) become
+        available again.
+        :param lease: float - seconds to hold the job for
+        :return: shiftmedia.jobs.Job or None
+        """
+        pass
+
+    @abstractmethod
+    def complete(self, job):
+        """
+        Complete
+        Removes successfully processed job from the queue
+        :param job: shiftmedia.jobs.Job
+        :return: None
+        """
+        pass
+
+    @abstractmethod
+    def fail(self, job, error=None):
+        """
+        Fail
+        Puts failed job back to the queue to be retried later or marks it
+        as failed if out of attempts.
+        :param job: shiftmedia.jobs.Job
+        :param error: string - error description
+        :return: bool - whether job will be retried
+        """
+        pass
+
+    @abstractmethod
+    def count(self, status=None):
+        """
+        Count
+        Returns number of jobs in the queue
+        :param status: string - queued/reserved/failed, None for all
+        :return: int
+        """
+        pass
+
+
+class SqliteJobQueue(JobQueue):
+    """
+    SQLite job queue
+    Durable local job queue kept in an SQLite database file. Safe to use
+    from several threads and processes on one host.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            available_at REAL NOT NULL,
+            leased_until REAL,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_available
+            ON jobs (status, available_at);
+    """
+
+    def __init__(self, path, max_attempts=3, retry_delay=5, timeout=30):
+        """
+        SQLite job queue constructor
+        :param path: string - path to database file
+        :param max_attempts: int - default attempts before job is failed
+        :param retry_delay: float - base delay before retry, doubles
+        :param timeout: float - seconds to wait for database lock
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._local = threading.local()
+        dir = os.path.dirname(path)
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.connection.executescript(self.SCHEMA)
+
+    @property
+    def connection(self):
+        """
+        Get connection
+        Returns database connection for current thread and process
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            connection = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = pid
+        return self._local.connection
+
+    def put(self, kind, payload, max_attempts=None):
+        """
+        Put
+        Enqueues a job
+        :param kind: string - job kind, e.g. 'resize'
+        :param payload: dict - json-serializable job parameters
+        :param max_attempts: int - attempts before job is failed for good
+        :return: job id
+        """
+        max_attempts = max_attempts or self.max_attempts
+        cursor = self.connection.execute(
+            'INSERT INTO jobs (kind, payload, max_attempts, available_at) '
+            'VALUES (?, ?, ?, ?)',
+            (kind, json.dumps(payload), max_attempts, time.time())
+        )
+        return cursor.lastrowid
+
+    def reserve(self, lease=300):
+        """
+        Reserve
+        Takes next available job off the queue for the duration of a lease.
+        Jobs whose lease expired (e.g. their worker crashed) become
+        available again, unless they used up their attempts, in which case
+        they are failed so that a job crashing its worker can't do that
+        forever.
+        :param lease: float - seconds to hold the job for
+        :return: shiftmedia.jobs.Job or None
+        """
+        now = time.time()
+        db = self.connection
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', leased_until = NULL, "
+                "error = 'Lease expired, out of attempts' "
+                "WHERE status = 'reserved' AND leased_until <= ? "
+                "AND attempts >= max_attempts",
+                (now,)
+            )
+            row = db.execute(
+                "SELECT id, kind, payload, attempts, max_attempts FROM jobs "
+                "WHERE (status = 'queued' AND available_at <= ?) "
+                "OR (status = 'reserved' AND leased_until <= ?) "
+                "ORDER BY id LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if not row:
+                db.execute('COMMIT')
+                return None
+
+            id, kind, payload, attempts, max_attempts = row
+            db.execute(
+                "UPDATE jobs SET status = 'reserved', attempts = ?, "
+                "leased_until = ? WHERE id = ?",
+                (attempts + 1, now + lease, id)
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+        return Job(id, kind, json.loads(payload), attempts + 1, max_attempts)
+
+    def complete(self, job):
+        """
+        Complete
+        Removes successfully processed job from the queue
+        :param job: shiftmedia.jobs.Job
+        :return: None
+        """
+        self.connection.execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+
+    def fail(self, job, error=None):
+        """
+        Fail
+        Puts failed job back to the queue to be retried with exponential
+        backoff or marks it as failed if out of attempts.
+        :param job: shiftmedia.jobs.Job
+        :param error: string - error description
+        :return: bool - whether job will be retried
+        """
+        if job.attempts >= job.max_attempts:
+            self.connection.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, "
+                "leased_until = NULL WHERE id = ?",
+                (error, job.id)
+            )
+            return False
+
+        delay = self.retry_delay * 2 ** (job.attempts - 1)
+        self.connection.execute(
+            "UPDATE jobs SET status = 'queued', error = ?, "
+            "available_at = ?, leased_until = NULL WHERE id = ?",
+            (error, time.time() + delay, job.id)
+        )
+        return True
+
+    def count(self, status=None):
+        """
+        Count
+        Returns number of jobs in the queue
+        :param status: string - queued/reserved/failed, None for all
+        :return: int
+        """
+        if status:
+            query = 'SELECT COUNT(*) FROM jobs WHERE status = ?'
+            return self.connection.execute(query, (status,)).fetchone()[0]
+        query = 'SELECT COUNT(*) FROM jobs'
+        return self.connection.execute(query).fetchone()[0]
@@ -0,0 +1,115 @@
+import bisect
+from shiftmedia import exceptions as x
+
+
+class SizeLadder:
+    """
+    Size ladder
+    A fixed set of allowed dimensions (rungs). Requested resize sizes are
+    snapped to the nearest rung when urls are built, so that clients asking
+    for sizes a pixel apart share one variant. This bounds the number of
+    variants per image, which keeps cache hit ratios up and stored variant
+    counts down. Rungs either grow geometrically by a step (e.g. 8%) or are
+    given as a list. Only the longer side of a size is snapped, the other
+    one is scaled to keep the requested aspect ratio, so that snapping
+    never changes framing of fill crops.
+    """
+
+    def __init__(
+        self,
+        step=None,
+        rungs=None,
+        min_size=16,
+        max_size=4096,
+        strict=False
+    ):
+        """
+        Size ladder constructor
+        :param step: float - geometric step between rungs, e.g. 0.08
+        :param rungs: list - explicit rungs, used instead of step
+        :param min_size: int - smallest rung of geometric ladder
+        :param max_size: int - largest rung of geometric ladder
+        :param strict: bool - refuse to create off-ladder resizes
+        """
+        if rungs:
+            rungs = sorted(set(int(rung) for rung in rungs))
+            if rungs[0] <= 0:
+                err = 'Ladder rungs must be positive'
+                raise x.ConfigurationException(err)
+        elif step:
+            if step <= 0:
+                err = 'Ladder step must be positive'
+                raise x.ConfigurationException(err)
+            if not 0 < min_size <= max_size:
+                err = 'Ladder min size must be positive and not over max size'
+                raise x.ConfigurationException(err)
+            rungs = self.geometric(step, min_size, max_size)
+        else:
+            err = 'Ladder needs either a step or a list of rungs'
+            raise x.ConfigurationException(err)
+
+        self.rungs = rungs
+        self.strict = strict
+        self._members = frozenset(rungs)
+
+    @staticmethod
+    def geometric(step, min_size, max_size):
+        """
+        Geometric
+        Generates rungs growing by step, at least a pixel apart
+        :param step: float - growth step, e.g. 0.08 for 8%
+        :param min_size: int - first rung
+        :param max_size: int - last rung
+        :return: list
+        """
+        rungs = [int(min_size)]
+        while rungs[-1] < max_size:
+            rung = max(rungs[-1] + 1, int(round(rungs[-1] * (1 + step))))
+            rungs.append(min(rung, int(max_size)))
+        return rungs
+
+    def snap(self, value):
+        """
+        Snap
+        Returns rung nearest to a dimension, the bigger one on ties.
+        Dimensions outside of the ladder snap to its ends.
+        :param value: int - dimension in pixels
+        :return: int
+        """
+        index = bisect.bisect_left(self.rungs, value)
+        if index == 0:
+            return self.rungs[0]
+        if index == len(self.rungs):
+            return self.rungs[-1]
+        below = self.rungs[index - 1]
+        above = self.rungs[index]
+        return below if value - below < above - value else above
+
+    def snap_size(self, size):
+        """
+        Snap size
+        Snaps longer side of a canonical size string to the ladder and
+        scales the shorter one to keep aspect ratio
+        :param size: string - width x height, e.g. 100x200
+        :return: string
+        """
+        width, height = [int(side) for side in size.split('x')]
+        longer = max(width, height)
+        snapped = self.snap(longer)
+        if width >= height:
+            height = max(1, int(round(height * snapped / longer)))
+            width = snapped
+        else:
+            width = max(1, int(round(width * snapped / longer)))
+            height = snapped
+        return '{}x{}'.format(width, height)
+
+    def contains(self, width, height):
+        """
+        Contains
+        Checks whether longer side of a size is on the ladder
+        :param width: int
+        :param height: int
+        :return: bool
+        """
+        return max(width, height) in self._members
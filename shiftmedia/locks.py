@@ -0,0 +1,262 @@
+import os, time, json, uuid, socket, hashlib, fcntl
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from shiftmedia import exceptions as x
+
+
+class Lock:
+    """
+    Lock
+    A handle to an acquired lock returned by lock managers. Holds the key,
+    a unique owner token and lease expiration time.
+    """
+    def __init__(self, key, token, expires, handle=None):
+        self.key = key
+        self.token = token
+        self.expires = expires
+        self.handle = handle
+
+    @property
+    def expired(self):
+        """ Whether the lease on this lock has expired """
+        return time.time() >= self.expires
+
+
+class LockManager(metaclass=ABCMeta):
+    """
+    Abstract lock manager
+    This defines methods your lock manager must implement in order to
+    serialize work on storage variants across processes and hosts.
+    """
+
+    @abstractmethod
+    def acquire(self, key, timeout=None):
+        """
+        Acquire
+        Blocks until lock for given key is acquired or timeout elapses, in
+        which case raises an exception.
+        :param key: string - lock key
+        :param timeout: float - seconds to wait, None to wait forever
+        :return: shiftmedia.locks.Lock
+        """
+        pass
+
+    @abstractmethod
+    def refresh(self, lock):
+        """
+        Refresh
+        Extends lease on a held lock, should be called by long-running
+        work to prevent others from considering the lock stale.
+        :param lock: shiftmedia.locks.Lock
+        :return: shiftmedia.locks.Lock
+        """
+        pass
+
+    @abstractmethod
+    def release(self, lock):
+        """
+        Release
+        Releases previously acquired lock
+        :param lock: shiftmedia.locks.Lock
+        :return: None
+        """
+        pass
+
+    @contextmanager
+    def lock(self, key, timeout=None):
+        """
+        Lock
+        Context manager to acquire lock for the duration of a block
+        :param key: string - lock key
+        :param timeout: float - seconds to wait, None to wait forever
+        """
+        lock = self.acquire(key, timeout)
+        try:
+            yield lock
+        finally:
+            self.release(lock)
+
+
+class FileLockManager(LockManager):
+    """
+    File lock manager
+    Serializes work across processes with fcntl-locked files under a
+    directory (usually inside local temp). Every lock file carries a lease
+    with owner details and expiration time, so that a lock held by a
+    crashed worker, or by a worker on another host sharing the volume,
+    will not block others forever.
+    """
+
+    def __init__(self, path, lease=60, poll=0.05):
+        """
+        File lock manager constructor
+        :param path: string - directory to keep lock files in
+        :param lease: float - lease duration in seconds
+        :param poll: float - delay between acquisition attempts in seconds
+        """
+        self._path = path
+        self.lease = lease
+        self.poll = poll
+        self.host = socket.gethostname()
+
+    @property
+    def path(self):
+        """
+        Get path
+        Returns path to lock files directory and creates one if necessary
+        """
+        if not os.path.exists(self._path):
+            os.makedirs(self._path, exist_ok=True)
+        return self._path
+
+    def key_to_path(self, key):
+        """
+        Key to path
+        Returns path to lock file for given key
+        :param key: string - lock key
+        :return: string
+        """
+        name = hashlib.sha1(bytes(key, 'utf-8')).hexdigest()
+        return os.path.join(self.path, name + '.lock')
+
+    def read_lease(self, fd):
+        """
+        Read lease
+        Reads lease data from lock file descriptor
+        :param fd: int - file descriptor
+        :return: dict or None
+        """
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, 4096)
+        if not data:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def write_lease(self, fd, lock):
+        """
+        Write lease
+        Writes lease data for given lock to file descriptor
+        :param fd: int - file descriptor
+        :param lock: shiftmedia.locks.Lock
+        :return: None
+        """
+        lease = dict(
+            key=lock.key,
+            token=lock.token,
+            expires=lock.expires,
+            host=self.host,
+            pid=os.getpid()
+        )
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, bytes(json.dumps(lease), 'utf-8'))
+
+    def is_stale(self, lease):
+        """
+        Is stale
+        Checks whether lease found in lock file can be taken over: it is
+        either empty, expired or belongs to a dead process on this host.
+        :param lease: dict or None
+        :return: bool
+        """
+        if not lease:
+            return True
+        if lease.get('expires', 0) <= time.time():
+            return True
+        if lease.get('host') == self.host:
+            try:
+                os.kill(lease.get('pid'), 0)
+            except ProcessLookupError:
+                return True
+            except (PermissionError, TypeError):
+                pass
+        return False
+
+    def try_acquire(self, key):
+        """
+        Try acquire
+        Makes a single non-blocking attempt to acquire lock.
+        :param key: string - lock key
+        :return: shiftmedia.locks.Lock or None
+        """
+        path = self.key_to_path(key)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (BlockingIOError, PermissionError):
+            os.close(fd)
+            return None
+
+        # file was unlinked by previous owner after we opened it
+        try:
+            current = os.stat(path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(fd).st_ino or not self.is_stale(
+            self.read_lease(fd)
+        ):
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            return None
+
+        token = uuid.uuid4().hex
+        lock = Lock(key, token, time.time() + self.lease, handle=fd)
+        self.write_lease(fd, lock)
+        return lock
+
+    def acquire(self, key, timeout=None):
+        """
+        Acquire
+        Blocks until lock for given key is acquired or timeout elapses, in
+        which case raises an exception.
+        :param key: string - lock key
+        :param timeout: float - seconds to wait, None to wait forever
+        :return: shiftmedia.locks.Lock
+        """
+        started = time.monotonic()
+        while True:
+            lock = self.try_acquire(key)
+            if lock:
+                return lock
+            if timeout is not None and time.monotonic() - started >= timeout:
+                msg = 'Unable to acquire lock [{}] within {} seconds'
+                raise x.LockTimeout(msg.format(key, timeout))
+            time.sleep(self.poll)
+
+    def refresh(self, lock):
+        """
+        Refresh
+        Extends lease on a held lock, should be called by long-running
+        work to prevent others from considering the lock stale.
+        :param lock: shiftmedia.locks.Lock
+        :return: shiftmedia.locks.Lock
+        """
+        lock.expires = time.time() + self.lease
+        self.write_lease(lock.handle, lock)
+        return lock
+
+    def release(self, lock):
+        """
+        Release
+        Removes lock file if the lease still belongs to us and releases
+        the underlying file lock.
+        :param lock: shiftmedia.locks.Lock
+        :return: None
+        """
+        fd = lock.handle
+        if fd is None:
+            return
+        try:
+            lease = self.read_lease(fd)
+            if lease and lease.get('token') == lock.token:
+                try:
+                    os.remove(self.key_to_path(lock.key))
+                except FileNotFoundError:
+                    pass
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            lock.handle = None
@@ -0,0 +1,406 @@
+import time, functools, threading
+from contextlib import contextmanager
+from abc import ABCMeta, abstractmethod
+
+# metric names
+STAGE_SECONDS = 'shiftmedia_stage_seconds'
+BACKEND_SECONDS = 'shiftmedia_backend_seconds'
+BACKEND_BYTES = 'shiftmedia_backend_bytes_total'
+VARIANT_CACHE = 'shiftmedia_variant_cache_total'
+RESIZES = 'shiftmedia_resizes_total'
+MEMORY_BUDGET = 'shiftmedia_memory_budget_total'
+WRITE_BEHIND = 'shiftmedia_write_behind_total'
+
+
+class Timer:
+    """
+    Timer
+    Context manager measuring wall time of a block and reporting it to a
+    sink, whether the block succeeds or raises.
+    """
+    __slots__ = ('sink', 'name', 'labels', 'start')
+
+    def __init__(self, sink, name, labels):
+        self.sink = sink
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        self.sink.timing(self.name, elapsed, self.labels)
+
+
+class NullTimer:
+    """ Timer that measures nothing """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Sink(metaclass=ABCMeta):
+    """
+    Abstract sink
+    Receives timings and counters from instrumented code. Implement to
+    forward metrics to statsd, Prometheus client or anything else.
+    """
+
+    # instrumented code skips extra work (e.g. stat calls) if disabled
+    enabled = True
+
+    @abstractmethod
+    def timing(self, name, seconds, labels=None):
+        """
+        Timing
+        Records duration of an operation
+        :param name: string - metric name
+        :param seconds: float - duration
+        :param labels: dict - metric labels
+        :return: None
+        """
+        pass
+
+    @abstractmethod
+    def increment(self, name, value=1, labels=None):
+        """
+        Increment
+        Increments a counter
+        :param name: string - metric name
+        :param value: int or float - amount to add
+        :param labels: dict - metric labels
+        :return: None
+        """
+        pass
+
+    def timer(self, name, labels=None):
+        """
+        Timer
+        Returns context manager recording duration of a block
+        :param name: string - metric name
+        :param labels: dict - metric labels
+        :return: shiftmedia.metrics.Timer
+        """
+        return Timer(self, name, labels)
+
+
+class NullSink(Sink):
+    """
+    Null sink
+    Default sink that drops everything. Timers it hands out are a shared
+    object doing nothing, so instrumentation costs next to nothing.
+    """
+
+    enabled = False
+
+    def timing(self, name, seconds, labels=None):
+        pass
+
+    def increment(self, name, value=1, labels=None):
+        pass
+
+    def timer(self, name, labels=None):
+        return NULL_TIMER
+
+
+class Registry(Sink):
+    """
+    Registry
+    In-process sink keeping counters and timing histograms in memory and
+    rendering them in Prometheus text exposition format. Safe to use from
+    multiple threads. Every process keeps its own registry.
+    """
+
+    # prometheus client default buckets, seconds
+    BUCKETS = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+
+    def __init__(self, buckets=None):
+        """
+        Registry constructor
+        :param buckets: tuple - histogram bucket upper bounds in seconds
+        """
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.counters = dict()
+        self.histograms = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(labels):
+        """ Get hashable key of a labels dict """
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def timing(self, name, seconds, labels=None):
+        """
+        Timing
+        Records duration in a histogram
+        :param name: string - metric name
+        :param seconds: float - duration
+        :param labels: dict - metric labels
+        :return: None
+        """
+        key = self.key(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, dict())
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = [[0] * len(self.buckets), 0.0, 0]
+                series[key] = histogram
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def increment(self, name, value=1, labels=None):
+        """
+        Increment
+        Increments a counter
+        :param name: string - metric name
+        :param value: int or float - amount to add
+        :param labels: dict - metric labels
+        :return: None
+        """
+        key = self.key(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+
+    def get_counter(self, name, **labels):
+        """
+        Get counter
+        Returns current value of a counter
+        :param name: string - metric name
+        :return: int or float
+        """
+        with self._lock:
+            return self.counters.get(name, {}).get(self.key(labels), 0)
+
+    def get_timing(self, name, **labels):
+        """
+        Get timing
+        Returns number and total duration of recorded timings
+        :param name: string - metric name
+        :return: tuple - count and sum in seconds
+        """
+        with self._lock:
+            histogram = self.histograms.get(name, {}).get(self.key(labels))
+            if histogram is None:
+                return 0, 0.0
+            return histogram[2], histogram[1]
+
+    def reset(self):
+        """
+        Reset
+        Drops all recorded metrics
+        :return: None
+        """
+        with self._lock:
+            self.counters = dict()
+            self.histograms = dict()
+
+    @staticmethod
+    def format_labels(key, extra=None):
+        """ Get labels in exposition format, e.g. {stage="decode"} """
+        pairs = list(key) + (extra or [])
+        if not pairs:
+            return ''
+        escaped = []
+        for label, value in pairs:
+            value = str(value).replace('\\', r'\\').replace('"', r'\"')
+            value = value.replace('\n', r'\n')
+            escaped.append('{}="{}"'.format(label, value))
+        return '{' + ','.join(escaped) + '}'
+
+    @staticmethod
+    def format_value(value):
+        """ Get sample value in exposition format """
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
+
+    def render(self):
+        """
+        Render
+        Returns all metrics in Prometheus text exposition format
+        :return: string
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self.counters):
+                lines.append('# TYPE {} counter'.format(name))
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append('{}{} {}'.format(
+                        name,
+                        self.format_labels(key),
+                        self.format_value(value)
+                    ))
+
+            for name in sorted(self.histograms):
+                lines.append('# TYPE {} histogram'.format(name))
+                for key, histogram in sorted(self.histograms[name].items()):
+                    counts, total, count = histogram
+                    bounds = [repr(b) for b in self.buckets] + ['+Inf']
+                    for bound, value in zip(bounds, counts + [count]):
+                        lines.append('{}_bucket{} {}'.format(
+                            name,
+                            self.format_labels(key, [('le', bound)]),
+                            value
+                        ))
+                    labels = self.format_labels(key)
+                    lines.append('{}_sum{} {}'.format(name, labels, total))
+                    lines.append('{}_count{} {}'.format(name, labels, count))
+
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+class Collector(Sink):
+    """
+    Collector
+    Sink collecting durations and transferred bytes of a single call,
+    keyed by stage or operation, while forwarding everything to the
+    sink it replaces. See collect().
+    """
+
+    def __init__(self, parent):
+        """
+        Collector constructor
+        :param parent: shiftmedia.metrics.Sink - sink to forward to
+        """
+        self.parent = parent
+        self.durations = dict()
+        self.bytes = dict()
+
+    @staticmethod
+    def key(name, labels):
+        """ Get stage or operation name of a metric """
+        if not labels:
+            return name
+        return labels.get('stage') or labels.get('operation') or name
+
+    def timing(self, name, seconds, labels=None):
+        key = self.key(name, labels)
+        self.durations[key] = self.durations.get(key, 0.0) + seconds
+        self.parent.timing(name, seconds, labels)
+
+    def increment(self, name, value=1, labels=None):
+        if name == BACKEND_BYTES:
+            key = self.key(name, labels)
+            self.bytes[key] = self.bytes.get(key, 0) + value
+        self.parent.increment(name, value, labels)
+
+
+# current sink, drops everything unless configured
+_sink = NullSink()
+
+# collectors of calls in progress, per thread
+_local = threading.local()
+
+
+def get_sink():
+    """
+    Get sink
+    Returns sink instrumented code currently reports to
+    :return: shiftmedia.metrics.Sink
+    """
+    return _sink
+
+
+def set_sink(sink):
+    """
+    Set sink
+    Sets sink all instrumented code reports to. Pass None to disable.
+    :param sink: shiftmedia.metrics.Sink
+    :return: shiftmedia.metrics.Sink - previous sink
+    """
+    global _sink
+    previous = _sink
+    _sink = sink or NullSink()
+    return previous
+
+
+def current():
+    """
+    Current
+    Returns sink of current thread: collector of the call in progress,
+    if any, or the global sink
+    :return: shiftmedia.metrics.Sink
+    """
+    return getattr(_local, 'collector', None) or _sink
+
+
+@contextmanager
+def collect(needed=True):
+    """
+    Collect
+    Context manager collecting durations and bytes reported by the
+    current thread within a block, in addition to reporting them to
+    the global sink. Collection works with metrics disabled as well,
+    unless it is not needed: then the block runs uninstrumented and
+    the collector stays empty.
+    :param needed: bool - collect even if metrics are disabled
+    :return: shiftmedia.metrics.Collector
+    """
+    previous = getattr(_local, 'collector', None)
+    collector = Collector(previous or _sink)
+    if not needed and not current().enabled:
+        yield collector
+        return
+    _local.collector = collector
+    try:
+        yield collector
+    finally:
+        _local.collector = previous
+
+
+def enabled():
+    """ Check whether metrics are being collected """
+    return current().enabled
+
+
+def timer(name, **labels):
+    """
+    Timer
+    Returns context manager recording duration of a block to current sink
+    :param name: string - metric name
+    :return: context manager
+    """
+    return current().timer(name, labels)
+
+
+def increment(name, value=1, **labels):
+    """
+    Increment
+    Increments a counter of current sink
+    :param name: string - metric name
+    :param value: int or float - amount to add
+    :return: None
+    """
+    current().increment(name, value, labels)
+
+
+def timed(name, **labels):
+    """
+    Timed
+    Decorator recording duration of every call to current sink
+    :param name: string - metric name
+    :return: decorator
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with current().timer(name, labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,16 +1,227 @@
-import hashlib
+import re, functools
+from enum import Enum
 from shiftmedia import exceptions as x
-from shiftmedia import utils
+from shiftmedia import utils, tracing
+from shiftmedia.signing import Md5Signer
+
+
+class ResizeMode(Enum):
+    """ Resize modes encoded in filenames """
+    AUTO = 'auto'
+    MANUAL = 'manual'
+
+
+class ResizeParams:
+    """
+    Resize parameters
+    Immutable result of parsing a resize filename with typed fields.
+    Dictionary access by legacy keys is supported for compatibility.
+    """
+    __slots__ = (
+        'id',
+        'filename',
+        'mode',
+        'width',
+        'height',
+        'factor',
+        'sample_width',
+        'sample_height',
+        'quality',
+        'upscale',
+        'output_format',
+        'preset',
+    )
+
+    def __init__(
+        self,
+        id,
+        filename,
+        mode,
+        width,
+        height,
+        factor=None,
+        sample_width=None,
+        sample_height=None,
+        quality=65,
+        upscale=True,
+        output_format=None,
+        preset=None
+    ):
+        """
+        Resize parameters constructor
+        :param id: string - storage id
+        :param filename: string - resize filename
+        :param mode: shiftmedia.paths.ResizeMode - resize mode
+        :param width: int - target width
+        :param height: int - target height
+        :param factor: string - crop factor (fit/fill) of auto resizes
+        :param sample_width: int - sample width of manual resizes
+        :param sample_height: int - sample height of manual resizes
+        :param quality: int - output quality
+        :param upscale: bool - enlarge smaller original
+        :param output_format: string - output format extension
+        :param preset: string - preset name if filename refers to one
+        """
+        assign = object.__setattr__
+        assign(self, 'id', id)
+        assign(self, 'filename', filename)
+        assign(self, 'mode', mode)
+        assign(self, 'width', width)
+        assign(self, 'height', height)
+        assign(self, 'factor', factor)
+        assign(self, 'sample_width', sample_width)
+        assign(self, 'sample_height', sample_height)
+        assign(self, 'quality', quality)
+        assign(self, 'upscale', upscale)
+        assign(self, 'output_format', output_format)
+        assign(self, 'preset', preset)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Resize parameters are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Resize parameters are immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, ResizeParams):
+            return NotImplemented
+        return self.astuple() == other.astuple()
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        return '<ResizeParams {}/{}>'.format(self.id, self.filename)
+
+    def astuple(self):
+        """ Get field values """
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @property
+    def size(self):
+        """ Get target size as a tuple """
+        return self.width, self.height
+
+    @property
+    def target_size(self):
+        """ Get target size as width x height string """
+        return '{}x{}'.format(self.width, self.height)
+
+    @property
+    def sample_size(self):
+        """ Get sample size of manual resize as width x height string """
+        if self.mode is not ResizeMode.MANUAL:
+            return None
+        return '{}x{}'.format(self.sample_width, self.sample_height)
+
+    def to_dict(self):
+        """
+        To dict
+        Returns parameters in legacy dictionary format
+        :return: dict
+        """
+        result = dict(
+            id=self.id,
+            resize_mode=self.mode.value,
+            target_size=self.target_size,
+            output_format=self.output_format,
+            quality=self.quality,
+            filename=self.filename,
+            upscale=self.upscale
+        )
+        if self.mode is ResizeMode.AUTO:
+            result['factor'] = self.factor
+        else:
+            result['sample_size'] = self.sample_size
+        if self.preset:
+            result['preset'] = self.preset
+        return result
+
+    def __getitem__(self, key):
+        try:
+            return self.to_dict()[key]
+        except KeyError:
+            raise KeyError(key) from None
+
+
+class ParsedId:
+    """
+    Parsed id
+    Storage id split into path parts once, together with url prefix all
+    urls of files under that id start with. Used to build many urls for
+    the same id without repeating string work.
+    """
+    __slots__ = ('id', 'parts', 'path', 'original', 'extension', 'prefix')
+
+    def __init__(self, id, parts, base_url):
+        """
+        Parsed id constructor
+        :param id: string - storage id
+        :param parts: list - path parts as returned by backend.id_to_path
+        :param base_url: string - storage base url without trailing slash
+        """
+        self.id = id
+        self.parts = tuple(parts)
+        self.path = '/'.join(parts)
+        self.original = parts[5]
+        self.extension = parts[5].partition('.')[2]
+        self.prefix = base_url + '/' + self.path + '/'
+
+    def __repr__(self):
+        return '<ParsedId {}>'.format(self.id)
 
 
 class PathBuilder:
-    def __init__(self, secret_key):
+
+    # resize filename, parsed in a single pass
+    FILENAME = re.compile(
+        r'^(?P<width>\d{1,6})x(?P<height>\d{1,6})'
+        r'-(?:(?P<factor>fill|fit)'
+        r'|(?P<sample_width>\d{1,6})x(?P<sample_height>\d{1,6}))'
+        r'-(?P<quality>\d{1,3})'
+        r'-(?P<upscale>upscale|noupscale)'
+        r'-(?P<signature>[0-9a-f]+)'
+        r'\.(?P<format>\w+(?:\.\w+)*)$'
+    )
+
+    # preset filename and name
+    PRESET_FILENAME = re.compile(
+        r'^(?P<preset>[a-z0-9_@]+)'
+        r'-(?P<signature>[0-9a-f]+)'
+        r'\.(?P<format>\w+(?:\.\w+)*)$'
+    )
+    PRESET_NAME = re.compile(r'^[a-z0-9_@]+$')
+
+    # number of parsed filenames to remember
+    PARSE_CACHE_SIZE = 4096
+
+    # formats quality makes no difference to
+    LOSSLESS_FORMATS = ('png', 'gif')
+    LOSSLESS_QUALITY = 100
+
+    def __init__(
+        self,
+        secret_key,
+        signer=None,
+        strict_presets=False,
+        ladder=None
+    ):
         """
         Path builder constructor
         Initializes path builder service.
         :param secret_key: string - secret key from config
+        :param signer: shiftmedia.signing.Signer, defaults to legacy md5
+        :param strict_presets: bool - only accept preset filenames
+        :param ladder: shiftmedia.ladder.SizeLadder - allowed auto crop sizes
         """
         self.secret_key = secret_key
+        self.signer = signer or Md5Signer(secret_key)
+        self.strict_presets = strict_presets
+        self.ladder = ladder
+        self.presets = dict()
+        self.parse_filename = functools.lru_cache(self.PARSE_CACHE_SIZE)(
+            self._parse_filename
+        )
 
     def generate_signature(self, id, filename):
         """
@@ -23,10 +234,7 @@ class PathBuilder:
         :param filename: - string, resize filename
         :return: string - signature
         """
-        sign_me = bytes(id + filename + self.secret_key, 'utf-8')
-        signature = hashlib.md5()
-        signature.update(sign_me)
-        return signature.hexdigest()
+        return self.signer.sign(id, filename)
 
     def validate_signature(self, id, filename):
         """
@@ -39,14 +247,83 @@ class PathBuilder:
         :param filename: - string, resize filename
         :return:
         """
-        parts = filename.split('-')
-        if len(parts) != 5:
+        stem, dot, extension = filename.partition('.')
+        non_signed, dash, signature = stem.rpartition('-')
+        if not dot or not dash or non_signed.count('-') != 3:
             return False
-        
-        extension = parts[4][parts[4].index('.'):]
-        non_signed_filename = '-'.join(parts[:4]) + extension
-        signature = parts[4].replace(extension, '')
-        return signature == self.generate_signature(id, non_signed_filename)
+
+        non_signed_filename = non_signed + '.' + extension
+        return self.signer.verify(id, non_signed_filename, signature)
+
+    @staticmethod
+    def canonical_size(size):
+        """
+        Canonical size
+        Returns size in canonical form (lowercase, no leading zeros) or
+        None if size is invalid
+        :param size: string - width x height
+        :return: string or None
+        """
+        dimensions = str(size).lower().split('x')
+        if len(dimensions) != 2:
+            return None
+        for dimension in dimensions:
+            if not dimension.isdigit() or int(dimension) <= 0:
+                return None
+        return '{}x{}'.format(int(dimensions[0]), int(dimensions[1]))
+
+    @staticmethod
+    def canonical_format(id, output_format=None):
+        """
+        Canonical format
+        Returns normalized lowercase output format extension, using
+        extension of the original if none given
+        :param id: string - storage id
+        :param output_format: string - requested format
+        :return: string
+        """
+        if not output_format:
+            parts = id.split('-')
+            output_format = parts[5][parts[5].index('.') + 1:]
+        return utils.normalize_extension(output_format)
+
+    def canonical_quality(self, output_format, quality):
+        """
+        Canonical quality
+        Quality makes no difference to lossless formats, so they always get
+        the same quality in filenames
+        :param output_format: string - canonical output format
+        :param quality: string or int - requested quality
+        :return: int
+        """
+        if output_format in self.LOSSLESS_FORMATS:
+            return self.LOSSLESS_QUALITY
+        return int(quality)
+
+    def get_canonical_filename(self, params, upscale_matters=True):
+        """
+        Get canonical filename
+        Returns the filename all resizes equivalent to the given one share.
+        Resizes are equivalent when they only differ in size spelling,
+        format aliases, quality of lossless formats or in upscaling when it
+        makes no difference for the original.
+
+        :param params: shiftmedia.paths.ResizeParams - parsed filename
+        :param upscale_matters: bool - upscaling changes the output
+        :return: string - signed filename
+        """
+        if params.preset or params.mode is not ResizeMode.AUTO:
+            return params.filename
+
+        return self.get_auto_crop_filename(
+            params.id,
+            params.target_size,
+            params.factor,
+            params.output_format,
+            params.upscale or not upscale_matters,
+            params.quality,
+            snap=False
+        )
 
     def get_auto_crop_filename(
             self,
@@ -55,7 +332,8 @@ class PathBuilder:
             factor,
             output_format=None,
             upscale=True,
-            quality=65
+            quality=65,
+            snap=True
     ):
         """
         Get auto crop filename
@@ -68,20 +346,57 @@ class PathBuilder:
         :param output_format: string - output format
         :param upscale: bool - enlarge smaller original
         :param quality: string - differs per format. i.e. 0-100 for jpg
+        :param snap: bool - snap size to ladder if one is configured
         :return: string - signed filename
         """
+        return self.get_auto_crop_filenames(
+            id,
+            [size],
+            factor,
+            output_format,
+            upscale,
+            quality,
+            snap
+        )[0]
 
-        # validate size
-        err = False
-        dimensions = size.lower().split('x')
-        if len(dimensions) != 2:
-            err = True
-        for dimension in dimensions:
-            if not dimension.isdigit() or int(dimension) <= 0:
-                err = True
-        if err:
-            err = 'Invalid size provided must be in 100x200 format'
-            raise x.InvalidArgumentException(err)
+    def get_auto_crop_filenames(
+            self,
+            id,
+            sizes,
+            factor,
+            output_format=None,
+            upscale=True,
+            quality=65,
+            snap=True
+    ):
+        """
+        Get auto crop filenames
+        Bulk version of auto crop filename that encodes a number of sizes
+        sharing the rest of parameters. Shared parameters are validated
+        once and signer gets to reuse work done for the id. Sizes are
+        snapped to size ladder if one is configured.
+
+        :param id: string - storage id (used to generate signature)
+        :param sizes: list - of width x height strings
+        :param factor: string - crop factor, fit/fill
+        :param output_format: string - output format
+        :param upscale: bool - enlarge smaller original
+        :param quality: string - differs per format. i.e. 0-100 for jpg
+        :param snap: bool - snap sizes to ladder if one is configured
+        :return: list - signed filenames
+        """
+
+        # validate sizes
+        canonical_sizes = []
+        for size in sizes:
+            canonical = self.canonical_size(size)
+            if not canonical:
+                err = 'Invalid size provided must be in 100x200 format'
+                raise x.InvalidArgumentException(err)
+            if snap and self.ladder:
+                canonical = self.ladder.snap_size(canonical)
+            canonical_sizes.append(canonical)
+        sizes = canonical_sizes
 
         # validate factor
         if factor not in ['fit', 'fill']:
@@ -94,29 +409,93 @@ class PathBuilder:
             raise x.InvalidArgumentException(err)
 
         # guess format from original if not specified
-        if not output_format:
-            parts = id.split('-')
-            output_format= parts[5][parts[5].index('.') + 1:]
+        output_format = self.canonical_format(id, output_format)
+        quality = self.canonical_quality(output_format, quality)
 
         # prepare upscale
         upscale = 'upscale' if bool(upscale) else 'noupscale'
 
-        # create filename filename
-        schema = '{size}-{factor}-{quality}-{upscale}.{format}'
-        signed_schema = '{size}-{factor}-{quality}-{upscale}-{sig}.{format}'
+        # everything but size is shared
+        tail = '-{factor}-{quality}-{upscale}'.format(
+            factor=factor,
+            quality=quality,
+            upscale=upscale
+        )
+        extension = '.' + output_format
+
+        # sign
+        unsigned = [size + tail + extension for size in sizes]
+        signatures = self.signer.sign_many(id, unsigned)
+        filenames = []
+        for size, signature in zip(sizes, signatures):
+            filenames.append(size + tail + '-' + signature + extension)
+        return filenames
+
+    def add_preset(
+            self,
+            name,
+            size,
+            factor='fill',
+            output_format=None,
+            upscale=True,
+            quality=65
+    ):
+        """
+        Add preset
+        Registers a named set of auto crop parameters, e.g. 'card' or
+        'avatar@2x'. Parameters are validated upon registration. Preset
+        filenames only carry preset name and signature, so every client
+        asking for a preset hits the same variant.
+
+        :param name: string - preset name, lowercase letters, digits, _ and @
+        :param size: string - width x height
+        :param factor: string - crop factor, fit/fill
+        :param output_format: string - output format, None for original
+        :param upscale: bool - enlarge smaller original
+        :param quality: string - differs per format. i.e. 0-100 for jpg
+        :return: None
+        """
+        if not name or not self.PRESET_NAME.match(name):
+            err = 'Preset name must be non-empty and contain only lowercase '
+            err += 'letters, digits, _ and @'
+            raise x.InvalidArgumentException(err)
+
         params = dict(
             size=size,
             factor=factor,
-            quality=quality,
+            output_format=output_format,
             upscale=upscale,
-            format=output_format
+            quality=quality
         )
-        unsigend_filename = schema.format(**params)
 
-        # sign
-        params['sig'] = self.generate_signature(id, unsigend_filename)
-        signed_filename = signed_schema.format(**params)
-        return signed_filename
+        # validate by building a filename for a dummy id
+        self.get_auto_crop_filename('0-0-0-0-0-preset.jpg', **params)
+        self.presets[name] = params
+
+        # parsed filenames of a re-registered preset are stale
+        self.parse_filename.cache_clear()
+
+    def get_preset_format(self, id, name):
+        """ Get output format of a preset for given id """
+        return self.canonical_format(id, self.presets[name]['output_format'])
+
+    def get_preset_filename(self, id, name):
+        """
+        Get preset filename
+        Encodes name of a registered preset into a short signed filename,
+        e.g. card-{signature}.jpg
+
+        :param id: string - storage id (used to generate signature)
+        :param name: string - preset name
+        :return: string - signed filename
+        """
+        if name not in self.presets:
+            err = 'Preset [{}] is not registered'.format(name)
+            raise x.InvalidArgumentException(err)
+
+        extension = '.' + self.get_preset_format(id, name)
+        signature = self.generate_signature(id, name + extension)
+        return name + '-' + signature + extension
 
     def get_manual_crop_filename(
         self,
@@ -142,28 +521,18 @@ class PathBuilder:
         """
 
         # validate sample size
-        err = False
-        sample_dimensions = sample_size.lower().split('x')
-        if len(sample_dimensions) != 2:
-            err = True
-        for dimension in sample_dimensions:
-            if not dimension.isdigit() or int(dimension) <= 0:
-                err = True
-        if err:
+        sample_size = self.canonical_size(sample_size)
+        if not sample_size:
             err = 'Invalid sample size provided must be in 100x200 format'
             raise x.InvalidArgumentException(err)
+        sample_dimensions = sample_size.split('x')
 
         # validate target size
-        err = False
-        target_dimensions = target_size.lower().split('x')
-        if len(target_dimensions) != 2:
-            err = True
-        for dimension in target_dimensions:
-            if not dimension.isdigit() or int(dimension) <= 0:
-                err = True
-        if err:
+        target_size = self.canonical_size(target_size)
+        if not target_size:
             err = 'Invalid target size provided must be in 100x200 format'
             raise x.InvalidArgumentException(err)
+        target_dimensions = target_size.split('x')
 
         # validate sample and target sizes being proportional
         sw = int(sample_dimensions[0])
@@ -180,9 +549,8 @@ class PathBuilder:
             raise x.InvalidArgumentException(err)
 
         # guess format from original if not specified
-        if not output_format:
-            parts = id.split('-')
-            output_format= parts[5][parts[5].index('.') + 1:]
+        output_format = self.canonical_format(id, output_format)
+        quality = self.canonical_quality(output_format, quality)
 
         # prepare upscale
         upscale = 'upscale' if bool(upscale) else 'noupscale'
@@ -209,74 +577,118 @@ class PathBuilder:
         Filename to parameters
         Parses resize filename to a set of usable parameters. Will perform
         filename signature checking and throw an exception if requested
-        resize filename is malformed.
+        resize filename is malformed. Kept for compatibility, use
+        parse_filename() to get typed parameters.
 
         :param id: string - unique storage id
         :param filename: string - resize filename
         :return: dict of parameters
         """
+        return self.parse_filename(id, filename).to_dict()
 
-        # validate signature
-        if not self.validate_signature(id, filename):
-            err = 'Unable to parse filename: bad signature'
-            raise x.InvalidArgumentException(err)
-
-        # get parts
-        parts = filename.split('-')
-        target_size,sample_size,quality,upscale,rest = parts
-        target_format = rest[rest.index('.') + 1:]
+    @tracing.traced('paths.parse_filename')
+    def _parse_filename(self, id, filename):
+        """
+        Parse filename
+        Parses and validates resize filename in a single pass, checking its
+        signature last, so that malformed filenames are rejected without
+        hashing. Available as parse_filename() that remembers recently
+        parsed filenames.
 
-        # detect manual/auto
-        if sample_size in ['fill', 'fit']:
-            resize = 'auto'
-        else:
-            err = False
-            sample_size = sample_size.split('x')
-            for dimension in sample_size:
-                if not dimension.isdigit() or int(dimension) <= 0:
-                    err = True
-                    break
-            if err or len(sample_size) != 2:
-                err = 'Unable to parse filename: bad sample size or crop factor'
-                raise x.InvalidArgumentException(err)
-            else:
-                resize = 'manual'
+        :param id: string - unique storage id
+        :param filename: string - resize filename
+        :return: shiftmedia.paths.ResizeParams
+        """
+        match = self.FILENAME.match(filename)
+        if not match:
+            return self._parse_preset_filename(id, filename)
+        if self.strict_presets:
+            err = 'Unable to parse filename: only presets are allowed'
+            raise x.InvalidArgumentException(err)
 
-        # validate size
-        err = False
-        target_size = target_size.split('x')
-        for dimension in target_size:
-            if not dimension.isdigit() or int(dimension) <= 0:
-                err = True
-                break
-        if err or len(target_size) != 2:
+        width = int(match.group('width'))
+        height = int(match.group('height'))
+        if not width or not height:
             err = 'Unable to parse filename: bad target size'
             raise x.InvalidArgumentException(err)
 
-        # validate quality
-        if not str(quality).isdigit():
-            err = 'Quality must be numeric'
-            raise x.InvalidArgumentException(err)
+        factor = match.group('factor')
+        sample_width = sample_height = None
+        mode = ResizeMode.AUTO
+        if not factor:
+            mode = ResizeMode.MANUAL
+            sample_width = int(match.group('sample_width'))
+            sample_height = int(match.group('sample_height'))
+            if not sample_width or not sample_height:
+                err = 'Unable to parse filename: bad sample size'
+                raise x.InvalidArgumentException(err)
+        elif self.ladder and self.ladder.strict:
+            if not self.ladder.contains(width, height):
+                err = 'Unable to parse filename: size is not on the ladder'
+                raise x.InvalidArgumentException(err)
 
-        # prepare upscale
-        upscale = True if upscale == 'upscale' else False
+        # validate signature
+        start, end = match.span('signature')
+        unsigned = filename[:start - 1] + filename[end:]
+        if not self.signer.verify(id, unsigned, match.group('signature')):
+            err = 'Unable to parse filename: bad signature'
+            raise x.InvalidArgumentException(err)
 
-        # prepare result
-        result = dict(
+        return ResizeParams(
             id=id,
-            resize_mode=resize,
-            target_size='x'.join(target_size),
-            output_format=target_format,
-            quality=int(quality),
             filename=filename,
-            upscale=upscale
+            mode=mode,
+            width=width,
+            height=height,
+            factor=factor,
+            sample_width=sample_width,
+            sample_height=sample_height,
+            quality=int(match.group('quality')),
+            upscale=match.group('upscale') == 'upscale',
+            output_format=match.group('format')
         )
 
-        if resize == 'auto':
-            result['factor'] = sample_size
-        if resize == 'manual':
-            result['sample_size'] = 'x'.join(sample_size)
+    def _parse_preset_filename(self, id, filename):
+        """
+        Parse preset filename
+        Parses and validates short filename of a registered preset
 
-        return result
+        :param id: string - unique storage id
+        :param filename: string - preset filename
+        :return: shiftmedia.paths.ResizeParams
+        """
+        match = self.PRESET_FILENAME.match(filename)
+        if not match:
+            err = 'Unable to parse filename: malformed filename'
+            raise x.InvalidArgumentException(err)
 
+        name = match.group('preset')
+        if name not in self.presets:
+            err = 'Unable to parse filename: unknown preset'
+            raise x.InvalidArgumentException(err)
 
+        output_format = self.get_preset_format(id, name)
+        if match.group('format') != output_format:
+            err = 'Unable to parse filename: bad preset format'
+            raise x.InvalidArgumentException(err)
+
+        # validate signature
+        unsigned = name + '.' + match.group('format')
+        if not self.signer.verify(id, unsigned, match.group('signature')):
+            err = 'Unable to parse filename: bad signature'
+            raise x.InvalidArgumentException(err)
+
+        preset = self.presets[name]
+        width, height = preset['size'].lower().split('x')
+        return ResizeParams(
+            id=id,
+            filename=filename,
+            mode=ResizeMode.AUTO,
+            width=int(width),
+            height=int(height),
+            factor=preset['factor'],
+            quality=int(preset['quality']),
+            upscale=bool(preset['upscale']),
+            output_format=match.group('format'),
+            preset=name
+        )
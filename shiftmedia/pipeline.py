@@ -0,0 +1,337 @@
+import queue, threading
+from contextlib import ExitStack
+from shiftmedia import metrics
+from shiftmedia import exceptions as x
+from shiftmedia.paths import ResizeMode
+from shiftmedia.resizer import Resizer
+
+
+class Task:
+    """
+    Task
+    A job travelling through pipeline stages, along with everything the
+    stages hand over to each other: parsed variants, scratch directory,
+    local or decoded original, rendered variants (and requested names to
+    store canonical ones under, if storage stores aliases) and held
+    variant locks.
+    """
+
+    def __init__(self, job, callback=None):
+        """
+        Task constructor
+        :param job: shiftmedia.jobs.Job
+        :param callback: callable - called with job and error when done
+        """
+        self.job = job
+        self.callback = callback
+        self.id = None
+        self.params = []
+        self.canonical = False
+        self.scratch = None
+        self.src = None
+        self.outputs = []
+        self.aliases = []
+        self.locks = ExitStack()
+        self.error = None
+
+    def __repr__(self):
+        return '<Task {}>'.format(self.job)
+
+
+class Pipeline:
+    """
+    Pipeline
+    Processes batch jobs in three overlapping stages, each with its own
+    pool of threads: fetch retrieves originals, compute decodes and
+    renders them and store puts rendered variants back to storage. This
+    keeps the network busy while images are rendered and vice versa.
+
+    Stages are connected with bounded queues, so originals of queued jobs
+    are prefetched only so far ahead of rendering, and uploads carry on
+    in background only so far behind it. Once a slow stage fills the
+    queue in front of it, stages before it block, and eventually so does
+    submitting new jobs.
+
+    Jobs are processed the same way as Storage.process_job does, except
+    that resize jobs are not coalesced with concurrent requests.
+    """
+
+    STAGES = ('fetch', 'compute', 'store')
+
+    # tells stage threads to exit
+    STOP = object()
+
+    def __init__(
+        self,
+        storage,
+        fetchers=4,
+        computers=1,
+        storers=4,
+        depth=None
+    ):
+        """
+        Pipeline constructor
+        :param storage: shiftmedia.storage.Storage
+        :param fetchers: int - threads retrieving originals
+        :param computers: int - threads rendering variants
+        :param storers: int - threads putting variants to storage
+        :param depth: int - tasks waiting in front of each stage, twice
+                      the number of its threads by default
+        """
+        self.storage = storage
+        self.threads = dict(fetch=fetchers, compute=computers, store=storers)
+        for stage, count in self.threads.items():
+            if count < 1:
+                err = 'Pipeline needs at least one {} thread'
+                raise x.ConfigurationException(err.format(stage))
+
+        self.queues = dict()
+        for stage in self.STAGES:
+            size = depth or 2 * self.threads[stage]
+            self.queues[stage] = queue.Queue(maxsize=size)
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.closed = False
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._workers = []
+        for stage in self.STAGES:
+            for index in range(self.threads[stage]):
+                worker = threading.Thread(
+                    target=self.run,
+                    args=(stage,),
+                    name='shiftmedia-{}-{}'.format(stage, index),
+                    daemon=True
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, job, callback=None):
+        """
+        Submit
+        Puts a job into the pipeline, blocking while fetch stage is full.
+        Callback is called from a pipeline thread when the job is done,
+        with the job and an exception if it failed, or None.
+        :param job: shiftmedia.jobs.Job
+        :param callback: callable - called with job and error when done
+        :return: shiftmedia.pipeline.Task
+        """
+        if self.closed:
+            raise x.ConfigurationException('Pipeline is closed')
+        task = Task(job, callback)
+        with self._idle:
+            self.submitted += 1
+            self._pending += 1
+        self.queues['fetch'].put(task)
+        return task
+
+    def join(self, timeout=None):
+        """
+        Join
+        Waits until every submitted job is done
+        :param timeout: float - seconds to wait, None to wait forever
+        :return: bool - whether pipeline is idle
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def close(self):
+        """
+        Close
+        Lets submitted jobs finish and stops stage threads
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for stage in self.STAGES:
+            for index in range(self.threads[stage]):
+                self.queues[stage].put(self.STOP)
+            for worker in self._workers:
+                if worker.name.startswith('shiftmedia-' + stage + '-'):
+                    worker.join()
+
+    def stats(self):
+        """
+        Stats
+        Returns job counters and number of tasks waiting for every stage
+        :return: dict
+        """
+        with self._idle:
+            stats = dict(
+                submitted=self.submitted,
+                completed=self.completed,
+                failed=self.failed,
+                pending=self._pending
+            )
+        stats['queued'] = {s: q.qsize() for s, q in self.queues.items()}
+        return stats
+
+    def run(self, stage):
+        """
+        Run
+        Stage thread loop: takes tasks from stage queue, processes them and
+        hands them over to the next stage, or finishes them if they are
+        done or failed.
+        :param stage: string - stage name
+        :return: None
+        """
+        handler = getattr(self, stage)
+        inbox = self.queues[stage]
+        index = self.STAGES.index(stage)
+        outbox = None
+        if index + 1 < len(self.STAGES):
+            outbox = self.queues[self.STAGES[index + 1]]
+
+        while True:
+            task = inbox.get()
+            if task is self.STOP:
+                return
+            try:
+                done = handler(task)
+            except Exception as e:
+                task.error = e
+                done = True
+            if done or outbox is None:
+                self.finish(task)
+            else:
+                outbox.put(task)
+
+    def fetch(self, task):
+        """
+        Fetch
+        Works out variants a job needs and retrieves the original, unless
+        it is decoded in cache already
+        :param task: shiftmedia.pipeline.Task
+        :return: bool - whether task is done
+        """
+        storage = self.storage
+        job = task.job
+        if job.kind == 'resize':
+            id, filename = storage.backend.parse_url(job.payload['url'])
+            filenames = [filename]
+            task.canonical = True
+        elif job.kind == 'warmup':
+            id = job.payload['id']
+            filenames = sorted(
+                storage.paths.get_preset_filename(id, preset)
+                for preset in job.payload['presets']
+            )
+        else:
+            err = 'Job kind [' + job.kind + '] is not supported.'
+            raise x.NotImplementedError(err)
+
+        task.id = id
+        for filename in filenames:
+            params = storage.paths.parse_filename(id, filename)
+            if params.mode is not ResizeMode.AUTO:
+                err = 'Resize mode [{}] is not yet implemented.'
+                raise x.NotImplementedError(err.format(params.mode.value))
+            if task.canonical and storage.stored_as(id, filename):
+                metrics.increment(metrics.RESIZES, result='exists')
+                continue
+            task.params.append(params)
+        if not task.params:
+            return True
+
+        if storage.decoded_cache:
+            task.src = storage.decoded_cache.get(id)
+        task.scratch = storage.workspace.scratch()
+        if task.src is None:
+            task.src = storage.retrieve_original(id, task.scratch.path)
+            task.scratch.track(task.src)
+        return False
+
+    def compute(self, task):
+        """
+        Compute
+        Decodes the original and renders every variant to scratch
+        directory, holding variant locks until variants are stored
+        :param task: shiftmedia.pipeline.Task
+        :return: bool - whether task is done
+        """
+        storage = self.storage
+        id = task.id
+        size = (
+            max(params.size[0] for params in task.params),
+            max(params.size[1] for params in task.params)
+        )
+        upscale = any(params.upscale for params in task.params)
+        img, plan = storage.open_original(task.src, id, size, upscale)
+        source = plan['source'] if plan else Resizer.describe(img)
+        source_size = (source['width'], source['height'])
+        task.src = None
+
+        for params in task.params:
+            requested = params.filename
+            if task.canonical:
+                params = storage.map_canonical(id, params, source_size)
+                if params.filename != requested:
+                    storage.remember_canonical(id, requested, params.filename)
+                exists = storage.index and storage.index.exists(
+                    id,
+                    params.filename
+                )
+                if params.filename != requested and exists:
+                    metrics.increment(metrics.RESIZES, result='exists')
+                    continue
+
+            lock = storage.variant_lock(id, params.filename)
+            task.locks.enter_context(lock)
+            path = task.scratch.join(params.filename)
+            storage.render(img, path, params, cache_key=id)
+            task.scratch.track(path)
+            with open(path, 'rb') as file:
+                data = file.read()
+            task.outputs.append((path, params.filename, data))
+            if storage.store_aliases and params.filename != requested:
+                task.aliases.append((path, requested, data))
+        return not task.outputs
+
+    def store(self, task):
+        """
+        Store
+        Puts rendered variants to storage
+        :param task: shiftmedia.pipeline.Task
+        :return: bool - whether task is done
+        """
+        for path, filename, data in task.outputs:
+            self.storage.store_variant(path, task.id, filename, data)
+            if task.canonical:
+                metrics.increment(metrics.RESIZES, result='created')
+        for path, filename, data in task.aliases:
+            self.storage.store_variant(path, task.id, filename, data)
+        return True
+
+    def finish(self, task):
+        """
+        Finish
+        Releases everything a task holds and reports it done
+        :param task: shiftmedia.pipeline.Task
+        :return: None
+        """
+        try:
+            task.locks.close()
+        except Exception as e:
+            task.error = task.error or e
+        if task.scratch:
+            task.scratch.cleanup()
+        task.src = None
+        task.outputs = []
+        task.aliases = []
+
+        if task.callback:
+            try:
+                task.callback(task.job, task.error)
+            except Exception:
+                pass  # never let a callback kill stage thread
+
+        with self._idle:
+            if task.error:
+                self.failed += 1
+            else:
+                self.completed += 1
+            self._pending -= 1
+            self._idle.notify_all()
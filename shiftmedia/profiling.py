@@ -0,0 +1,294 @@
+import io, os, json, time, uuid, random, pstats, cProfile, threading
+import tracemalloc
+from contextlib import contextmanager
+from shiftmedia import exceptions as x
+
+
+class Capture:
+    """
+    Capture
+    Record of a single profiled call: its name, context (parsed
+    parameters, source dimensions etc) and, if it was sampled, profiler
+    and memory statistics.
+    """
+
+    def __init__(self, name, context=None):
+        """
+        Capture constructor
+        :param name: string - name of profiled operation
+        :param context: dict - whatever helps to reproduce the call
+        """
+        self.name = name
+        self.context = dict(context or {})
+        self.sampled = False
+        self.elapsed = None
+        self.error = None
+        self.memory = None
+        self.report = None
+
+    def annotate(self, **attrs):
+        """
+        Annotate
+        Adds attributes to capture context
+        :return: None
+        """
+        self.context.update(attrs)
+
+
+class Profiler:
+    """
+    Profiler
+    Opt-in profiling hook for expensive operations. Samples a fraction of
+    calls under cProfile (and optionally tracemalloc) and writes a report
+    for every sampled call and for every call slower than a threshold,
+    whether sampled or not. Reports are JSON files carrying everything
+    needed to replay the call offline (see replay), sampled calls also
+    get a .prof file loadable with pstats or snakeviz.
+
+    Only the outermost profiled call in a thread is captured, nested
+    calls are annotating it. Only one call at a time is sampled, as
+    running several profilers at once skews their results.
+    """
+
+    def __init__(
+        self,
+        path=os.path.join('var', 'logs', 'profiles'),
+        sample_rate=0.0,
+        threshold=1.0,
+        memory=False,
+        top=40
+    ):
+        """
+        Profiler constructor
+        :param path: string - directory to write reports to
+        :param sample_rate: float - fraction of calls to profile, 0 to 1
+        :param threshold: float - seconds, slower calls are always reported
+        :param memory: bool - trace memory allocations of sampled calls
+        :param top: int - number of functions to list in reports
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.memory = memory
+        self.top = top
+        self.reports = 0
+        self._local = threading.local()
+        self._sampling = threading.Lock()
+
+    @property
+    def current(self):
+        """ Get capture of the call being profiled in this thread """
+        return getattr(self._local, 'capture', None)
+
+    def should_sample(self):
+        """
+        Should sample
+        Decides whether next call gets profiled
+        :return: bool
+        """
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @contextmanager
+    def profile(self, name, context=None, force=False):
+        """
+        Profile
+        Context manager timing a block, profiling it if sampled and
+        writing a report if it was sampled or slow.
+        :param name: string - name of profiled operation
+        :param context: dict - whatever helps to reproduce the call
+        :param force: bool - always profile
+        :return: shiftmedia.profiling.Capture
+        """
+        if self.current is not None:
+            self.current.annotate(**(context or {}))
+            yield self.current
+            return
+
+        capture = Capture(name, context)
+        sampled = force or self.should_sample()
+        sampled = sampled and self._sampling.acquire(blocking=False)
+        capture.sampled = sampled
+        profiler = cProfile.Profile() if sampled else None
+        tracing = sampled and self.memory
+        started_tracing = False
+        if tracing:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+
+        self._local.capture = capture
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield capture
+        except Exception as e:
+            capture.error = repr(e)
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+            capture.elapsed = time.perf_counter() - start
+            self._local.capture = None
+            if tracing:
+                capture.memory = self.memory_stats()
+                if started_tracing:
+                    tracemalloc.stop()
+            if sampled:
+                self._sampling.release()
+            if sampled or capture.elapsed >= self.threshold:
+                capture.report = self.write(capture, profiler)
+
+    def memory_stats(self):
+        """
+        Memory stats
+        Returns peak traced memory and top allocation sites
+        :return: dict
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        top = snapshot.statistics('lineno')[:self.top]
+        return dict(
+            current=current,
+            peak=peak,
+            top=[str(stat) for stat in top]
+        )
+
+    def write(self, capture, profiler=None):
+        """
+        Write
+        Writes report of a captured call. Failing to write a report never
+        fails the call itself.
+        :param capture: shiftmedia.profiling.Capture
+        :param profiler: cProfile.Profile - profiler of a sampled call
+        :return: string - path to report or None
+        """
+        name = '{}-{}-{}-{}'.format(
+            time.strftime('%Y%m%d-%H%M%S'),
+            capture.name,
+            os.getpid(),
+            uuid.uuid4().hex[:8]
+        )
+        base = os.path.join(self.path, name)
+        report = dict(
+            name=capture.name,
+            time=time.time(),
+            pid=os.getpid(),
+            elapsed=capture.elapsed,
+            sampled=capture.sampled,
+            slow=capture.elapsed >= self.threshold,
+            error=capture.error,
+            context=capture.context,
+            memory=capture.memory,
+            stats=None,
+            profile=None
+        )
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            if profiler:
+                profiler.dump_stats(base + '.prof')
+                stream = io.StringIO()
+                stats = pstats.Stats(profiler, stream=stream)
+                stats.sort_stats('cumulative').print_stats(self.top)
+                report['stats'] = stream.getvalue()
+                report['profile'] = base + '.prof'
+            with open(base + '.json', 'w') as file:
+                json.dump(report, file, indent=2, default=str)
+        except OSError:
+            return None
+
+        self.reports += 1
+        return base + '.json'
+
+    def replay(self, report, storage):
+        """
+        Replay
+        Renders resize described by a report again under profiler. The
+        result goes to a scratch directory and is never stored.
+        :param report: string - path to report
+        :param storage: shiftmedia.storage.Storage
+        :return: string - path to report of the replay or None
+        """
+        from shiftmedia.resizer import Resizer
+
+        with open(report) as file:
+            context = json.load(file)['context']
+        if 'id' not in context or 'filename' not in context:
+            err = 'Report [{}] does not describe a storage resize'
+            raise x.InvalidArgumentException(err.format(report))
+
+        id = context['id']
+        filename = context['filename']
+        params = storage.paths.parse_filename(id, filename)
+        with storage.workspace.scratch() as scratch:
+            src = storage.retrieve_original(id, scratch.path)
+            replay = dict(context, replay_of=report)
+            with self.profile('replay', replay, force=True) as capture:
+                Resizer.render(src, scratch.join(filename), params)
+        return capture.report
+
+
+class NullProfile:
+    """ Context manager and capture of a call that isn't profiled """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def annotate(self, **attrs):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+# current profiler, none unless configured
+_profiler = None
+
+
+def get_profiler():
+    """
+    Get profiler
+    Returns profiler instrumented code currently reports to
+    :return: shiftmedia.profiling.Profiler or None
+    """
+    return _profiler
+
+
+def set_profiler(profiler):
+    """
+    Set profiler
+    Sets profiler for all instrumented code. Pass None to disable.
+    :param profiler: shiftmedia.profiling.Profiler
+    :return: shiftmedia.profiling.Profiler - previous profiler
+    """
+    global _profiler
+    previous = _profiler
+    _profiler = profiler
+    return previous
+
+
+def profile(name, **context):
+    """
+    Profile
+    Returns context manager profiling a block with current profiler
+    :param name: string - name of profiled operation
+    :return: context manager
+    """
+    if _profiler is None:
+        return NULL_PROFILE
+    return _profiler.profile(name, context)
+
+
+def annotate(**attrs):
+    """
+    Annotate
+    Adds attributes to context of the call being profiled in this thread
+    :return: None
+    """
+    if _profiler is not None and _profiler.current is not None:
+        _profiler.current.annotate(**attrs)
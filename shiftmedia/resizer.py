@@ -1,10 +1,12 @@
-import magic
+import os, magic
+from contextlib import contextmanager
 from PIL import Image
 from PIL import ImageSequence
 from PIL import ExifTags
 import piexif
 from math import floor
 from shiftmedia import utils
+from shiftmedia import metrics, profiling, tracing
 from pprint import pprint as pp
 
 
@@ -48,6 +50,13 @@ class Resizer:
     RESIZE_TO_FILL = 'mode_resize_to_fill'
     RESIZE_TO_FIT = 'mode_resize_to_fit'
 
+    # exif orientation tag and fixable orientations swapping width and height
+    ORIENTATION = 274
+    TRANSPOSED = (6, 8)
+
+    # output quality of quick previews
+    PREVIEW_QUALITY = 40
+
     @staticmethod
     def fix_orientation_and_save(src):
         """
@@ -124,6 +133,54 @@ class Resizer:
         # and return
         return img, exif
 
+    @staticmethod
+    def open(src, cache=None, key=None, draft=None):
+        """
+        Open
+        Opens source image and fixes its orientation. If decoded cache and
+        key are given, will return cached image when possible, or decode
+        and put the image to cache otherwise. Animated images are never
+        cached as iterating their frames changes image state. Decoding is
+        done eagerly, so that it is timed as a separate stage.
+
+        Draft size makes JPEG decoder skip detail, decoding the image at
+        1/2, 1/4 or 1/8 scale while keeping it at least as big as draft
+        size. Images decoded in draft mode are never cached.
+
+        :param src: Source file path or decoded PIL.Image object
+        :param cache: shiftmedia.cache.DecodedCache, optional decoded cache
+        :param key: Key of source image in decoded cache
+        :param draft: Target (width, height) to decode JPEG images for
+        :return: PIL.Image
+        """
+        if isinstance(src, Image.Image):
+            return src
+
+        use_cache = cache is not None and key is not None and not draft
+        if use_cache:
+            img = cache.get(key)
+            if img is not None:
+                return img
+
+        with Resizer.stage('decode') as span:
+            img = Image.open(src)
+            if draft:
+                if Resizer.orientation(img) in Resizer.TRANSPOSED:
+                    draft = (draft[1], draft[0])
+                img.draft(img.mode, tuple(draft))
+            img, exif = Resizer.fix_orientation(img)
+            img.load()
+            span.set_attributes(dict(
+                width=img.size[0],
+                height=img.size[1],
+                pixels=img.size[0] * img.size[1],
+                frames=getattr(img, 'n_frames', 1),
+                draft=bool(draft)
+            ))
+        if use_cache and not getattr(img, 'is_animated', False):
+            cache.set(key, img)
+        return img
+
     @staticmethod
     def manual_crop(
         src,
@@ -173,7 +230,10 @@ class Resizer:
         mode=None,
         upscale=False,
         format=None,
-        quality=100
+        quality=100,
+        cache=None,
+        cache_key=None,
+        resample=None
     ):
         """
         Resize auto crop
@@ -186,17 +246,59 @@ class Resizer:
         working with GIFs that are in mode=P, we have to forcefully convert
         image mode to RGBA for gif images to preserve animation.
 
-        :param src: Source file path
+        :param src: Source file path or decoded PIL.Image object
         :param dst: Destination file path
         :param size: Target size
         :param mode: Resize mode (fit/fill)
         :param upscale: Whether to enlarge src if its smaller than dst
         :param format: Target format (None to guess by extension)
         :param quality: Output quality
+        :param cache: shiftmedia.cache.DecodedCache, optional decoded cache
+        :param cache_key: Key of source image in decoded cache
+        :param resample: Resampling filter, Image.LANCZOS by default
         :return: destination image path
         """
-        img = Image.open(src)
-        img, exif = Resizer.fix_orientation(img)
+        context = dict(
+            size=size if isinstance(size, str) else '{}x{}'.format(*size),
+            mode=mode,
+            upscale=upscale,
+            format=format,
+            quality=quality
+        )
+        profile = profiling.profile('auto_crop', **context)
+        span = tracing.span('resizer.auto_crop', **context)
+        with profile as capture, span:
+            img = Resizer.open(src, cache, cache_key)
+            capture.annotate(source=Resizer.describe(img))
+            return Resizer._auto_crop(
+                img,
+                dst,
+                size,
+                mode,
+                upscale,
+                format,
+                quality,
+                resample
+            )
+
+    @staticmethod
+    def _auto_crop(
+        img,
+        dst,
+        size,
+        mode,
+        upscale,
+        format,
+        quality,
+        resample=None
+    ):
+        """
+        Resize auto crop (opened)
+        Does the actual work of auto crop on an opened image
+        :return: destination image path
+        """
+        if getattr(img, 'is_animated', False):
+            img.seek(0)  # image might be reused for several resizes
 
         animated_gif = 'duration' in img.info and img.info['duration'] > 0
         if format:
@@ -204,30 +306,244 @@ class Resizer:
 
         if not animated_gif or (animated_gif and format and format != 'GIF'):
             # resize regular image
-            if format == 'PNG' or dst.lower().endswith('.png'):
-                img = img.convert(mode='RGBA')
-            else:
-                img = img.convert(mode='RGB')
+            with Resizer.stage('crop', size=str(size)):
+                if format == 'PNG' or dst.lower().endswith('.png'):
+                    img = img.convert(mode='RGBA')
+                else:
+                    img = img.convert(mode='RGB')
+                img = Resizer.auto_crop_img(img, size, mode, upscale, resample)
 
-            img = Resizer.auto_crop_img(img, size, mode, upscale)
-            img.save(dst, format=format, quality=quality)
+            with Resizer.stage('encode', format=format) as span:
+                img.save(dst, format=format, quality=quality)
+                Resizer.record_size(span, dst)
         else:
-            # resize animated gif
-            out = img.convert(mode='RGBA')
-            out = Resizer.auto_crop_img(out, size, mode, upscale)
-            frames = []
-            for index, frame in enumerate(ImageSequence.Iterator(img)):
-                if index == 0: continue
-                frame = frame.convert(mode='RGBA')
-                frame = Resizer.auto_crop_img(frame, size, mode, upscale)
-                frames.append(frame)
-            out.save(dst, format=format, save_all=True, append_images=frames)
+            # resize animated gif, decoding frames is part of cropping
+            with Resizer.stage('crop', size=str(size)) as span:
+                out = img.convert(mode='RGBA')
+                out = Resizer.auto_crop_img(out, size, mode, upscale, resample)
+                frames = []
+                for index, frame in enumerate(ImageSequence.Iterator(img)):
+                    if index == 0: continue
+                    frame = frame.convert(mode='RGBA')
+                    frame = Resizer.auto_crop_img(
+                        frame,
+                        size,
+                        mode,
+                        upscale,
+                        resample
+                    )
+                    frames.append(frame)
+                span.set_attribute('frames', len(frames) + 1)
+
+            with Resizer.stage('encode', format=format) as span:
+                out.save(
+                    dst,
+                    format=format,
+                    save_all=True,
+                    append_images=frames
+                )
+                Resizer.record_size(span, dst)
 
         # and return
         return dst
 
     @staticmethod
-    def auto_crop_img(img, size, mode=None, upscale=False):
+    @contextmanager
+    def stage(name, **attributes):
+        """
+        Stage
+        Times a resize stage and records it as a trace span
+        :param name: string - stage name
+        :return: span
+        """
+        timer = metrics.timer(metrics.STAGE_SECONDS, stage=name)
+        with timer, tracing.span('resizer.' + name, **attributes) as span:
+            yield span
+
+    @staticmethod
+    def record_size(span, path):
+        """ Add size of written file to a recording span """
+        if span.is_recording():
+            span.set_attribute('bytes', os.path.getsize(path))
+
+    @staticmethod
+    def describe(img):
+        """
+        Describe
+        Returns dimensions and format of an image for reports
+        :param img: PIL.Image
+        :return: dict
+        """
+        return dict(
+            width=img.size[0],
+            height=img.size[1],
+            format=img.format,
+            mode=img.mode,
+            frames=getattr(img, 'n_frames', 1)
+        )
+
+    @staticmethod
+    def probe(src):
+        """
+        Probe
+        Describes an image file reading only its header. Dimensions are
+        reported as the image is displayed, i.e. after fixing orientation.
+        :param src: string or file object - image to probe
+        :return: dict or None if file is not an image
+        """
+        try:
+            with Image.open(src) as img:
+                info = Resizer.describe(img)
+                if Resizer.orientation(img) in Resizer.TRANSPOSED:
+                    info['width'], info['height'] = img.size[1], img.size[0]
+                return info
+        except OSError:
+            return None
+
+    @staticmethod
+    def orientation(img):
+        """
+        Orientation
+        Returns exif orientation of an image, 1 (normal) if unknown
+        :param img: PIL.Image
+        :return: int
+        """
+        try:
+            return img.getexif().get(Resizer.ORIENTATION, 1)
+        except Exception:
+            return 1
+
+    @staticmethod
+    def pixel_bytes(mode):
+        """
+        Pixel bytes
+        Returns bytes per pixel Pillow uses to store image of given mode.
+        Images with several bands take four bytes, whatever the depth.
+        :param mode: string - PIL image mode
+        :return: int
+        """
+        if mode in ('1', 'L', 'P'):
+            return 1
+        if mode.startswith('I;16'):
+            return 2
+        return 4
+
+    @staticmethod
+    def draft_scale(src_size, dst_size):
+        """
+        Draft scale
+        Returns scale JPEG decoder in draft mode reduces an original of
+        given size by, when asked for target size. Mirrors Pillow.
+        :param src_size: tuple - original width and height
+        :param dst_size: tuple - target width and height
+        :return: int - 1, 2, 4 or 8
+        """
+        scale = min(
+            src_size[0] // max(dst_size[0], 1),
+            src_size[1] // max(dst_size[1], 1)
+        )
+        for candidate in (8, 4, 2):
+            if scale >= candidate:
+                return candidate
+        return 1
+
+    @staticmethod
+    def estimate_memory(info, size, upscale=True, scale=1):
+        """
+        Estimate memory
+        Estimates peak memory auto crop needs, knowing only the header of
+        the original: decoded original, its converted and cropped copies
+        and resized output, every frame of it for animations. Counts pixel
+        buffers only, so actual peak is somewhat higher.
+
+        :param info: dict - original description, see probe
+        :param size: tuple - target width and height
+        :param upscale: bool - whether output may be bigger than original
+        :param scale: int - draft decoding scale
+        :return: int - bytes
+        """
+        width = -(-info['width'] // scale)
+        height = -(-info['height'] // scale)
+        pixels = width * height
+        decoded = pixels * Resizer.pixel_bytes(info['mode'])
+        copies = pixels * 4 * 2
+        output = size[0] * size[1]
+        if not upscale:
+            output = min(output, pixels)
+        frames = max(info.get('frames') or 1, 1)
+        return decoded + copies + output * 4 * frames
+
+    @staticmethod
+    def factor_to_mode(factor):
+        """
+        Factor to mode
+        Converts crop factor used in filenames to resize mode
+        :param factor: string - fit/fill
+        :return: string - resize mode
+        """
+        if factor == 'fill':
+            return Resizer.RESIZE_TO_FILL
+        return Resizer.RESIZE_TO_FIT
+
+    @staticmethod
+    def render(src, dst, params, cache=None, cache_key=None, preview=False):
+        """
+        Render
+        Renders auto crop described by parsed resize filename parameters
+        and writes it to destination.
+
+        Preview trades quality for speed: it is resized with bilinear filter
+        and encoded with low quality. Decode the source in draft mode to
+        make it faster still (see open).
+
+        :param src: Source file path or decoded PIL.Image object
+        :param dst: Destination file path
+        :param params: shiftmedia.paths.ResizeParams
+        :param cache: shiftmedia.cache.DecodedCache, optional decoded cache
+        :param cache_key: Key of source image in decoded cache
+        :param preview: bool - render a quick low quality preview
+        :return: destination image path
+        """
+        quality = params.quality
+        resample = None
+        if preview:
+            quality = min(quality, Resizer.PREVIEW_QUALITY)
+            resample = Image.BILINEAR
+        return Resizer.auto_crop(
+            src=src,
+            dst=dst,
+            size=params.size,
+            mode=Resizer.factor_to_mode(params.factor),
+            upscale=params.upscale,
+            format=params.output_format,
+            quality=quality,
+            cache=cache,
+            cache_key=cache_key,
+            resample=resample
+        )
+
+    @staticmethod
+    def upscale_matters(src_size, dst_size, mode=None):
+        """
+        Upscale matters
+        Checks whether upscale flag changes auto crop of an original of
+        given size. It doesn't when resizing to fill an original bigger than
+        target on both sides or when resizing to fit an original that is
+        bigger than target on any side.
+
+        :param src_size: tuple - original width and height
+        :param dst_size: tuple - target width and height
+        :param mode: Resize mode (fit/fill)
+        :return: bool
+        """
+        mode = mode or Resizer.RESIZE_TO_FILL
+        src, dst = src_size, dst_size
+        if mode == Resizer.RESIZE_TO_FIT:
+            return src[0] <= dst[0] and src[1] <= dst[1]
+        return not (src[0] > dst[0] and src[1] > dst[1])
+
+    @staticmethod
+    def auto_crop_img(img, size, mode=None, upscale=False, resample=None):
         """
         Auto crop and return img
         Accepts source image (file or object) and target size. May optionally
@@ -236,18 +552,24 @@ class Resizer:
         makes it reusable for gif sequence animations.
 
         :param img: Source file path or PIL.Image object
-        :param size: Target size
+        :param size: Target size, 100x200 string or (width, height) tuple
         :param mode: Resize mode (fit/fill)
         :param upscale: Whether to enlarge src if its smaller than dst
         :param write: Write to dst or return image object (for testing)
+        :param resample: Resampling filter, Image.LANCZOS by default
         :return: PIL.Image object
         """
         mode = mode or Resizer.RESIZE_TO_FILL
+        if resample is None:
+            resample = Image.LANCZOS
 
         # create image and get size
         img = img if isinstance(img, Image.Image) else Image.open(img)
         src = img.size
-        dst = [int(x) for x in size.split('x')]
+        if isinstance(size, str):
+            dst = [int(x) for x in size.split('x')]
+        else:
+            dst = [int(x) for x in size]
 
         # get src sides
         long_side = 0 if src[0] >= src[1] else 1
@@ -281,19 +603,19 @@ class Resizer:
                 new_size[closest_side] = dst[closest_side]
                 new_size[farthest_side] = floor(src[farthest_side] / ratio)
                 resize = (new_size[0], new_size[1])
-                return img.resize(resize, Image.LANCZOS)
+                return img.resize(resize, resample)
             elif one_side_smaller:
                 ratio = src[longer_side] / dst[longer_side]
                 new_size[longer_side] = dst[longer_side]
                 new_size[shorter_side] = floor(src[shorter_side] / ratio)
                 resize = (new_size[0], new_size[1])
-                return img.resize(resize, Image.LANCZOS)
+                return img.resize(resize, resample)
             elif original_bigger:
                 ratio = src[long_side] / dst[long_side]
                 new_size[long_side] = dst[long_side]
                 new_size[short_side] = floor(src[short_side] / ratio)
                 resize = (new_size[0], new_size[1])
-                return img.resize(resize, Image.LANCZOS)
+                return img.resize(resize, resample)
 
         # resize to fill, no upscale
         elif mode == Resizer.RESIZE_TO_FILL:
@@ -311,7 +633,7 @@ class Resizer:
                         new_size[0] + offset[0], new_size[1] + offset[1]
                     )
                     img = img.crop(box)
-                    return img.resize(dst, Image.LANCZOS)
+                    return img.resize(dst, resample)
 
             elif one_side_smaller:  # one crop the other
                 if not upscale:
@@ -335,33 +657,20 @@ class Resizer:
                         new_size[0] + offset[0], new_size[1] + offset[1]
                     )
                     img = img.crop(box)
-                    return img.resize(dst, Image.LANCZOS)
+                    return img.resize(dst, resample)
 
-            elif original_bigger:
-                if not upscale:
-                    ratio = src[closest_side] / dst[closest_side]
-                    new_size[closest_side] = src[closest_side]
-                    new_size[farthest_side] = floor(dst[farthest_side] * ratio)
-                    diff = src[farthest_side] - new_size[farthest_side]
-                    offset[farthest_side] = round(diff / 2)
-                    box = (
-                        offset[0], offset[1],
-                        new_size[0] + offset[0], new_size[1] + offset[1]
-                    )
-                    img = img.crop(box)
-                    return img.resize(dst, Image.LANCZOS)
-                else:
-                    ratio = dst[closest_side] / src[closest_side]
-                    new_size[closest_side] = src[closest_side]
-                    new_size[farthest_side] = floor(dst[farthest_side] / ratio)
-                    diff = src[farthest_side] - new_size[farthest_side]
-                    offset[farthest_side] = round(diff / 2)
-                    box = (
-                        offset[0], offset[1],
-                        new_size[0] + offset[0], new_size[1] + offset[1]
-                    )
-                    img = img.crop(box)
-                    return img.resize(dst, Image.LANCZOS)
+            elif original_bigger:  # upscale makes no difference
+                ratio = src[closest_side] / dst[closest_side]
+                new_size[closest_side] = src[closest_side]
+                new_size[farthest_side] = floor(dst[farthest_side] * ratio)
+                diff = src[farthest_side] - new_size[farthest_side]
+                offset[farthest_side] = round(diff / 2)
+                box = (
+                    offset[0], offset[1],
+                    new_size[0] + offset[0], new_size[1] + offset[1]
+                )
+                img = img.crop(box)
+                return img.resize(dst, resample)
 
         # error out otherwise
         else:
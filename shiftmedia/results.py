@@ -0,0 +1,129 @@
+class Result:
+    """
+    Result
+    Base for structured results of storage operations. Results are plain
+    records with fixed fields, every field not known for a particular
+    call is None.
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            err = 'Unknown result fields: {}'.format(', '.join(sorted(fields)))
+            raise TypeError(err)
+
+    def __repr__(self):
+        fields = ', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__ if name != 'data'
+        )
+        return '<{} {}>'.format(type(self).__name__, fields)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def replace(self, **changes):
+        """
+        Replace
+        Returns a copy of the result with some fields changed
+        :return: shiftmedia.results.Result
+        """
+        fields = self.to_dict()
+        fields.update(changes)
+        return type(self)(**fields)
+
+    def to_dict(self):
+        """
+        To dict
+        Returns result fields as a dictionary
+        :return: dict
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ResizeResult(Result):
+    """
+    Resize result
+    Describes how a resize was obtained: its url and filename (canonical
+    one if requested resize was mapped to it), status, source and output
+    dimensions, byte counts, estimated peak memory and draft decoding
+    scale (if memory budget is set) and durations of every stage in
+    seconds. Stats of rendering are shared by coalesced callers, so
+    durations are empty for callers joining a call that didn't ask for
+    a result while metrics are disabled.
+
+    Statuses:
+        cached - served from variant cache
+        exists - already in storage according to variant index
+        created - rendered and stored by this call
+        coalesced - rendered and stored by a concurrent call
+        preview - quick provisional preview, not stored, while the resize
+                  itself is rendered in background
+    """
+    __slots__ = (
+        'url',
+        'id',
+        'filename',
+        'requested',
+        'status',
+        'source_size',
+        'source_bytes',
+        'size',
+        'format',
+        'frames',
+        'bytes',
+        'memory',
+        'draft',
+        'durations',
+        'elapsed',
+        'data',
+    )
+
+    CACHED = 'cached'
+    EXISTS = 'exists'
+    CREATED = 'created'
+    COALESCED = 'coalesced'
+    PREVIEW = 'preview'
+
+    @property
+    def canonical(self):
+        """ Check whether requested resize was mapped to a canonical one """
+        return self.requested is not None and self.requested != self.filename
+
+    @property
+    def rendered(self):
+        """ Check whether resize was rendered to serve this call """
+        return self.status in (self.CREATED, self.COALESCED)
+
+    @property
+    def provisional(self):
+        """ Check whether result is a preview to be replaced shortly """
+        return self.status == self.PREVIEW
+
+
+class PutResult(Result):
+    """
+    Put result
+    Describes a file put to storage: its id and url, size in bytes,
+    image dimensions, format and frame count (None for files that are
+    not images), rendered presets and durations of every stage in
+    seconds. Presets rendered in background are listed, but might not
+    be done yet.
+    """
+    __slots__ = (
+        'id',
+        'url',
+        'filename',
+        'bytes',
+        'size',
+        'format',
+        'frames',
+        'presets',
+        'background',
+        'durations',
+        'elapsed',
+    )
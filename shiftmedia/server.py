@@ -0,0 +1,410 @@
+import os, re, hashlib, mimetypes
+from email.utils import formatdate
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from socketserver import ThreadingMixIn
+from shiftmedia import metrics, exceptions as x
+from shiftmedia.backend import BackendLocal
+
+
+class ResizeServer:
+    """
+    Resize server
+    WSGI application that serves storage files and renders missing resizes
+    on the fly. Request path is mapped to storage id and filename with
+    backend url parser, so the app can sit behind a 404 redirect from static
+    hosting or serve the whole storage by itself.
+
+    Since variant urls are signed and never change, responses are marked
+    immutable and their ETags are derived from the path, which allows to
+    answer conditional requests without touching storage. Single byte
+    ranges are supported, files of local backend are sent with
+    wsgi.file_wrapper (sendfile where server supports it), freshly rendered
+    resizes are sent straight from memory.
+
+    With previews on, cold resizes are answered with a quick provisional
+    preview while the resize itself is rendered in background (see
+    Storage.get_preview). Previews are cached only briefly and carry no
+    ETag, so that clients come back for the real thing.
+
+    Optionally exposes metrics collected by in-process registry in
+    Prometheus text format.
+    """
+
+    ID = re.compile(r'^[0-9a-f]+(-[0-9a-f]+){4}-[^/]+$')
+    RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(
+        self,
+        storage,
+        prefix='',
+        max_age=365 * 24 * 60 * 60,
+        metrics_path=None,
+        previews=False,
+        preview_max_age=5
+    ):
+        """
+        Resize server constructor
+        :param storage: shiftmedia.storage.Storage
+        :param prefix: string - path prefix to strip from requests
+        :param max_age: int - seconds clients and proxies may cache for
+        :param metrics_path: string - path to expose metrics at, e.g /metrics
+        :param previews: bool - answer cold resizes with quick previews
+        :param preview_max_age: int - seconds previews may be cached for
+        """
+        self.storage = storage
+        self.prefix = '/' + prefix.strip('/') if prefix.strip('/') else ''
+        self.max_age = max_age
+        self.metrics_path = metrics_path
+        self.previews = previews
+        self.preview_max_age = preview_max_age
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD'):
+            status = '405 Method Not Allowed'
+            headers = [('Allow', 'GET, HEAD')]
+            return self.error(start_response, status, headers)
+
+        path = environ.get('PATH_INFO', '')
+        if self.metrics_path and path == self.metrics_path:
+            return self.send_metrics(start_response)
+
+        target = self.parse(path)
+        if not target:
+            return self.error(start_response, '404 Not Found')
+        id, filename = target
+
+        # paths are immutable, so a matching tag is answered right away,
+        # but any tag only matches once the file is found or rendered
+        etag = self.etag(id, filename)
+        if self.not_modified(environ, etag):
+            return self.send_not_modified(start_response, etag)
+
+        # serve existing local files, originals are never rendered
+        backend = self.storage.backend
+        parts = backend.id_to_path(id)
+        if isinstance(backend, BackendLocal):
+            path = os.path.join(backend.path, *parts, filename)
+            if os.path.isfile(path):
+                if self.not_modified(environ, etag, exists=True):
+                    return self.send_not_modified(start_response, etag)
+                return self.send_file(environ, start_response, path, etag)
+        if filename == parts[5]:
+            return self.error(start_response, '404 Not Found')
+
+        url = self.url(id, filename)
+        provisional = False
+        try:
+            if self.previews:
+                resize = self.storage.get_preview(url, result=True)
+                data, provisional = resize.data, resize.provisional
+            else:
+                data = self.storage.get_resize(url)
+        except (x.InvalidArgumentException, x.NotImplementedError):
+            return self.error(start_response, '404 Not Found')
+        except (FileNotFoundError, x.LocalFileNotFound):
+            return self.error(start_response, '404 Not Found')
+        except x.MemoryBudgetExceeded:
+            return self.error(start_response, '413 Payload Too Large')
+
+        if provisional:
+            etag = None
+        if self.not_modified(environ, etag, exists=True):
+            return self.send_not_modified(start_response, etag)
+        return self.send_bytes(environ, start_response, data, filename, etag)
+
+    def parse(self, path):
+        """
+        Parse
+        Maps request path to storage id and filename, rejecting anything
+        that can't be a storage path.
+        :param path: string - request path
+        :return: tuple of id and filename or None
+        """
+        if self.prefix:
+            if not path.startswith(self.prefix + '/'):
+                return None
+            path = path[len(self.prefix):]
+
+        id, filename = self.storage.backend.parse_url(path)
+        if not self.ID.match(id) or not filename:
+            return None
+        tail = self.storage.backend.id_to_path(id)[5]
+        if tail.startswith('.') or filename.startswith('.'):
+            return None
+        return id, filename
+
+    def url(self, id, filename):
+        """
+        Url
+        Returns storage url for id and filename
+        :param id: string - storage id
+        :param filename: string - filename
+        :return: string
+        """
+        base = self.storage.backend.get_url().rstrip('/')
+        path = '/'.join(self.storage.backend.id_to_path(id))
+        return base + '/' + path + '/' + filename
+
+    @staticmethod
+    def etag(id, filename):
+        """
+        ETag
+        Returns entity tag for a storage file. Files never change once
+        created, so the tag only depends on id and filename.
+        :param id: string - storage id
+        :param filename: string - filename
+        :return: string
+        """
+        key = bytes(id + '/' + filename, 'utf-8')
+        return '"' + hashlib.blake2b(key, digest_size=12).hexdigest() + '"'
+
+    @staticmethod
+    def not_modified(environ, etag, exists=False):
+        """
+        Not modified
+        Checks If-None-Match request header against entity tag. Any tag
+        (*) only matches a file known to exist.
+        :param environ: dict - wsgi environment
+        :param etag: string - entity tag or None
+        :param exists: bool - whether file was found or rendered
+        :return: bool
+        """
+        header = environ.get('HTTP_IF_NONE_MATCH')
+        if not header:
+            return False
+        tags = [tag.strip() for tag in header.split(',')]
+        if exists and '*' in tags:
+            return True
+        if etag is None:
+            return False
+        return etag in tags or 'W/' + etag in tags
+
+    def send_not_modified(self, start_response, etag):
+        """
+        Send not modified
+        Responds to a conditional request with no body
+        :param start_response: callable - wsgi start response
+        :param etag: string - entity tag or None
+        :return: iterable
+        """
+        start_response('304 Not Modified', self.cache_headers(etag))
+        return []
+
+    def cache_headers(self, etag):
+        """
+        Cache headers
+        Returns headers allowing to cache the response forever, or only
+        briefly if there's no entity tag (provisional previews)
+        :param etag: string - entity tag or None
+        :return: list
+        """
+        if etag is None:
+            cache = 'public, max-age={}'.format(self.preview_max_age)
+            return [('Cache-Control', cache)]
+        cache = 'public, max-age={}, immutable'.format(self.max_age)
+        return [('ETag', etag), ('Cache-Control', cache)]
+
+    def range(self, environ, length):
+        """
+        Range
+        Parses Range request header. Only a single byte range is supported,
+        anything else is ignored and the full body is sent.
+        :param environ: dict - wsgi environment
+        :param length: int - body length
+        :return: tuple of start and end (inclusive), False if not
+                 satisfiable or None if no range requested
+        """
+        header = environ.get('HTTP_RANGE')
+        if not header:
+            return None
+        match = self.RANGE.match(header.strip())
+        if not match:
+            return None
+
+        start, end = match.groups()
+        if not start and not end:
+            return None
+        if not start:
+            start = max(0, length - int(end))
+            end = length - 1
+        else:
+            start = int(start)
+            end = min(int(end), length - 1) if end else length - 1
+        if start >= length or start > end:
+            return False
+        return start, end
+
+    def headers(self, filename, length, etag):
+        """
+        Headers
+        Returns common response headers
+        :param filename: string - filename to guess content type from
+        :param length: int - content length
+        :param etag: string - entity tag or None
+        :return: list
+        """
+        type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        headers = [
+            ('Content-Type', type),
+            ('Content-Length', str(length)),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        return headers + self.cache_headers(etag)
+
+    def send_bytes(self, environ, start_response, data, filename, etag):
+        """
+        Send bytes
+        Responds with bytes held in memory
+        :return: iterable
+        """
+        length = len(data)
+        byte_range = self.range(environ, length)
+        if byte_range is False:
+            return self.not_satisfiable(start_response, length)
+
+        status = '200 OK'
+        extra = []
+        if byte_range:
+            start, end = byte_range
+            data = data[start:end + 1]
+            status = '206 Partial Content'
+            extra = [self.content_range(start, end, length)]
+
+        headers = self.headers(filename, len(data), etag) + extra
+        start_response(status, headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [data]
+
+    def send_file(self, environ, start_response, path, etag):
+        """
+        Send file
+        Responds with a local file, using server file wrapper when
+        sending it whole
+        :return: iterable
+        """
+        stat = os.stat(path)
+        length = stat.st_size
+        byte_range = self.range(environ, length)
+        if byte_range is False:
+            return self.not_satisfiable(start_response, length)
+
+        status = '200 OK'
+        extra = [('Last-Modified', formatdate(stat.st_mtime, usegmt=True))]
+        start, end = 0, length - 1
+        if byte_range:
+            start, end = byte_range
+            status = '206 Partial Content'
+            extra.append(self.content_range(start, end, length))
+
+        size = end - start + 1
+        headers = self.headers(path, size, etag) + extra
+        start_response(status, headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+
+        file = open(path, 'rb')
+        if not byte_range and 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](file, self.CHUNK_SIZE)
+        file.seek(start)
+        return self.read_chunks(file, size)
+
+    def read_chunks(self, file, size):
+        """
+        Read chunks
+        Yields given number of bytes from file in chunks and closes it
+        :param file: file object
+        :param size: int - bytes to read
+        :return: generator
+        """
+        try:
+            while size > 0:
+                chunk = file.read(min(self.CHUNK_SIZE, size))
+                if not chunk:
+                    break
+                size -= len(chunk)
+                yield chunk
+        finally:
+            file.close()
+
+    @staticmethod
+    def send_metrics(start_response):
+        """
+        Send metrics
+        Responds with metrics of in-process registry if one is used
+        :return: iterable
+        """
+        sink = metrics.get_sink()
+        if not isinstance(sink, metrics.Registry):
+            return ResizeServer.error(start_response, '404 Not Found')
+        body = bytes(sink.render(), 'utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ])
+        return [body]
+
+    @staticmethod
+    def content_range(start, end, length):
+        """ Get Content-Range header """
+        value = 'bytes {}-{}/{}'.format(start, end, length)
+        return ('Content-Range', value)
+
+    def not_satisfiable(self, start_response, length):
+        """ Respond to a range request outside of body """
+        headers = [('Content-Range', 'bytes */{}'.format(length))]
+        return self.error(start_response, '416 Range Not Satisfiable', headers)
+
+    @staticmethod
+    def error(start_response, status, headers=None):
+        """ Respond with an error status """
+        body = bytes(status, 'utf-8')
+        headers = (headers or []) + [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ]
+        start_response(status, headers)
+        return [body]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+    Threading WSGI server
+    Reference server handling every request in a thread
+    """
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    """ Request handler that doesn't log every request """
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(app, host='127.0.0.1', port=8000, quiet=False):
+    """
+    Serve
+    Runs WSGI app with the standard library threading server. Good for
+    development and small setups, otherwise mount the app in a production
+    WSGI server (gunicorn, uwsgi etc).
+    :param app: callable - wsgi app
+    :param host: string - interface to bind to
+    :param port: int - port to listen on
+    :param quiet: bool - don't log requests
+    :return: None
+    """
+    handler = QuietHandler if quiet else WSGIRequestHandler
+    server = make_server(
+        host,
+        port,
+        app,
+        server_class=ThreadingWSGIServer,
+        handler_class=handler
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
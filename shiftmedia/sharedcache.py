@@ -0,0 +1,358 @@
+import os, mmap, struct, fcntl, hashlib, threading
+from contextlib import contextmanager
+from shiftmedia import exceptions as x
+
+
+class SharedVariantCache:
+    """
+    Shared variant cache
+    Cross-process cache of rendered variants backed by a memory-mapped slab
+    file, so that every worker process on a host can hit the same copy of
+    hot data. The file holds a header, a set-associative index of slots
+    keyed by storage id and variant filename, and a ring buffer of data.
+
+    Writers are serialized with a file lock (plus a thread lock within a
+    process). Forked processes reopen the slab file on first write, since
+    a lock taken on the inherited descriptor is shared with the parent.
+    Readers never lock: they check slot sequence numbers and
+    ring position after reading to detect concurrent overwrites. Once the
+    ring wraps around, oldest data is overwritten which bounds the cache
+    by its byte budget.
+    """
+
+    MAGIC = b'SMVC'
+    VERSION = 2
+
+    # readers don't lock, so 8-byte fields (ring size and head of the
+    # header, data position of slots) must be 8-byte aligned for writes
+    # to them not to be seen torn. Mapping starts at a page boundary,
+    # header is padded and slots are 48 bytes long starting at offset 64.
+    HEADER = struct.Struct('<4sII4xQQI')
+    HEADER_SIZE = 64
+    SLOT = struct.Struct('<16s8sQIII4x')
+    WAYS = 4
+    _reopen_lock = threading.Lock()
+
+    def __init__(self, path, max_bytes, slots=4096):
+        """
+        Shared variant cache constructor
+        Opens slab file at given path or creates one if necessary. All
+        processes sharing the file must use the same size settings.
+
+        :param path: string - path to slab file (ideally on tmpfs)
+        :param max_bytes: int - data ring size in bytes
+        :param slots: int - number of index slots, multiple of 4
+        """
+        if slots % self.WAYS:
+            err = 'Number of slots must be a multiple of {}'
+            raise x.ConfigurationException(err.format(self.WAYS))
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.slots = slots
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._data_offset = self.HEADER_SIZE + slots * self.SLOT.size
+        size = self._data_offset + max_bytes
+
+        dir = os.path.dirname(path)
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                self._map = mmap.mmap(self._fd, size)
+                self._write_header(0, 0)
+            else:
+                self._map = mmap.mmap(self._fd, 0)
+                magic, version, slots, data_size, head, epoch = \
+                    self.HEADER.unpack_from(self._map, 0)
+                valid = magic == self.MAGIC and version == self.VERSION
+                if not valid or (slots, data_size) != (self.slots, max_bytes):
+                    self._map.close()
+                    msg = 'Shared cache [{}] exists with different settings'
+                    raise x.ConfigurationException(msg.format(path))
+        except Exception:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            raise
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        """
+        Close
+        Unmaps slab file
+        :return: None
+        """
+        self._map.close()
+        os.close(self._fd)
+
+    def _reopen_if_forked(self):
+        """
+        Reopen if forked
+        Gives a forked process its own descriptor of the slab file and a
+        fresh thread lock. The memory map itself is shared, so it is kept.
+        :return: None
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._reopen_lock:
+            if self._pid == pid:
+                return
+            os.close(self._fd)
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._lock = threading.Lock()
+            self._pid = pid
+
+    @contextmanager
+    def write_lock(self):
+        """
+        Write lock
+        Serializes writers across threads and processes
+        """
+        self._reopen_if_forked()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def digest(id, filename=None):
+        """
+        Digest
+        Returns hash digest of an id or a variant key
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bytes
+        """
+        if filename is None:
+            return hashlib.blake2b(bytes(id, 'utf-8'), digest_size=8).digest()
+        key = bytes(id + '/' + filename, 'utf-8')
+        return hashlib.blake2b(key, digest_size=16).digest()
+
+    def _write_header(self, head, epoch):
+        """ Write header fields """
+        self.HEADER.pack_into(
+            self._map,
+            0,
+            self.MAGIC,
+            self.VERSION,
+            self.slots,
+            self.max_bytes,
+            head,
+            epoch
+        )
+
+    def _header(self):
+        """ Read head and epoch from header """
+        header = self.HEADER.unpack_from(self._map, 0)
+        return header[4], header[5]
+
+    def _slot_offset(self, index):
+        """ Get offset of slot in slab """
+        return self.HEADER_SIZE + index * self.SLOT.size
+
+    def _bucket(self, key):
+        """ Get slot indexes of a bucket for given key """
+        first = int.from_bytes(key[:8], 'little') % (self.slots // self.WAYS)
+        first *= self.WAYS
+        return range(first, first + self.WAYS)
+
+    def _is_live(self, slot, head, epoch):
+        """ Check whether slot data is neither cleared nor overwritten """
+        key, id_key, position, length, seq, slot_epoch = slot
+        if not length or seq % 2 or slot_epoch != epoch:
+            return False
+        return head <= position + self.max_bytes
+
+    def _find(self, key):
+        """
+        Find
+        Looks up live slot for a key and returns its index and fields
+        :param key: bytes - variant key digest
+        :return: tuple or None
+        """
+        head, epoch = self._header()
+        for index in self._bucket(key):
+            slot = self.SLOT.unpack_from(self._map, self._slot_offset(index))
+            if slot[0] == key and self._is_live(slot, head, epoch):
+                return index, slot
+        return None
+
+    def view(self, id, filename):
+        """
+        View
+        Returns a zero-copy memoryview of cached variant. The view is only
+        guaranteed to be intact at the moment of return: a writer can
+        overwrite it once the ring wraps around, so long-lived consumers
+        should use get() instead.
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: memoryview or None
+        """
+        key = self.digest(id, filename)
+        found = self._find(key)
+        if not found:
+            self.misses += 1
+            return None
+
+        index, slot = found
+        position, length = slot[2], slot[3]
+        start = self._data_offset + position % self.max_bytes
+        view = memoryview(self._map)[start:start + length]
+
+        # check nothing changed while we were looking
+        if not self._still_valid(index, slot):
+            view.release()
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return view
+
+    def get(self, id, filename):
+        """
+        Get
+        Returns a copy of cached variant bytes
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bytes or None
+        """
+        key = self.digest(id, filename)
+        found = self._find(key)
+        if not found:
+            self.misses += 1
+            return None
+
+        index, slot = found
+        position, length = slot[2], slot[3]
+        start = self._data_offset + position % self.max_bytes
+        data = self._map[start:start + length]
+        if not self._still_valid(index, slot):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    def _still_valid(self, index, slot):
+        """ Check slot was not rewritten or overwritten since it was read """
+        current = self.SLOT.unpack_from(self._map, self._slot_offset(index))
+        head, epoch = self._header()
+        return current == slot and self._is_live(current, head, epoch)
+
+    def set(self, id, filename, data):
+        """
+        Set
+        Writes variant bytes to the ring and publishes them in the index.
+        Variants larger than the ring are not cached.
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :param data: bytes - encoded variant
+        :return: bool - whether variant was cached
+        """
+        length = len(data)
+        if not length or length > self.max_bytes:
+            return False
+
+        key = self.digest(id, filename)
+        id_key = self.digest(id)
+        with self.write_lock():
+            head, epoch = self._header()
+
+            # skip to ring start if data doesn't fit before the end
+            position = head
+            if position % self.max_bytes + length > self.max_bytes:
+                position += self.max_bytes - position % self.max_bytes
+
+            # publish new head first so readers notice overwrites
+            self._write_header(position + length, epoch)
+            head = position + length
+
+            # pick a slot: same key, then free, then oldest
+            victim = None
+            for index in self._bucket(key):
+                offset = self._slot_offset(index)
+                slot = self.SLOT.unpack_from(self._map, offset)
+                if slot[0] == key or not self._is_live(slot, head, epoch):
+                    victim = (index, slot)
+                    break
+                if victim is None or slot[2] < victim[1][2]:
+                    victim = (index, slot)
+
+            index, slot = victim
+            offset = self._slot_offset(index)
+            seq = (slot[4] + 1 + slot[4] % 2) % 2 ** 32
+            self.SLOT.pack_into(self._map, offset, key, id_key, 0, 0, seq, 0)
+
+            start = self._data_offset + position % self.max_bytes
+            self._map[start:start + length] = data
+            self.SLOT.pack_into(
+                self._map,
+                offset,
+                key,
+                id_key,
+                position,
+                length,
+                seq + 1,
+                epoch
+            )
+        return True
+
+    def invalidate(self, id, filename=None):
+        """
+        Invalidate
+        Removes a single variant or all variants of given id from cache
+        :param id: string - storage id
+        :param filename: string - variant filename, None for all variants
+        :return: None
+        """
+        if filename is not None:
+            key = self.digest(id, filename)
+            indexes = self._bucket(key)
+        else:
+            key = None
+            indexes = range(self.slots)
+
+        id_key = self.digest(id)
+        with self.write_lock():
+            for index in indexes:
+                offset = self._slot_offset(index)
+                slot = self.SLOT.unpack_from(self._map, offset)
+                if slot[1] != id_key or (key and slot[0] != key):
+                    continue
+                seq = (slot[4] + 2) % 2 ** 32
+                empty = (slot[0], slot[1], 0, 0, seq, 0)
+                self.SLOT.pack_into(self._map, offset, *empty)
+
+    def clear(self):
+        """
+        Clear
+        Invalidates everything in cache by advancing epoch
+        :return: None
+        """
+        with self.write_lock():
+            head, epoch = self._header()
+            self._write_header(head, (epoch + 1) % 2 ** 32)
+
+    def stats(self):
+        """
+        Stats
+        Returns per-process hit counters and shared ring usage
+        :return: dict
+        """
+        head, epoch = self._header()
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            written_bytes=head,
+            max_bytes=self.max_bytes,
+            slots=self.slots,
+        )
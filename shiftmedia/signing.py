@@ -0,0 +1,262 @@
+import hmac, hashlib
+from abc import ABCMeta, abstractmethod
+from shiftmedia import exceptions as x
+
+
+class Signer(metaclass=ABCMeta):
+    """
+    Abstract signer
+    Signs resize filenames to prevent brute force attacks against resizing
+    service. Signatures are hex strings that never contain dashes or dots.
+    """
+
+    @abstractmethod
+    def sign(self, id, filename):
+        """
+        Sign
+        Generates signature for a filename under storage id
+        :param id: string - storage id
+        :param filename: string - unsigned filename
+        :return: string - signature
+        """
+        pass
+
+    def sign_many(self, id, filenames):
+        """
+        Sign many
+        Generates signatures for a number of filenames under the same id.
+        Override to reuse work done for the id.
+        :param id: string - storage id
+        :param filenames: list - unsigned filenames
+        :return: list - signatures
+        """
+        return [self.sign(id, filename) for filename in filenames]
+
+    @abstractmethod
+    def verify(self, id, filename, signature):
+        """
+        Verify
+        Checks signature of a filename in constant time
+        :param id: string - storage id
+        :param filename: string - unsigned filename
+        :param signature: string - signature to check
+        :return: bool
+        """
+        pass
+
+
+class Md5Signer(Signer):
+    """
+    MD5 signer
+    Legacy signer producing md5(id + filename + secret) signatures. This is
+    the default, so that urls generated by previous versions stay valid.
+    """
+
+    def __init__(self, secret_key):
+        """
+        MD5 signer constructor
+        :param secret_key: string - secret key from config
+        """
+        self.secret_key = secret_key
+        self.length = 32
+
+    def _seed(self, id):
+        """ Get hash state fed with storage id """
+        return hashlib.md5(bytes(id, 'utf-8'))
+
+    def sign(self, id, filename):
+        """
+        Sign
+        Generates signature for a filename under storage id
+        :param id: string - storage id
+        :param filename: string - unsigned filename
+        :return: string - signature
+        """
+        signature = self._seed(id)
+        signature.update(bytes(filename + self.secret_key, 'utf-8'))
+        return signature.hexdigest()
+
+    def sign_many(self, id, filenames):
+        """
+        Sign many
+        Feeds storage id to hash once and copies its state per filename
+        :param id: string - storage id
+        :param filenames: list - unsigned filenames
+        :return: list - signatures
+        """
+        seed = self._seed(id)
+        signatures = []
+        for filename in filenames:
+            signature = seed.copy()
+            signature.update(bytes(filename + self.secret_key, 'utf-8'))
+            signatures.append(signature.hexdigest())
+        return signatures
+
+    def verify(self, id, filename, signature):
+        """
+        Verify
+        Checks signature of a filename in constant time
+        :param id: string - storage id
+        :param filename: string - unsigned filename
+        :param signature: string - signature to check
+        :return: bool
+        """
+        if len(signature) != self.length:
+            return False
+        return hmac.compare_digest(signature, self.sign(id, filename))
+
+
+class KeyedSigner(Signer):
+    """
+    Keyed signer
+    Base for signers built on keyed hashes. Hash state for every key is
+    prepared once and copied for every signature. The first key is used
+    to sign, all keys are accepted when verifying, which allows to rotate
+    keys: add a new key first, keep old ones until their urls expire.
+    Signatures can be truncated to make urls shorter.
+    """
+
+    def __init__(self, keys, length=None):
+        """
+        Keyed signer constructor
+        :param keys: string or list - secret key(s), first one signs
+        :param length: int - signature length in hex chars, None for full
+        """
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+        if not keys:
+            raise x.ConfigurationException('At least one key is required')
+
+        keys = [bytes(k, 'utf-8') if isinstance(k, str) else k for k in keys]
+        self.states = [self.prepare(key) for key in keys]
+        full = self.states[0].digest_size * 2
+        if length is None:
+            length = full
+        if not 16 <= length <= full:
+            err = 'Signature length must be between 16 and {} characters'
+            raise x.ConfigurationException(err.format(full))
+        self.length = length
+
+    @abstractmethod
+    def prepare(self, key):
+        """
+        Prepare
+        Returns keyed hash object to be copied for every signature
+        :param key: bytes - secret key
+        :return: hash object
+        """
+        pass
+
+    @staticmethod
+    def message(id, filename):
+        """ Get bytes to sign, separator keeps id and filename apart """
+        return bytes(id + '\0' + filename, 'utf-8')
+
+    def _sign(self, state, id, filename):
+        """ Sign with given key state """
+        signature = state.copy()
+        signature.update(self.message(id, filename))
+        return signature.hexdigest()[:self.length]
+
+    def sign(self, id, filename):
+        """
+        Sign
+        Generates signature for a filename under storage id with first key
+        :param id: string - storage id
+        :param filename: string - unsigned filename
+        :return: string - signature
+        """
+        return self._sign(self.states[0], id, filename)
+
+    def sign_many(self, id, filenames):
+        """
+        Sign many
+        Feeds storage id to hash once and copies its state per filename
+        :param id: string - storage id
+        :param filenames: list - unsigned filenames
+        :return: list - signatures
+        """
+        seed = self.states[0].copy()
+        seed.update(bytes(id + '\0', 'utf-8'))
+        signatures = []
+        for filename in filenames:
+            signature = seed.copy()
+            signature.update(bytes(filename, 'utf-8'))
+            signatures.append(signature.hexdigest()[:self.length])
+        return signatures
+
+    def verify(self, id, filename, signature):
+        """
+        Verify
+        Checks signature against every key in constant time. Signatures
+        of wrong length are rejected without hashing.
+        :param id: string - storage id
+        :param filename: string - unsigned filename
+        :param signature: string - signature to check
+        :return: bool
+        """
+        if len(signature) != self.length:
+            return False
+        valid = False
+        for state in self.states:
+            expected = self._sign(state, id, filename)
+            valid |= hmac.compare_digest(signature, expected)
+        return valid
+
+
+class HmacSigner(KeyedSigner):
+    """
+    HMAC signer
+    Signs with HMAC, SHA-256 by default
+    """
+
+    def __init__(self, keys, length=None, digest=hashlib.sha256):
+        """
+        HMAC signer constructor
+        :param keys: string or list - secret key(s), first one signs
+        :param length: int - signature length in hex chars, None for full
+        :param digest: callable - hashlib constructor
+        """
+        self.digest = digest
+        super().__init__(keys, length)
+
+    def prepare(self, key):
+        """
+        Prepare
+        Returns HMAC object with inner and outer pads already hashed
+        :param key: bytes - secret key
+        :return: hmac.HMAC
+        """
+        return hmac.new(key, digestmod=self.digest)
+
+
+class Blake2Signer(KeyedSigner):
+    """
+    BLAKE2 signer
+    Signs with BLAKE2b in keyed mode, which is faster than HMAC as it
+    needs a single hash pass.
+    """
+
+    def __init__(self, keys, length=None, digest_size=32):
+        """
+        BLAKE2 signer constructor
+        :param keys: string or list - secret key(s) up to 64 bytes
+        :param length: int - signature length in hex chars, None for full
+        :param digest_size: int - digest size in bytes
+        """
+        self.digest_size = digest_size
+        super().__init__(keys, length)
+
+    def prepare(self, key):
+        """
+        Prepare
+        Returns BLAKE2b object with key block already hashed
+        :param key: bytes - secret key
+        :return: hashlib.blake2b
+        """
+        if len(key) > hashlib.blake2b.MAX_KEY_SIZE:
+            err = 'BLAKE2 key must be at most {} bytes'
+            raise x.ConfigurationException(
+                err.format(hashlib.blake2b.MAX_KEY_SIZE)
+            )
+        return hashlib.blake2b(key=key, digest_size=self.digest_size)
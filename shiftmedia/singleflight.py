@@ -0,0 +1,123 @@
+import threading
+
+
+class Flight:
+    """
+    Flight
+    Represents a single in-progress call that concurrent callers asking
+    for the same key can wait on to share its outcome.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Single flight
+    Coalesces concurrent calls keyed by the same value so that only one
+    caller (the leader) does the actual work, while the rest wait for and
+    share its result or exception. Once the call completes the key is
+    forgotten, so subsequent calls will run the work again.
+    """
+
+    def __init__(self):
+        """
+        Single flight constructor
+        Initializes an empty in-flight registry and counters.
+        """
+        self._lock = threading.Lock()
+        self._flights = dict()
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Do
+        Runs the callable under given key unless a call with the same key is
+        already in flight, in which case waits for it and returns its result
+        (or re-raises its exception).
+
+        :param key: hashable - deduplication key
+        :param fn: callable - work to perform
+        :param args: positional args to be passed to callable
+        :param kwargs: keyword args to be passed to callable
+        :return: whatever callable returns
+        """
+        return self.call(key, fn, *args, **kwargs)[0]
+
+    def call(self, key, fn, *args, **kwargs):
+        """
+        Call
+        Same as do, but also tells whether the result was shared by a
+        concurrent call rather than computed by this one.
+
+        :param key: hashable - deduplication key
+        :param fn: callable - work to perform
+        :param args: positional args to be passed to callable
+        :param kwargs: keyword args to be passed to callable
+        :return: tuple - whatever callable returns and whether it was shared
+        """
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self._flights[key] = flight
+                self.executions += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn(*args, **kwargs)
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.result, False
+
+    def in_flight(self, key=None):
+        """
+        In flight
+        Returns number of calls currently in progress, or whether a call
+        with given key is in progress.
+        :param key: hashable - optional key to check
+        :return: int or bool
+        """
+        with self._lock:
+            if key is None:
+                return len(self._flights)
+            return key in self._flights
+
+    def stats(self):
+        """
+        Stats
+        Returns counters of how many calls were made, how many of them
+        actually executed and how many duplicate computations were avoided,
+        along with calls in progress and callers waiting for them.
+        :return: dict
+        """
+        with self._lock:
+            flights = self._flights.values()
+            return dict(
+                calls=self.calls,
+                executions=self.executions,
+                coalesced=self.coalesced,
+                in_flight=len(self._flights),
+                waiting=sum(flight.waiters for flight in flights),
+            )
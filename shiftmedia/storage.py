@@ -1,21 +1,98 @@
-import os
+import io, os, time, functools, threading
+from collections import OrderedDict
 from pathlib import Path
-from shiftmedia import utils, exceptions as x
-from shiftmedia.paths import PathBuilder
+from contextlib import contextmanager
+from concurrent import futures
+from shiftmedia import utils, metrics, profiling, tracing
+from shiftmedia import exceptions as x
+from shiftmedia.paths import PathBuilder, ParsedId, ResizeMode
 from shiftmedia.resizer import Resizer
+from shiftmedia.results import ResizeResult, PutResult
+from shiftmedia.singleflight import SingleFlight
+from shiftmedia.workspace import Workspace
 
 
 class Storage:
-    def __init__(self, backend, secret_key, local_temp):
+
+    # number of parsed ids to remember for building urls
+    ID_CACHE_SIZE = 4096
+
+    # number of requested to canonical resize mappings to remember
+    CANONICAL_CACHE_SIZE = 4096
+
+    def __init__(
+        self,
+        backend,
+        secret_key,
+        local_temp,
+        locks=None,
+        lock_timeout=None,
+        originals_cache=None,
+        decoded_cache=None,
+        variant_cache=None,
+        shared_cache=None,
+        index=None,
+        background_workers=2,
+        queue=None,
+        workspace=None,
+        signer=None,
+        strict_presets=False,
+        ladder=None,
+        memory_budget=None,
+        write_behind=None,
+        store_aliases=False
+    ):
         """
         Init
         :param backend:, shiftmedia.backend.Backend instance
         :param secret_key: string, random salt
         :param local_temp: string, path to local temp directory
+        :param locks: shiftmedia.locks.LockManager, cross-process locks
+        :param lock_timeout: float, seconds to wait for a variant lock
+        :param originals_cache: shiftmedia.cache.OriginalsCache, disk cache
+        :param decoded_cache: shiftmedia.cache.DecodedCache, memory cache
+        :param variant_cache: shiftmedia.cache.VariantCache, memory cache
+        :param shared_cache: shiftmedia.sharedcache.SharedVariantCache
+        :param index: shiftmedia.index.VariantIndex, variant existence index
+        :param background_workers: int, threads for background rendering
+        :param queue: shiftmedia.jobs.JobQueue, queue to offload work to
+        :param workspace: shiftmedia.workspace.Workspace, local scratch space
+        :param signer: shiftmedia.signing.Signer, filename signer
+        :param strict_presets: bool, only create resizes of named presets
+        :param ladder: shiftmedia.ladder.SizeLadder, allowed auto crop sizes
+        :param memory_budget: shiftmedia.budget.MemoryBudget, memory cap
+        :param write_behind: shiftmedia.writebehind.WriteBehind, uploads
+                             variants asynchronously
+        :param store_aliases: bool, store resizes mapped to canonical ones
+                              under requested filename as well
         """
         self.backend = backend
-        self.paths = PathBuilder(secret_key)
+        self.paths = PathBuilder(secret_key, signer, strict_presets, ladder)
         self._tmp_path = local_temp
+        self._tmp_ready = False
+        self._workspace = workspace
+        self._workspace_lock = threading.Lock()
+        self.parse_id = functools.lru_cache(self.ID_CACHE_SIZE)(self._parse_id)
+        self.flights = SingleFlight()
+        self.locks = locks
+        self.lock_timeout = lock_timeout
+        self.originals_cache = originals_cache
+        self.decoded_cache = decoded_cache
+        self.variant_cache = variant_cache
+        self.shared_cache = shared_cache
+        self.index = index
+        self.background_workers = background_workers
+        self.queue = queue
+        self.memory_budget = memory_budget
+        self.write_behind = write_behind
+        self.store_aliases = store_aliases
+        self._executor = None
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._previews = dict()
+        self._previews_lock = threading.Lock()
+        self._canonical = OrderedDict()
+        self._canonical_lock = threading.Lock()
 
     @property
     def tmp(self):
@@ -23,15 +100,131 @@ class Storage:
         Get temp path
         Returns path to local temp and creates one if necessary
         """
-        if not os.path.exists(self._tmp_path):
-            os.makedirs(self._tmp_path)
+        if not self._tmp_ready:
+            os.makedirs(self._tmp_path, exist_ok=True)
+            self._tmp_ready = True
         return self._tmp_path
 
-    def put(self, src, delete_local=True, fix_orientation=False):
+    @property
+    def workspace(self):
+        """
+        Get workspace
+        Returns local scratch workspace, creating one in local temp if
+        none was configured. Stale scratches are swept upon creation.
+        """
+        if not self._workspace:
+            with self._workspace_lock:
+                if not self._workspace:
+                    self._workspace = Workspace(self.tmp)
+        return self._workspace
+
+    def _parse_id(self, id):
+        """
+        Parse id
+        Splits storage id into path parts and url prefix. Available as
+        parse_id() that remembers recently parsed ids.
+        :param id: string - storage id
+        :return: shiftmedia.paths.ParsedId
+        """
+        base = self.backend.get_url().rstrip('/')
+        return ParsedId(id, self.backend.id_to_path(id), base)
+
+    @contextmanager
+    def variant_lock(self, id, filename):
+        """
+        Variant lock
+        Serializes work on a variant across processes if lock manager was
+        configured, otherwise does nothing.
+        :param id: string - storage id
+        :param filename: string - variant filename
+        """
+        if not self.locks:
+            yield None
+            return
+
+        key = id + '/' + filename
+        with self.locks.lock(key, self.lock_timeout) as lock:
+            yield lock
+
+    @tracing.traced('storage.put')
+    def put(
+        self,
+        src,
+        delete_local=True,
+        fix_orientation=False,
+        presets=None,
+        background=False,
+        result=False
+    ):
         """
         Put local file to storage
         Generates a uuid for the file, tells backend to accept
         it by that id and removes original on success.
+
+        Optionally renders a list of named presets from the local original
+        before it gets removed, so that these variants exist before anyone
+        requests them. Rendering can be done in background, in which case
+        the original will be removed once done.
+
+        :param src: string - path to local file
+        :param delete_local: bool - remove local file when done
+        :param fix_orientation: bool - fix image orientation before put
+        :param presets: list - names of presets to render
+        :param background: bool - render presets in background
+        :param result: bool - return shiftmedia.results.PutResult
+        :return: string - storage id
+        """
+        if not result:
+            return self._put(
+                src,
+                delete_local,
+                fix_orientation,
+                presets,
+                background
+            )
+
+        info = dict()
+        with metrics.collect() as collector:
+            start = time.perf_counter()
+            id = self._put(
+                src,
+                delete_local,
+                fix_orientation,
+                presets,
+                background,
+                info
+            )
+            elapsed = time.perf_counter() - start
+
+        source = info['source'] or {}
+        return PutResult(
+            id=id,
+            url=self.get_original_url(id),
+            filename=info['filename'],
+            bytes=info['bytes'],
+            size=(source['width'], source['height']) if source else None,
+            format=source.get('format'),
+            frames=source.get('frames'),
+            presets=info['presets'],
+            background=bool(presets and background),
+            durations=collector.durations,
+            elapsed=elapsed
+        )
+
+    def _put(
+        self,
+        src,
+        delete_local=True,
+        fix_orientation=False,
+        presets=None,
+        background=False,
+        info=None
+    ):
+        """
+        Put (without result)
+        Does the actual work of putting local file to storage, optionally
+        describing the put file into info dictionary
+        :return: string - storage id
         """
         if not os.path.exists(src):
             msg = 'Unable to find local file [{}]'
@@ -43,34 +236,297 @@ class Storage:
         extension = utils.normalize_extension(extension)
         filename = name + '.' + extension
         id = utils.generate_id(filename)
+        if tracing.enabled():
+            tracing.set_attributes(id=id, bytes=os.path.getsize(src))
 
         # fix image orientation before accepting
         if fix_orientation:
             Resizer.fix_orientation_and_save(src)
+        if info is not None:
+            info['filename'] = filename.lower()
+            info['bytes'] = os.path.getsize(src)
+            info['source'] = Resizer.probe(src)
+            info['presets'] = None
+
+        # fresh id is known to be empty, skip existence check
+        force = False
+        if self.index:
+            self.index.mark_new(id)
+            force = True
+
+        with metrics.timer(metrics.STAGE_SECONDS, stage='upload'):
+            self.backend.put_variant(src, id, filename.lower(), force=force)
+        if self.index:
+            self.index.add(id, filename.lower())
+
+        if presets and info is not None:
+            info['presets'] = [
+                self.paths.get_preset_filename(id, name) for name in presets
+            ]
 
-        self.backend.put_variant(src, id, filename.lower())
+        if presets and background:
+            self.run_in_background(
+                self.render_presets,
+                src,
+                id,
+                presets,
+                delete_local
+            )
+            return id
+
+        if presets:
+            self.render_presets(src, id, presets)
         if delete_local:
             os.remove(src)
         return id
 
+    def add_preset(self, name, *args, **kwargs):
+        """
+        Add preset
+        Registers named set of auto crop parameters with path builder
+        :param name: string - preset name
+        :param args: positional args to be passed to path builder
+        :param kwargs: keyword args to be passed to path builder
+        :return: None
+        """
+        self.paths.add_preset(name, *args, **kwargs)
+
+    def get_preset_url(self, id, name):
+        """
+        Get preset URL
+        Combines backend base url, path to object id and preset filename.
+        :param id: string - storage id
+        :param name: string - preset name
+        :return: string - full object url
+        """
+        filename = self.paths.get_preset_filename(id, name)
+        return self.parse_id(id).prefix + filename
+
+    def render_presets(self, src, id, presets, delete_local=False):
+        """
+        Render presets
+        Decodes local original once and renders every given preset from
+        it, putting results to storage.
+        :param src: string - path to local original
+        :param id: string - storage id
+        :param presets: list - names of presets to render
+        :param delete_local: bool - remove local original when done
+        :return: list - rendered variant filenames
+        """
+        filenames = [self.paths.get_preset_filename(id, p) for p in presets]
+        try:
+            with self.workspace.scratch() as scratch:
+                parsed = [self.paths.parse_filename(id, f) for f in filenames]
+                size = (
+                    max(params.size[0] for params in parsed),
+                    max(params.size[1] for params in parsed)
+                )
+                upscale = any(params.upscale for params in parsed)
+                img, plan = self.open_original(src, id, size, upscale)
+                for filename, params in zip(filenames, parsed):
+                    dst = scratch.join(filename)
+                    with self.variant_lock(id, filename):
+                        self.render(img, dst, params)
+                        scratch.track(dst)
+                        self.store_variant(dst, id, filename)
+        finally:
+            if delete_local:
+                os.remove(src)
+        return filenames
+
+    def warmup(self, id, presets):
+        """
+        Warmup
+        Retrieves original of a stored file and renders given presets
+        :param id: string - storage id
+        :param presets: list - names of presets to render
+        :return: list - rendered variant filenames
+        """
+        with self.workspace.scratch() as scratch:
+            local_original = self.retrieve_original(id, scratch.path)
+            scratch.track(local_original)
+            return self.render_presets(local_original, id, presets)
+
+    def enqueue_resize(self, url):
+        """
+        Enqueue resize
+        Puts resize job to the queue to be processed by workers
+        :param url: string - url of resize to be created
+        :return: job id
+        """
+        if not self.queue:
+            raise x.ConfigurationException('Job queue is not configured')
+        return self.queue.put('resize', dict(url=url))
+
+    def enqueue_warmup(self, id, presets):
+        """
+        Enqueue warmup
+        Puts job to render presets of a stored file to the queue
+        :param id: string - storage id
+        :param presets: list - names of presets to render
+        :return: job id
+        """
+        if not self.queue:
+            raise x.ConfigurationException('Job queue is not configured')
+        return self.queue.put('warmup', dict(id=id, presets=list(presets)))
+
+    def process_job(self, job):
+        """
+        Process job
+        Performs work described by a job reserved from the queue
+        :param job: shiftmedia.jobs.Job
+        :return: None
+        """
+        if job.kind == 'resize':
+            self.create_resize(job.payload['url'])
+        elif job.kind == 'warmup':
+            self.warmup(job.payload['id'], job.payload['presets'])
+        else:
+            err = 'Job kind [' + job.kind + '] is not supported.'
+            raise x.NotImplementedError(err)
+
+    def run_in_background(self, fn, *args, **kwargs):
+        """
+        Run in background
+        Submits work to background thread pool
+        :param fn: callable - work to perform
+        :return: concurrent.futures.Future
+        """
+        with self._pending_lock:
+            if not self._executor:
+                self._executor = futures.ThreadPoolExecutor(
+                    max_workers=self.background_workers,
+                    thread_name_prefix='shiftmedia'
+                )
+            future = self._executor.submit(fn, *args, **kwargs)
+            self._pending.add(future)
+        future.add_done_callback(self._background_done)
+        return future
+
+    def _background_done(self, future):
+        """ Forget finished background work """
+        with self._pending_lock:
+            self._pending.discard(future)
+
+    def wait(self, timeout=None):
+        """
+        Wait
+        Waits for background work and write-behind uploads to finish and
+        re-raises the first error that happened in background, if any.
+        :param timeout: float - seconds to wait, None to wait forever
+        :return: None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._pending_lock:
+            pending = list(self._pending)
+        done, not_done = futures.wait(pending, timeout=timeout)
+        if self.write_behind:
+            self.write_behind.flush(self._remaining(deadline))
+        for future in done:
+            if future.exception():
+                raise future.exception()
+
+    def close(self, timeout=None):
+        """
+        Close
+        Waits for background work and closes write-behind, spilling
+        uploads that didn't finish within timeout to disk
+        :param timeout: float - seconds to wait, None to wait forever
+        :return: None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self.wait(timeout)
+        finally:
+            if self.write_behind:
+                self.write_behind.close(self._remaining(deadline))
+
+    @staticmethod
+    def _remaining(deadline):
+        """ Get seconds left until deadline, None for no deadline """
+        if deadline is None:
+            return None
+        return max(0, deadline - time.monotonic())
+
+    def variant_stored(self, id, filename):
+        """
+        Variant stored
+        Records variant put to storage in existence index
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: None
+        """
+        if self.index:
+            self.index.add(id, filename)
+
     def delete(self, id):
         """
         Delete
         Removes file and all its artifacts from storage by id
         """
+        if self.write_behind:
+            self.write_behind.discard(id)
+        with self._previews_lock:
+            for key in [key for key in self._previews if key[0] == id]:
+                del self._previews[key]
+        if self.originals_cache:
+            self.originals_cache.invalidate(id)
+        if self.decoded_cache:
+            self.decoded_cache.invalidate(id)
+        if self.variant_cache:
+            self.variant_cache.invalidate(id)
+        if self.shared_cache:
+            self.shared_cache.invalidate(id)
+        if self.index:
+            self.index.invalidate(id)
         return self.backend.delete(id)
 
+    def clear_variants(self):
+        """
+        Clear variants
+        Removes all files that are not originals from storage and caches,
+        dropping pending uploads and previews too
+        :return: Bool
+        """
+        if self.write_behind:
+            self.write_behind.discard()
+        with self._previews_lock:
+            self._previews.clear()
+        if self.variant_cache:
+            self.variant_cache.clear()
+        if self.shared_cache:
+            self.shared_cache.clear()
+        result = self.backend.clear_variants()
+        if self.index:
+            self.index.clear_variants()
+        return result
+
+    def retrieve_original(self, id, local_path):
+        """
+        Retrieve original
+        Downloads original to local path going through originals cache
+        if one was configured.
+        :param id: string - storage id
+        :param local_path: string - local path to download to
+        :return: string - path to local original
+        """
+        with metrics.timer(metrics.STAGE_SECONDS, stage='retrieve'):
+            if not self.originals_cache:
+                return self.backend.retrieve_original(id, local_path)
+            return self.originals_cache.retrieve_original(
+                self.backend,
+                id,
+                local_path
+            )
+
     def get_original_url(self, id):
         """
         Get original URL
         Combines backend base url, path to object id and original filename.
         :return: string - full object url
         """
-        base = self.backend.get_url().rstrip('/')
-        parts = self.backend.id_to_path(id)
-        filename = parts[5]
-        path = '/'.join(parts)
-        return base + '/' + path + '/' + filename
+        parsed = self.parse_id(id)
+        return parsed.prefix + parsed.original
 
     def get_auto_crop_url(self, *args, **kwargs):
         """
@@ -81,11 +537,117 @@ class Storage:
         :return: string - full object url
         """
         id = kwargs['id'] if 'id' in kwargs else args[0]
-        base = self.backend.get_url().rstrip('/')
-        parts = self.backend.id_to_path(id)
-        path = '/'.join(parts)
         filename = self.paths.get_auto_crop_filename(*args, **kwargs)
-        return base + '/' + path + '/' + filename
+        return self.parse_id(id).prefix + filename
+
+    def get_auto_crop_urls(
+        self,
+        id,
+        sizes,
+        factor,
+        output_format=None,
+        upscale=True,
+        quality=65
+    ):
+        """
+        Get auto crop URLs
+        Bulk version of auto crop url for a number of sizes of the same id
+        sharing the rest of parameters.
+        :param id: string - storage id
+        :param sizes: list - of width x height strings
+        :param factor: string - crop factor, fit/fill
+        :param output_format: string - output format
+        :param upscale: bool - enlarge smaller original
+        :param quality: string - differs per format. i.e. 0-100 for jpg
+        :return: list - full object urls
+        """
+        prefix = self.parse_id(id).prefix
+        filenames = self.paths.get_auto_crop_filenames(
+            id,
+            sizes,
+            factor,
+            output_format,
+            upscale,
+            quality
+        )
+        return [prefix + filename for filename in filenames]
+
+    def get_srcset(
+        self,
+        id,
+        sizes,
+        factor='fill',
+        output_format=None,
+        upscale=True,
+        quality=65,
+        densities=None
+    ):
+        """
+        Get srcset
+        Builds value of srcset attribute for an image. Given a list of sizes
+        emits width descriptors (url 100w, ...). Given a single size and a
+        list of densities emits scaled sizes with density descriptors
+        (url 1x, url 2x, ...). Sizes snapped to the same ladder rung are
+        only listed once, the first one wins.
+        :param id: string - storage id
+        :param sizes: list - of width x height strings, or a single one
+        :param factor: string - crop factor, fit/fill
+        :param output_format: string - output format
+        :param upscale: bool - enlarge smaller original
+        :param quality: string - differs per format. i.e. 0-100 for jpg
+        :param densities: list - pixel densities, e.g. [1, 1.5, 2]
+        :return: string - srcset
+        """
+        if isinstance(sizes, str):
+            sizes = [sizes]
+
+        if densities:
+            if len(sizes) != 1:
+                err = 'Densities can only be used with a single size'
+                raise x.InvalidArgumentException(err)
+            dimensions = sizes[0].lower().split('x')
+            valid = all(dimension.isdigit() for dimension in dimensions)
+            if len(dimensions) != 2 or not valid:
+                err = 'Invalid size provided must be in 100x200 format'
+                raise x.InvalidArgumentException(err)
+            width, height = int(dimensions[0]), int(dimensions[1])
+            sizes = []
+            descriptors = []
+            for density in densities:
+                size = '{}x{}'.format(
+                    int(round(width * density)),
+                    int(round(height * density))
+                )
+                sizes.append(size)
+                descriptors.append('{:g}x'.format(density))
+        else:
+            if self.paths.ladder:
+                snapped = []
+                for size in sizes:
+                    canonical = self.paths.canonical_size(size)
+                    if canonical:
+                        size = self.paths.ladder.snap_size(canonical)
+                    snapped.append(size)
+                sizes = snapped
+            descriptors = [s.lower().split('x')[0] + 'w' for s in sizes]
+
+        urls = self.get_auto_crop_urls(
+            id,
+            sizes,
+            factor,
+            output_format,
+            upscale,
+            quality
+        )
+
+        # sizes snapped to the same rung share a descriptor
+        srcset = []
+        seen = set()
+        for url, descriptor in zip(urls, descriptors):
+            if descriptor not in seen:
+                seen.add(descriptor)
+                srcset.append(url + ' ' + descriptor)
+        return ', '.join(srcset)
 
     def get_manual_crop_url(self, *args, **kwargs):
         """
@@ -96,56 +658,632 @@ class Storage:
         :return: string - full object url
         """
         id = kwargs['id'] if 'id' in kwargs else args[0]
-        base = self.backend.get_url().rstrip('/')
-        parts = self.backend.id_to_path(id)
-        path = '/'.join(parts)
         filename = self.paths.get_manual_crop_filename(*args, **kwargs)
-        return base + '/' + path + '/' + filename
+        return self.parse_id(id).prefix + filename
 
-    def create_resize(self, url):
+    def create_resize(self, url, result=False):
         """
         Create resize
         Accepts storage URL of a resize, parses and validates it and then
-        creates the resize to be put back to storage.
+        creates the resize to be put back to storage. Concurrent requests
+        for the same resize are coalesced so that only one of them does
+        the work while the others wait for it to finish.
+
+        Requests for a resize equivalent to a canonical one (see
+        PathBuilder.get_canonical_filename) create the canonical resize
+        instead and return its url, so redirect to the returned url.
+
         :param url: string - url of resize to be created
-        :return: string - same url on success
+        :param result: bool - return shiftmedia.results.ResizeResult
+        :return: string - url of created resize
         """
         id, filename = self.backend.parse_url(url)
-        params = self.paths.filename_to_resize_params(id, filename)
-        mode = params['resize_mode']
-        modes = ['auto', 'manual']
-        if mode not in modes:
-            err = 'Resize mode [' + mode + '] is not yet implemented.'
-            raise x.NotImplementedError(err)
+        cached = self.get_cached_variant(id, filename)
+        if cached is not None:
+            if not result:
+                return url
+            return self.cached_result(url, id, filename, cached, data=False)
 
-        local_original = self.backend.retrieve_original(id, self._tmp_path)
-        local_resize = os.path.join(self._tmp_path, id, params['filename'])
-        factor = Resizer.RESIZE_TO_FIT
-        if params['factor'] == 'fill':
-            factor = Resizer.RESIZE_TO_FILL
-
-        resize = Resizer.auto_crop(
-            src=local_original,
-            dst=local_resize,
-            size=params['target_size'],
-            mode= factor,
-            upscale=params['upscale'],
-            format=params['output_format'],
-            quality=params['quality']
+        key = (id, filename)
+        created, shared = self.flights.call(
+            key,
+            self._create_resize,
+            id,
+            filename,
+            collect=result
         )
+        if created.filename != filename:
+            url = self.parse_id(id).prefix + created.filename
+        if not result:
+            return url
+        return self.share_result(created, shared, url=url, data=None)
 
+    def get_resize(self, url, result=False):
+        """
+        Get resize
+        Same as create resize, but returns bytes of the variant so that
+        they can be sent to the client straight away without reading them
+        back from storage. Served from variant caches when possible, and
+        read back from storage if variant index says it's there.
+        :param url: string - url of resize
+        :param result: bool - return shiftmedia.results.ResizeResult
+                       with variant bytes in its data field
+        :return: bytes
+        """
+        id, filename = self.backend.parse_url(url)
+        data = self.get_cached_variant(id, filename)
+        if data is not None:
+            if not result:
+                return data
+            return self.cached_result(url, id, filename, data, data=True)
+
+        key = (id, filename)
+        created, shared = self.flights.call(
+            key,
+            self._create_resize,
+            id,
+            filename,
+            collect=result
+        )
+
+        # index says variant is in storage, read its bytes back
+        if created.data is None:
+            created, shared = self.flights.call(
+                ('stored', id, created.filename),
+                self._read_stored,
+                id,
+                created.filename,
+                filename
+            )
+        if not result:
+            return created.data
+        url = self.parse_id(id).prefix + created.filename
+        return self.share_result(created, shared, url=url)
+
+    def get_preview(self, url, result=False):
+        """
+        Get preview
+        Stale-while-revalidate flavour of get resize for cold variants.
+        Instead of waiting for the resize to be rendered, returns a quick
+        preview (draft decoded, bilinear resampled, low quality) and
+        renders the resize itself in background. Previews are never put
+        to storage: they are only served to readers of the same resize
+        until the resize is stored and cached. Without a variant cache,
+        shared cache or variant index nothing would tell later requests
+        that the resize is stored, so every one of them would render a
+        preview and the resize again: such storage returns resizes as get
+        resize does. Resizes that are cached are returned from cache, and
+        those that exist in storage are read back from it.
+        :param url: string - url of resize
+        :param result: bool - return shiftmedia.results.ResizeResult
+                       with variant bytes in its data field, previews
+                       are marked provisional
+        :return: bytes
+        """
+        id, filename = self.backend.parse_url(url)
+        data = self.get_cached_variant(id, filename)
+        if data is not None:
+            if not result:
+                return data
+            return self.cached_result(url, id, filename, data, data=True)
+        if not (self.variant_cache or self.shared_cache or self.index):
+            return self.get_resize(url, result)
+
+        stored = self.stored_as(id, filename)
+        if stored:
+            read, shared = self.flights.call(
+                ('stored', id, stored),
+                self._read_stored,
+                id,
+                stored,
+                filename
+            )
+            if not result:
+                return read.data
+            return read.replace(url=self.parse_id(id).prefix + stored)
+
+        key = ('preview', id, filename)
+        preview, shared = self.flights.call(
+            key,
+            self._create_preview,
+            id,
+            filename
+        )
+        if not result:
+            return preview.data
+        return preview.replace(url=url)
+
+    def _create_preview(self, id, filename):
+        """
+        Create preview (uncoalesced)
+        Renders a preview of a resize, unless there is one already, and
+        hands the retrieved original over to background rendering of the
+        resize itself. The preview is served until that is done.
+        :param id: string - storage id
+        :param filename: string - resize filename
+        :return: shiftmedia.results.ResizeResult
+        """
+        key = (id, filename)
+        with self._previews_lock:
+            preview = self._previews.get(key)
+        if preview is not None:
+            return preview
+
+        params = self.paths.parse_filename(id, filename)
+        if params.mode is not ResizeMode.AUTO:
+            err = 'Resize mode [{}] is not yet implemented.'
+            raise x.NotImplementedError(err.format(params.mode.value))
+
+        scratch = self.workspace.scratch()
+        try:
+            with metrics.collect() as collector:
+                stage = 'preview'
+                timer = metrics.timer(metrics.STAGE_SECONDS, stage=stage)
+                span = tracing.span(
+                    'storage.' + stage,
+                    id=id,
+                    filename=filename
+                )
+                with timer, span:
+                    src = None
+                    if self.decoded_cache:
+                        src = self.decoded_cache.get(id)
+                    source_bytes = None
+                    if src is None:
+                        src = self.retrieve_original(id, scratch.path)
+                        source_bytes = scratch.track(src)
+                    img, plan = self.open_original(
+                        src,
+                        id,
+                        params.size,
+                        params.upscale,
+                        draft=True
+                    )
+                    dst = scratch.join('preview-' + filename)
+                    Resizer.render(img, dst, params, preview=True)
+                    with open(dst, 'rb') as file:
+                        data = file.read()
+                    os.remove(dst)
+                    tracing.set_attributes(bytes=len(data))
+        except Exception:
+            scratch.cleanup()
+            raise
+
+        output = Resizer.probe(io.BytesIO(data)) or {}
+        preview = ResizeResult(
+            id=id,
+            filename=filename,
+            requested=filename,
+            status=ResizeResult.PREVIEW,
+            source_bytes=source_bytes,
+            size=(output.get('width'), output.get('height')),
+            format=params.output_format,
+            frames=output.get('frames'),
+            bytes=len(data),
+            draft=plan['scale'] if plan else None,
+            durations=collector.durations,
+            elapsed=collector.durations[stage],
+            data=data
+        )
+        with self._previews_lock:
+            self._previews[key] = preview
+        metrics.increment(metrics.RESIZES, result='preview')
+        self.run_in_background(self.revalidate, id, filename, src, scratch)
+        return preview
+
+    def revalidate(self, id, filename, src=None, scratch=None):
+        """
+        Revalidate
+        Renders and stores a resize a preview was served for, coalesced
+        with concurrent requests for it, and drops the preview
+        :param id: string - storage id
+        :param filename: string - resize filename
+        :param src: string or PIL.Image - retrieved or decoded original
+        :param scratch: shiftmedia.workspace.Scratch - holding original,
+                        cleaned up when done
+        :return: shiftmedia.results.ResizeResult
+        """
         try:
-            self.backend.put_variant(resize, id, filename, force=True)
-        except x.FileExists:
-            pass
+            created, shared = self.flights.call(
+                (id, filename),
+                self._create_resize,
+                id,
+                filename,
+                src=src
+            )
+            return created
+        finally:
+            with self._previews_lock:
+                self._previews.pop((id, filename), None)
+            if scratch:
+                scratch.cleanup()
+
+    @staticmethod
+    def cached_result(url, id, filename, cached, data=False):
+        """
+        Cached result
+        Returns result of a resize served from variant cache
+        :param url: string - resize url
+        :param id: string - storage id
+        :param filename: string - resize filename
+        :param cached: bytes - cached variant
+        :param data: bool - include variant bytes
+        :return: shiftmedia.results.ResizeResult
+        """
+        return ResizeResult(
+            url=url,
+            id=id,
+            filename=filename,
+            requested=filename,
+            status=ResizeResult.CACHED,
+            bytes=len(cached),
+            durations=dict(),
+            elapsed=0.0,
+            data=cached if data else None
+        )
+
+    @staticmethod
+    def share_result(result, shared, **changes):
+        """
+        Share result
+        Returns a copy of resize result for a caller, marked coalesced if
+        the resize was created by a concurrent call
+        :param result: shiftmedia.results.ResizeResult
+        :param shared: bool - result came from a concurrent call
+        :return: shiftmedia.results.ResizeResult
+        """
+        if shared and result.status == ResizeResult.CREATED:
+            changes['status'] = ResizeResult.COALESCED
+        return result.replace(**changes)
+
+    def get_variant(self, url):
+        """
+        Get variant
+        Returns bytes of a rendered variant if it is cached in memory
+        :param url: string - variant url
+        :return: bytes or None
+        """
+        id, filename = self.backend.parse_url(url)
+        return self.get_cached_variant(id, filename)
+
+    def get_cached_variant(self, id, filename):
+        """
+        Get cached variant
+        Looks up variant bytes in process memory cache and then in cache
+        shared between processes by id and filename, then under canonical
+        filename the resize was mapped to before, if any.
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bytes or None
+        """
+        data = self._cached_variant(id, filename)
+        if data is None:
+            with self._canonical_lock:
+                canonical = self._canonical.get((id, filename))
+            if canonical:
+                data = self._cached_variant(id, canonical)
+        if self.variant_cache or self.shared_cache or self.write_behind:
+            result = 'miss' if data is None else 'hit'
+            metrics.increment(metrics.VARIANT_CACHE, result=result)
+        return data
+
+    def _cached_variant(self, id, filename):
+        """ Look up variant bytes in caches and pending uploads """
+        data = None
+        if self.variant_cache:
+            data = self.variant_cache.get(id, filename)
+        if data is None and self.shared_cache:
+            data = self.shared_cache.get(id, filename)
+            if data is not None and self.variant_cache:
+                self.variant_cache.set(id, filename, data)
+        if data is None and self.write_behind:
+            data = self.write_behind.get(id, filename)
+        return data
+
+    def _read_stored(self, id, filename, requested):
+        """
+        Read stored (uncoalesced)
+        Reads bytes of a variant that variant index says is in storage
+        and puts them to variant caches. Variants backend can't read
+        back are rendered again, but never stored again.
+        :param id: string - storage id
+        :param filename: string - stored variant filename
+        :param requested: string - requested resize filename
+        :return: shiftmedia.results.ResizeResult - with variant bytes
+        """
+        started = time.monotonic()
+        with metrics.timer(metrics.STAGE_SECONDS, stage='read'):
+            data = self.backend.get_variant(id, filename)
+        elapsed = time.monotonic() - started
+        if data is None:
+            return self._create_resize(
+                id,
+                requested,
+                check_index=False,
+                store=False
+            )
+
+        if self.variant_cache:
+            self.variant_cache.set(id, filename, data)
+        if self.shared_cache:
+            self.shared_cache.set(id, filename, data)
+        output = Resizer.probe(io.BytesIO(data)) or {}
+        return ResizeResult(
+            id=id,
+            filename=filename,
+            requested=requested,
+            status=ResizeResult.EXISTS,
+            size=(output.get('width'), output.get('height')),
+            format=self.paths.parse_filename(id, filename).output_format,
+            frames=output.get('frames'),
+            bytes=len(data),
+            durations=dict(read=elapsed),
+            elapsed=elapsed,
+            data=data
+        )
+
+    def _create_resize(
+        self,
+        id,
+        filename,
+        check_index=True,
+        src=None,
+        store=True,
+        collect=False
+    ):
+        """
+        Create resize (uncoalesced)
+        Does the actual work of retrieving the original, resizing it and
+        putting the result back to storage while holding variant lock.
+        :param id: string - storage id
+        :param filename: string - resize filename
+        :param check_index: bool - skip variants index knows about
+        :param src: string or PIL.Image - original retrieved already
+        :param store: bool - put rendered variant to storage
+        :param collect: bool - collect durations of stages even if metrics
+                        are disabled
+        :return: shiftmedia.results.ResizeResult - with variant bytes, if
+                 it was created
+        """
+        with metrics.collect(collect) as collector:
+            stage = 'create_resize'
+            timer = metrics.timer(metrics.STAGE_SECONDS, stage=stage)
+            profile = profiling.profile(stage, id=id, filename=filename)
+            span = tracing.span('storage.' + stage, id=id, filename=filename)
+            with timer, profile, span, self.variant_lock(id, filename):
+                result = self._resize(id, filename, check_index, src, store)
+
+        result.durations = collector.durations
+        result.elapsed = collector.durations.get(stage)
+        return result
+
+    def _resize(self, id, filename, check_index=True, src=None, store=True):
+        """
+        Resize
+        Retrieves the original, resizes it and puts the result to storage.
+        Once original size is known, the request is mapped to canonical
+        filename, and the canonical resize is created instead.
+        :param id: string - storage id
+        :param filename: string - resize filename
+        :param check_index: bool - skip variants index knows about
+        :param src: string or PIL.Image - original retrieved already
+        :param store: bool - put rendered variant to storage
+        :return: shiftmedia.results.ResizeResult
+        """
+        requested = filename
+        params = self.paths.parse_filename(id, filename)
+        if params.mode is not ResizeMode.AUTO:
+            err = 'Resize mode [{}] is not yet implemented.'
+            raise x.NotImplementedError(err.format(params.mode.value))
+
+        # variant already in storage
+        stored = self.stored_as(id, filename) if check_index else None
+        if stored:
+            metrics.increment(metrics.RESIZES, result='exists')
+            return ResizeResult(
+                id=id,
+                filename=stored,
+                requested=requested,
+                status=ResizeResult.EXISTS
+            )
+
+        # every resize works in its own scratch directory
+        with self.workspace.scratch() as scratch:
+
+            # decoded original might be cached, skip retrieving then
+            if src is None and self.decoded_cache:
+                src = self.decoded_cache.get(id)
+            source_bytes = None
+            if src is None:
+                src = self.retrieve_original(id, scratch.path)
+                source_bytes = scratch.track(src)
+            img, plan = self.open_original(src, id, params.size, True)
+            source = plan['source'] if plan else Resizer.describe(img)
+            source_size = (source['width'], source['height'])
+            profiling.annotate(params=params.to_dict(), source=source)
+            tracing.set_attributes(
+                pixels=source['width'] * source['height'],
+                frames=source['frames']
+            )
 
-        os.remove(local_original)
-        os.remove(resize)
-        tmp_dir = os.path.join(self._tmp_path, id)
-        if not os.listdir(tmp_dir):
-            os.rmdir(tmp_dir)
-        return url
+            # map to canonical resize (draft decoded image is smaller)
+            params = self.map_canonical(id, params, source_size)
+            if params.filename != filename:
+                filename = params.filename
+                self.remember_canonical(id, requested, filename)
+                exists = self.index and self.index.exists(id, filename)
+                if check_index and exists:
+                    metrics.increment(metrics.RESIZES, result='exists')
+                    return ResizeResult(
+                        id=id,
+                        filename=filename,
+                        requested=requested,
+                        status=ResizeResult.EXISTS,
+                        source_size=source_size,
+                        source_bytes=source_bytes,
+                        frames=source['frames']
+                    )
 
+            local_resize = scratch.join(params.filename)
+            resize = self.render(img, local_resize, params, cache_key=id)
+            scratch.track(resize)
+            with open(resize, 'rb') as file:
+                data = file.read()
+            if store:
+                self.store_variant(resize, id, filename, data)
+            if store and self.store_aliases and filename != requested:
+                self.store_variant(resize, id, requested, data)
+            metrics.increment(metrics.RESIZES, result='created')
+            tracing.set_attributes(bytes=len(data))
+            output = Resizer.probe(io.BytesIO(data)) or {}
+            return ResizeResult(
+                id=id,
+                filename=filename,
+                requested=requested,
+                status=ResizeResult.CREATED,
+                source_size=source_size,
+                source_bytes=source_bytes,
+                size=(output.get('width'), output.get('height')),
+                format=params.output_format,
+                frames=output.get('frames'),
+                bytes=len(data),
+                memory=plan['estimate'] if plan else None,
+                draft=plan['scale'] if plan else None,
+                data=data
+            )
 
+    def map_canonical(self, id, params, source_size):
+        """
+        Map canonical
+        Maps parsed resize to its canonical equivalent once size of the
+        original is known (see PathBuilder.get_canonical_filename)
+        :param id: string - storage id
+        :param params: shiftmedia.paths.ResizeParams - parsed filename
+        :param source_size: tuple - original width and height
+        :return: shiftmedia.paths.ResizeParams - of canonical resize
+        """
+        upscale_matters = Resizer.upscale_matters(
+            source_size,
+            params.size,
+            Resizer.factor_to_mode(params.factor)
+        )
+        canonical = self.paths.get_canonical_filename(params, upscale_matters)
+        if canonical == params.filename:
+            return params
+        profiling.annotate(canonical=canonical)
+        tracing.set_attributes(canonical=canonical)
+        return self.paths.parse_filename(id, canonical)
+
+    def remember_canonical(self, id, requested, canonical):
+        """
+        Remember canonical
+        Remembers which canonical resize a requested one was mapped to,
+        so that it is found in index without retrieving the original
+        :param id: string - storage id
+        :param requested: string - requested resize filename
+        :param canonical: string - canonical resize filename
+        :return: None
+        """
+        with self._canonical_lock:
+            self._canonical[(id, requested)] = canonical
+            self._canonical.move_to_end((id, requested))
+            while len(self._canonical) > self.CANONICAL_CACHE_SIZE:
+                self._canonical.popitem(last=False)
+
+    def stored_as(self, id, filename):
+        """
+        Stored as
+        Checks variant index for requested resize and for the canonical
+        resize it was mapped to before, if any
+        :param id: string - storage id
+        :param filename: string - requested resize filename
+        :return: string - filename the resize is stored under or None
+        """
+        if not self.index:
+            return None
+        if self.index.exists(id, filename):
+            return filename
+        with self._canonical_lock:
+            canonical = self._canonical.get((id, filename))
+        if canonical and self.index.exists(id, canonical):
+            return canonical
+        return None
+
+    def open_original(self, src, id, size, upscale=True, draft=False):
+        """
+        Open original
+        Decodes local original checking memory budget first, if any.
+        Originals over budget are decoded in draft mode or rejected.
+        Decoded images are returned as is.
+        :param src: string or PIL.Image - local original or decoded image
+        :param id: string - storage id
+        :param size: tuple - biggest target width and height
+        :param upscale: bool - whether output may be bigger than original
+        :param draft: bool - always decode in draft mode
+        :return: tuple - PIL.Image and budget plan (or None if unchecked)
+        """
+        plan = None
+        info = None
+        if self.memory_budget and isinstance(src, str):
+            info = Resizer.probe(src)
+        if info:
+            plan = self.memory_budget.check(info, size, upscale)
+            plan['source'] = info
+
+        if draft or (plan and plan['scale'] > 1):
+            draft = size
+        img = Resizer.open(src, self.decoded_cache, id, draft=draft or None)
+        return img, plan
+
+    def render(self, src, dst, params, cache_key=None):
+        """
+        Render
+        Renders a variant described by parsed filename parameters from
+        local original or decoded image and writes it to destination.
+        :param src: string or PIL.Image - local original or decoded image
+        :param dst: string - local path to write variant to
+        :param params: shiftmedia.paths.ResizeParams - parsed filename
+        :param cache_key: string - key of original in decoded cache
+        :return: string - path to rendered variant
+        """
+        return Resizer.render(
+            src,
+            dst,
+            params,
+            cache=self.decoded_cache,
+            cache_key=cache_key
+        )
+
+    def store_variant(self, path, id, filename, data=None):
+        """
+        Store variant
+        Puts rendered variant to storage and records it in existence
+        index and variant caches. With write-behind, the variant is only
+        queued for upload and recorded in the index once uploaded.
+        :param path: string - local path to rendered variant
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :param data: bytes - variant bytes if already read
+        :return: None
+        """
+        caches = self.variant_cache or self.shared_cache
+        if data is None and (caches or self.write_behind):
+            with open(path, 'rb') as file:
+                data = file.read()
 
+        if self.write_behind:
+            with metrics.timer(metrics.STAGE_SECONDS, stage='store'):
+                self.write_behind.put(id, filename, data, self.variant_stored)
+        else:
+            try:
+                with metrics.timer(metrics.STAGE_SECONDS, stage='store'):
+                    self.backend.put_variant(path, id, filename, force=True)
+            except x.FileExists:
+                pass
+            self.variant_stored(id, filename)
 
+        if caches:
+            if self.variant_cache:
+                self.variant_cache.set(id, filename, data)
+            if self.shared_cache:
+                self.shared_cache.set(id, filename, data)
@@ -246,5 +246,27 @@ class BackendLocalTests(TestCase, LocalStorageTestHelpers):
         self.assertFalse(os.path.exists(variant3))
         self.assertFalse(os.path.exists(variant4))
 
+    def test_list_variants(self):
+        """ Listing files stored under id """
+        self.prepare_uploads()
+        backend = BackendLocal(self.path)
+        src = os.path.join(self.upload_path, 'demo-test.tar.gz')
+        id = utils.generate_id('demo-test.tar.gz')
+        self.assertEquals([], backend.list_variants(id))
+        backend.put(src, id)
+        backend.put_variant(src, id, 'variant1.tar.gz')
+        result = sorted(backend.list_variants(id))
+        self.assertEquals(['demo-test.tar.gz', 'variant1.tar.gz'], result)
 
-
+    def test_get_variant(self):
+        """ Reading back bytes of a stored variant """
+        self.prepare_uploads()
+        backend = BackendLocal(self.path)
+        src = os.path.join(self.upload_path, 'demo-test.tar.gz')
+        id = utils.generate_id('demo-test.tar.gz')
+        self.assertIsNone(backend.get_variant(id, 'variant1.tar.gz'))
+        backend.put(src, id)
+        backend.put_variant(src, id, 'variant1.tar.gz')
+        with open(src, 'rb') as file:
+            expected = file.read()
+        self.assertEquals(expected, backend.get_variant(id, 'variant1.tar.gz'))
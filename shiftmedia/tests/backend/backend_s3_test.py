@@ -2,7 +2,8 @@ from unittest import mock, TestCase
 from nose.plugins.attrib import attr
 from nose.tools import assert_raises
 
-import os, boto3
+import io, os, boto3
+from botocore import exceptions as bx
 from config.local import LocalConfig
 from shiftmedia import BackendS3, utils, PathBuilder, exceptions as x
 from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
@@ -286,7 +287,43 @@ class BackendLocalTests(TestCase, LocalStorageTestHelpers):
         self.assertFalse(backend.exists(variant4))
 
 
+@attr('backend', 's3')
+class BackendS3ListingTests(TestCase):
+    """ S3 backend listing tests, with S3 client stubbed out """
 
-
-
-
+    def test_list_variants(self):
+        """ Listing files stored under id with a single prefix listing """
+        backend = BackendS3('key', 'secret', 'bucket', 'eu-west-1')
+        id = utils.generate_id('demo-test.tar.gz')
+        prefix = '/'.join(backend.id_to_path(id)) + '/'
+        keys = ['demo-test.tar.gz', 'variant1.tar.gz', 'nested/file.txt']
+        pages = mock.MagicMock()
+        pages.search.return_value = iter(
+            [dict(Key=prefix + key) for key in keys] + [None]
+        )
+        client = mock.MagicMock()
+        client.get_paginator.return_value.paginate.return_value = pages
+
+        with mock.patch('boto3.client', return_value=client):
+            result = sorted(backend.list_variants(id))
+        self.assertEquals(['demo-test.tar.gz', 'variant1.tar.gz'], result)
+        paginate = client.get_paginator.return_value.paginate
+        paginate.assert_called_once_with(Bucket='bucket', Prefix=prefix)
+
+    def test_get_variant(self):
+        """ Reading back bytes of a stored variant """
+        backend = BackendS3('key', 'secret', 'bucket', 'eu-west-1')
+        id = utils.generate_id('demo-test.tar.gz')
+        key = '/'.join(backend.id_to_path(id)) + '/variant1.tar.gz'
+        client = mock.MagicMock()
+        client.get_object.return_value = dict(Body=io.BytesIO(b'bytes'))
+        with mock.patch('boto3.client', return_value=client):
+            data = backend.get_variant(id, 'variant1.tar.gz')
+        self.assertEquals(b'bytes', data)
+        client.get_object.assert_called_once_with(Bucket='bucket', Key=key)
+
+        missing = dict(Error=dict(Code='NoSuchKey'))
+        error = bx.ClientError(missing, 'GetObject')
+        client.get_object.side_effect = error
+        with mock.patch('boto3.client', return_value=client):
+            self.assertIsNone(backend.get_variant(id, 'variant1.tar.gz'))
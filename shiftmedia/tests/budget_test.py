@@ -0,0 +1,156 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os
+from PIL import Image
+from shiftmedia import Storage, BackendLocal
+from shiftmedia import exceptions as x
+from shiftmedia.budget import MemoryBudget, measure
+from shiftmedia.resizer import Resizer
+from shiftmedia.results import ResizeResult
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('budget')
+class MemoryBudgetTests(TestCase, LocalStorageTestHelpers):
+    """ Memory budget tests """
+
+    def setUp(self):
+        super().setUp()
+        self.prepare_uploads()
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    def asset(self, filename):
+        """ Get path to test asset """
+        return os.path.join(self.upload_path, filename)
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_budget(self):
+        """ Instantiating memory budget """
+        budget = MemoryBudget(64 * 1024 * 1024)
+        self.assertIsInstance(budget, MemoryBudget)
+        with assert_raises(x.ConfigurationException):
+            MemoryBudget(0)
+
+    def test_probe_reports_displayed_dimensions(self):
+        """ Probing rotated original swaps its dimensions """
+        info = Resizer.probe(self.asset('bad_orientation.jpg'))
+        self.assertEquals((2448, 3264), (info['width'], info['height']))
+        self.assertIsNone(Resizer.probe(self.asset('test.tar.gz')))
+
+    def test_estimate_memory(self):
+        """ Estimating peak memory from image header """
+        info = dict(width=100, height=50, mode='RGB', frames=1)
+        expected = 100 * 50 * 4 * 3 + 10 * 10 * 4
+        self.assertEquals(expected, Resizer.estimate_memory(info, (10, 10)))
+
+        # every frame of animation is kept
+        gif = Resizer.probe(self.asset('countdown.gif'))
+        estimate = Resizer.estimate_memory(gif, (100, 100))
+        expected = 640 * 427 * (1 + 8) + 100 * 100 * 4 * 23
+        self.assertEquals(expected, estimate)
+
+        # no upscale, no output bigger than original
+        small = Resizer.estimate_memory(info, (1000, 1000), upscale=False)
+        big = Resizer.estimate_memory(info, (1000, 1000))
+        self.assertEquals(100 * 50 * 4 * 4, small)
+        self.assertTrue(big > small)
+
+        # draft decoding shrinks original
+        drafted = Resizer.estimate_memory(info, (10, 10), scale=2)
+        self.assertEquals(50 * 25 * 4 * 3 + 10 * 10 * 4, drafted)
+
+    def test_draft_scale_mirrors_decoder(self):
+        """ Draft scale matches what JPEG decoder does """
+        src = self.asset('bad_orientation2.jpg')
+        for size in [(100, 100), (600, 500), (1500, 1500), (4000, 3000)]:
+            img = Image.open(src)
+            img.draft(img.mode, size)
+            scale = Resizer.draft_scale((4032, 3024), size)
+            self.assertEquals(-(-4032 // scale), img.size[0], size)
+
+    def test_open_in_draft_mode(self):
+        """ Draft decoding keeps image at least as big as target """
+        src = self.asset('bad_orientation.jpg')
+        img = Resizer.open(src, draft=(300, 400))
+        self.assertTrue(img.size[0] < 2448)
+        self.assertTrue(img.size[0] >= 300 and img.size[1] >= 400)
+        self.assertTrue(img.size[1] > img.size[0])
+
+        # drafted images aren't cached
+        cache = mock.Mock()
+        cache.get.return_value = None
+        Resizer.open(src, cache, 'key', draft=(300, 400))
+        cache.set.assert_not_called()
+
+    def test_check_within_budget(self):
+        """ Originals within budget are decoded in full """
+        info = Resizer.probe(self.asset('original_vertical.jpg'))
+        plan = MemoryBudget(64 * 1024 * 1024).check(info, (100, 200))
+        self.assertEquals(1, plan['scale'])
+        estimate = Resizer.estimate_memory(info, (100, 200))
+        self.assertEquals(estimate, plan['estimate'])
+
+    def test_check_downgrades_jpeg_to_draft(self):
+        """ Over budget JPEG is decoded in draft mode """
+        info = Resizer.probe(self.asset('bad_orientation2.jpg'))
+        budget = MemoryBudget(16 * 1024 * 1024)
+        plan = budget.check(info, (400, 300))
+        self.assertEquals(8, plan['scale'])
+        self.assertTrue(plan['estimate'] <= budget.max_bytes)
+
+        # unless asked not to
+        strict = MemoryBudget(16 * 1024 * 1024, draft=False)
+        with assert_raises(x.MemoryBudgetExceeded):
+            strict.check(info, (400, 300))
+
+        # or draft doesn't help
+        with assert_raises(x.MemoryBudgetExceeded):
+            budget.check(info, (3000, 2000))
+
+    def test_check_rejects_other_formats(self):
+        """ Over budget originals other than JPEG are rejected """
+        info = Resizer.probe(self.asset('countdown.gif'))
+        with assert_raises(x.MemoryBudgetExceeded):
+            MemoryBudget(1024 * 1024).check(info, (100, 100))
+
+    def test_storage_drafts_over_budget_resizes(self):
+        """ Storage decodes over budget original in draft mode """
+        storage = Storage(
+            BackendLocal(self.path),
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            memory_budget=MemoryBudget(16 * 1024 * 1024)
+        )
+        id = storage.put(self.asset('bad_orientation.jpg'))
+        url = storage.get_auto_crop_url(id, '300x400', 'fill')
+        result = storage.create_resize(url, result=True)
+        self.assertIsInstance(result, ResizeResult)
+        self.assertEquals(8, result.draft)
+        self.assertEquals((2448, 3264), result.source_size)
+        self.assertEquals((300, 400), result.size)
+        self.assertTrue(result.memory <= storage.memory_budget.max_bytes)
+
+        # too big even in draft mode
+        url = storage.get_auto_crop_url(id, '2000x3000', 'fill')
+        with assert_raises(x.MemoryBudgetExceeded):
+            storage.create_resize(url)
+
+    def test_measure_peak_memory(self):
+        """ Measuring actual peak memory of a block """
+        size = 32 * 1024 * 1024
+        with measure() as measurement:
+            data = bytearray(size)
+            del data
+        self.assertTrue(measurement.traced >= size)
+        self.assertTrue(measurement.elapsed > 0)
+        if measurement.rss is not None:
+            self.assertTrue(measurement.rss >= 0)
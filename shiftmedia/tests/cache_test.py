@@ -0,0 +1,222 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os, time
+from PIL import Image
+from shiftmedia import BackendLocal, utils
+from shiftmedia.cache import OriginalsCache, DecodedCache, VariantCache
+from shiftmedia.resizer import Resizer
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('cache')
+class OriginalsCacheTests(TestCase, LocalStorageTestHelpers):
+    """ Disk cache of originals tests """
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    @property
+    def cache_path(self):
+        return os.path.join(self.tmp_path, '.originals')
+
+    def put_original(self, backend, filename):
+        """ Put test asset to backend and return its id """
+        self.prepare_uploads()
+        id = utils.generate_id(filename)
+        backend.put(os.path.join(self.upload_path, filename), id)
+        return id
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_cache(self):
+        """ Instantiating originals cache """
+        cache = OriginalsCache(self.cache_path, 1024)
+        self.assertIsInstance(cache, OriginalsCache)
+
+    def test_retrieve_populates_cache_and_then_hits(self):
+        """ Retrieving original populates cache, then serves from it """
+        backend = BackendLocal(self.path)
+        id = self.put_original(backend, 'test.jpg')
+        cache = OriginalsCache(self.cache_path, 10 * 1024 * 1024)
+
+        with mock.patch.object(
+            backend,
+            'retrieve_original',
+            wraps=backend.retrieve_original
+        ) as retrieve:
+            dst1 = cache.retrieve_original(backend, id, self.tmp_path)
+            os.remove(dst1)
+            dst2 = cache.retrieve_original(backend, id, self.tmp_path)
+            self.assertEquals(1, retrieve.call_count)
+
+        self.assertEquals(dst1, dst2)
+        self.assertTrue(os.path.exists(dst2))
+        self.assertTrue(dst2.endswith(os.path.join(id, 'test.jpg')))
+        stats = cache.stats()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(1, stats['misses'])
+        self.assertEquals(os.path.getsize(dst2), stats['bytes'])
+
+        # no staging leftovers
+        staging = os.path.join(self.cache_path, OriginalsCache.STAGING)
+        self.assertEquals([], os.listdir(staging))
+
+    def test_evicting_least_recently_used(self):
+        """ Evicting least recently used originals over budget """
+        backend = BackendLocal(self.path)
+        id1 = self.put_original(backend, 'test.jpg')
+        id2 = self.put_original(backend, 'test.png')
+        size1 = os.path.getsize(os.path.join(self.upload_path, 'test.jpg'))
+        size2 = os.path.getsize(os.path.join(self.upload_path, 'test.png'))
+        cache = OriginalsCache(self.cache_path, max(size1, size2))
+
+        cache.retrieve_original(backend, id1, self.tmp_path)
+        past = time.time() - 100
+        os.utime(cache.id_to_path(id1), (past, past))
+        cache.retrieve_original(backend, id2, self.tmp_path)
+
+        self.assertFalse(os.path.exists(cache.id_to_path(id1)))
+        self.assertTrue(os.path.exists(cache.id_to_path(id2)))
+        self.assertEquals(1, cache.stats()['evictions'])
+        self.assertEquals(size2, cache.size)
+
+    def test_evicted_entry_does_not_affect_readers(self):
+        """ Readers keep their copy after entry is evicted """
+        backend = BackendLocal(self.path)
+        id = self.put_original(backend, 'test.jpg')
+        cache = OriginalsCache(self.cache_path, 10 * 1024 * 1024)
+        dst = cache.retrieve_original(backend, id, self.tmp_path)
+        cache.invalidate(id)
+        self.assertTrue(os.path.exists(dst))
+        self.assertEquals(0, cache.size)
+
+    def test_originals_larger_than_budget_are_not_cached(self):
+        """ Originals over budget are retrieved but not cached """
+        backend = BackendLocal(self.path)
+        id = self.put_original(backend, 'test.jpg')
+        cache = OriginalsCache(self.cache_path, 10)
+        dst = cache.retrieve_original(backend, id, self.tmp_path)
+        self.assertTrue(os.path.exists(dst))
+        self.assertFalse(os.path.exists(cache.id_to_path(id)))
+
+
+@attr('cache')
+class DecodedCacheTests(TestCase, LocalStorageTestHelpers):
+    """ In-memory cache of decoded originals tests """
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    def test_instantiate_cache(self):
+        """ Instantiating decoded cache """
+        cache = DecodedCache(1000)
+        self.assertIsInstance(cache, DecodedCache)
+
+    def test_evicting_by_pixel_count(self):
+        """ Evicting least recently used images over pixel budget """
+        cache = DecodedCache(250)
+        cache.set('one', Image.new('RGB', (10, 10)))
+        cache.set('two', Image.new('RGB', (10, 10)))
+        self.assertIsNotNone(cache.get('one'))
+        cache.set('three', Image.new('RGB', (10, 10)))
+        self.assertIsNone(cache.get('two'))
+        self.assertIsNotNone(cache.get('one'))
+        self.assertIsNotNone(cache.get('three'))
+        self.assertEquals(200, cache.pixels)
+        self.assertEquals(1, cache.stats()['evictions'])
+
+    def test_images_over_budget_are_not_cached(self):
+        """ Images larger than the whole budget are not cached """
+        cache = DecodedCache(10)
+        self.assertFalse(cache.set('big', Image.new('RGB', (10, 10))))
+        self.assertEquals(0, cache.pixels)
+
+    def test_resizer_draws_on_decoded_cache(self):
+        """ Resizer decodes original once when given decoded cache """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'bad_orientation.jpg')
+        cache = DecodedCache(20 * 1000 * 1000)
+        with mock.patch('shiftmedia.resizer.Image.open', wraps=Image.open) \
+                as open:
+            for size in ['100x100', '200x100']:
+                dst = os.path.join(self.tmp_path, size + '.jpg')
+                Resizer.auto_crop(src, dst, size, cache=cache, cache_key='k')
+                self.assertTrue(os.path.exists(dst))
+            self.assertEquals(1, open.call_count)
+
+        img = cache.get('k')
+        self.assertEquals((2448, 3264), img.size)
+
+    def test_animated_images_are_not_cached(self):
+        """ Animated images are not put to decoded cache """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'countdown.gif')
+        cache = DecodedCache(20 * 1000 * 1000)
+        dst = os.path.join(self.tmp_path, 'resize.gif')
+        Resizer.auto_crop(src, dst, '50x50', cache=cache, cache_key='k')
+        self.assertEquals(0, cache.stats()['items'])
+
+
+@attr('cache')
+class VariantCacheTests(TestCase):
+    """ In-memory cache of rendered variants tests """
+
+    def test_instantiate_cache(self):
+        """ Instantiating variant cache """
+        cache = VariantCache(1000)
+        self.assertIsInstance(cache, VariantCache)
+
+    def test_set_and_get(self):
+        """ Putting variant bytes to cache and getting them back """
+        cache = VariantCache(1000)
+        self.assertIsNone(cache.get('id', 'resize.jpg'))
+        cache.set('id', 'resize.jpg', b'12345')
+        self.assertEquals(b'12345', cache.get('id', 'resize.jpg'))
+        stats = cache.stats()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(1, stats['misses'])
+        self.assertEquals(5, stats['bytes'])
+
+    def test_evicting_by_byte_size(self):
+        """ Evicting least recently used variants over byte budget """
+        cache = VariantCache(10)
+        cache.set('id', 'one.jpg', b'1234')
+        cache.set('id', 'two.jpg', b'1234')
+        cache.get('id', 'one.jpg')
+        cache.set('id', 'three.jpg', b'1234')
+        self.assertIsNone(cache.get('id', 'two.jpg'))
+        self.assertIsNotNone(cache.get('id', 'one.jpg'))
+        self.assertEquals(8, cache.bytes)
+        self.assertFalse(cache.set('id', 'big.jpg', b'12345678901'))
+
+    def test_entries_expire(self):
+        """ Variants expire after time to live """
+        cache = VariantCache(1000, ttl=0.01)
+        cache.set('id', 'resize.jpg', b'12345')
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('id', 'resize.jpg'))
+        self.assertEquals(0, cache.bytes)
+        self.assertEquals(1, cache.stats()['expirations'])
+
+    def test_invalidate_all_variants_of_id(self):
+        """ Invalidating all variants of an id """
+        cache = VariantCache(1000)
+        cache.set('id1', 'one.jpg', b'1')
+        cache.set('id1', 'two.jpg', b'2')
+        cache.set('id2', 'one.jpg', b'3')
+        cache.invalidate('id1')
+        self.assertIsNone(cache.get('id1', 'one.jpg'))
+        self.assertIsNone(cache.get('id1', 'two.jpg'))
+        self.assertEquals(b'3', cache.get('id2', 'one.jpg'))
+        self.assertEquals(1, cache.bytes)
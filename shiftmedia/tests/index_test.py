@@ -0,0 +1,93 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+
+from shiftmedia import utils
+from shiftmedia.index import VariantIndex
+
+
+@attr('index')
+class VariantIndexTests(TestCase):
+    """ Variant existence index tests """
+
+    def get_backend(self, id, filenames):
+        backend = mock.MagicMock()
+        backend.list_variants.return_value = filenames
+        backend.id_to_path.return_value = id.split('-')[:5] + ['test.jpg']
+        return backend
+
+    def test_lists_id_once(self):
+        """ Index lists each id only once """
+        id = utils.generate_id('test.jpg')
+        backend = self.get_backend(id, ['test.jpg', 'resize.jpg'])
+        index = VariantIndex(backend)
+        self.assertTrue(index.exists(id, 'resize.jpg'))
+        self.assertTrue(index.exists(id, 'test.jpg'))
+        self.assertFalse(index.exists(id, 'other.jpg'))
+        backend.list_variants.assert_called_once_with(id)
+        self.assertEquals(1, index.stats()['negatives'])
+
+    def test_new_ids_are_not_listed(self):
+        """ Freshly generated ids do not require listing """
+        id = utils.generate_id('test.jpg')
+        backend = self.get_backend(id, [])
+        index = VariantIndex(backend)
+        index.mark_new(id)
+        self.assertFalse(index.exists(id, 'test.jpg'))
+        index.add(id, 'test.jpg')
+        self.assertTrue(index.exists(id, 'test.jpg'))
+        backend.list_variants.assert_not_called()
+
+    def test_invalidate_forces_listing(self):
+        """ Invalidated id is listed again """
+        id = utils.generate_id('test.jpg')
+        backend = self.get_backend(id, ['test.jpg'])
+        index = VariantIndex(backend)
+        index.exists(id, 'test.jpg')
+        index.invalidate(id)
+        backend.list_variants.return_value = []
+        self.assertFalse(index.exists(id, 'test.jpg'))
+        self.assertEquals(2, backend.list_variants.call_count)
+
+    def test_clear_variants_keeps_originals(self):
+        """ Clearing variants keeps only originals """
+        id = utils.generate_id('test.jpg')
+        backend = self.get_backend(id, ['test.jpg', 'resize.jpg'])
+        index = VariantIndex(backend)
+        index.exists(id, 'resize.jpg')
+        index.clear_variants()
+        self.assertTrue(index.exists(id, 'test.jpg'))
+        self.assertFalse(index.exists(id, 'resize.jpg'))
+        backend.list_variants.assert_called_once_with(id)
+
+    def test_forgets_least_recently_used_ids(self):
+        """ Index remembers a bounded number of ids """
+        backend = self.get_backend(utils.generate_id('test.jpg'), [])
+        index = VariantIndex(backend, max_ids=2)
+        for id in ['a', 'b', 'c']:
+            index.exists(id, 'resize.jpg')
+        self.assertEquals(2, index.stats()['ids'])
+        index.exists('a', 'resize.jpg')
+        self.assertEquals(4, backend.list_variants.call_count)
+
+    def test_listings_expire(self):
+        """ Ids are listed again once their listing expires """
+        id = utils.generate_id('test.jpg')
+        backend = self.get_backend(id, ['test.jpg', 'resize.jpg'])
+        index = VariantIndex(backend, ttl=60)
+        with mock.patch('time.monotonic', return_value=1000):
+            self.assertTrue(index.exists(id, 'resize.jpg'))
+        backend.list_variants.return_value = ['test.jpg']
+        with mock.patch('time.monotonic', return_value=1030):
+            self.assertTrue(index.exists(id, 'resize.jpg'))
+        with mock.patch('time.monotonic', return_value=1061):
+            self.assertFalse(index.exists(id, 'resize.jpg'))
+        self.assertEquals(2, backend.list_variants.call_count)
+
+    def test_backend_that_cant_list(self):
+        """ Index knows only about added variants if backend can't list """
+        id = utils.generate_id('test.jpg')
+        backend = self.get_backend(id, None)
+        index = VariantIndex(backend)
+        self.assertFalse(index.exists(id, 'resize.jpg'))
+        index.add(id, 'resize.jpg')
+        self.assertTrue(index.exists(id, 'resize.jpg'))
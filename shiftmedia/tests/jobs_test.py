@@ -0,0 +1,191 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os, time, signal
+from shiftmedia import Storage, BackendLocal
+from shiftmedia.jobs import SqliteJobQueue
+from shiftmedia.worker import Worker, load_factory
+from shiftmedia import exceptions as x
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('jobs')
+class SqliteJobQueueTests(TestCase, LocalStorageTestHelpers):
+    """ SQLite job queue tests """
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    @property
+    def db(self):
+        return os.path.join(self.tmp_path, 'jobs.sqlite')
+
+    def test_instantiate_queue(self):
+        """ Instantiating queue creates database """
+        queue = SqliteJobQueue(self.db)
+        self.assertIsInstance(queue, SqliteJobQueue)
+        self.assertTrue(os.path.exists(self.db))
+
+    def test_put_reserve_and_complete(self):
+        """ Putting, reserving and completing jobs in order """
+        queue = SqliteJobQueue(self.db)
+        queue.put('resize', dict(url='one'))
+        queue.put('resize', dict(url='two'))
+        job = queue.reserve()
+        self.assertEquals('resize', job.kind)
+        self.assertEquals(dict(url='one'), job.payload)
+        self.assertEquals(1, job.attempts)
+        self.assertEquals(1, queue.count('reserved'))
+        queue.complete(job)
+        self.assertEquals('two', queue.reserve().payload['url'])
+        self.assertIsNone(queue.reserve())
+
+    def test_queue_is_durable(self):
+        """ Jobs survive reopening the queue """
+        SqliteJobQueue(self.db).put('resize', dict(url='one'))
+        self.assertEquals(1, SqliteJobQueue(self.db).count('queued'))
+
+    def test_expired_lease_makes_job_available(self):
+        """ Job with expired lease is available again """
+        queue = SqliteJobQueue(self.db)
+        queue.put('resize', dict(url='one'))
+        queue.reserve(lease=0)
+        job = queue.reserve()
+        self.assertEquals(2, job.attempts)
+
+    def test_expired_lease_out_of_attempts_fails_job(self):
+        """ Job never acknowledged is failed once out of attempts """
+        queue = SqliteJobQueue(self.db, max_attempts=2)
+        queue.put('resize', dict(url='one'))
+        self.assertEquals(1, queue.reserve(lease=0).attempts)
+        self.assertEquals(2, queue.reserve(lease=0).attempts)
+        self.assertIsNone(queue.reserve())
+        self.assertEquals(1, queue.count('failed'))
+        self.assertEquals(0, queue.count('reserved'))
+
+    def test_failed_job_is_retried_then_failed(self):
+        """ Failing job retries with backoff until out of attempts """
+        queue = SqliteJobQueue(self.db, max_attempts=2, retry_delay=0)
+        queue.put('resize', dict(url='one'))
+        self.assertTrue(queue.fail(queue.reserve(), 'error'))
+        job = queue.reserve()
+        self.assertEquals(2, job.attempts)
+        self.assertFalse(queue.fail(job, 'error'))
+        self.assertIsNone(queue.reserve())
+        self.assertEquals(1, queue.count('failed'))
+
+
+@attr('jobs', 'worker')
+class WorkerTests(TestCase, LocalStorageTestHelpers):
+    """ Resize worker tests """
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    def get_storage(self):
+        queue = SqliteJobQueue(os.path.join(self.tmp_path, 'jobs.sqlite'))
+        return Storage(
+            BackendLocal(self.path),
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            queue=queue
+        )
+
+    def test_load_factory(self):
+        """ Loading storage factory by import path """
+        factory = load_factory('shiftmedia.utils:generate_id')
+        self.assertTrue(callable(factory))
+        with assert_raises(x.ConfigurationException):
+            load_factory('shiftmedia.utils')
+
+    def test_enqueue_raises_without_queue(self):
+        """ Enqueuing raises when no queue configured """
+        storage = Storage(mock.MagicMock(), '123', self.tmp_path)
+        with assert_raises(x.ConfigurationException):
+            storage.enqueue_resize('url')
+
+    def test_worker_processes_resize_and_warmup_jobs(self):
+        """ Worker processes resize and warmup jobs """
+        self.prepare_uploads()
+        storage = self.get_storage()
+        storage.add_preset('card', '100x100', 'fill')
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        id = storage.put(src)
+        resize_url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        storage.enqueue_resize(resize_url)
+        storage.enqueue_warmup(id, ['card'])
+        storage.enqueue_resize(resize_url + 'CRAP')
+
+        def factory():
+            result = self.get_storage()
+            result.add_preset('card', '100x100', 'fill')
+            return result
+
+        worker = Worker(factory)
+        self.assertEquals(3, worker.work(max_jobs=10))
+        self.assertEquals(2, worker.processed)
+        self.assertEquals(1, worker.failed)
+
+        path = os.path.join(self.path, *storage.backend.id_to_path(id))
+        card_url = storage.get_preset_url(id, 'card')
+        for url in [resize_url, card_url]:
+            self.assertTrue(os.path.exists(
+                os.path.join(path, url.split('/')[-1])
+            ))
+        self.assertEquals(1, storage.queue.count())
+
+    def test_pipelined_worker_processes_jobs(self):
+        """ Worker processes jobs in a staged pipeline """
+        self.prepare_uploads()
+        storage = self.get_storage()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        id = storage.put(src)
+        urls = [
+            storage.get_auto_crop_url(id, size, 'fill')
+            for size in ['100x200', '50x50', '20x30']
+        ]
+        for url in urls:
+            storage.enqueue_resize(url)
+        storage.enqueue_resize(urls[0] + 'CRAP')
+
+        worker = Worker(self.get_storage, pipeline=dict(fetchers=2))
+        self.assertEquals(4, worker.work(max_jobs=10))
+        self.assertEquals(3, worker.processed)
+        self.assertEquals(1, worker.failed)
+
+        path = os.path.join(self.path, *storage.backend.id_to_path(id))
+        for url in urls:
+            self.assertTrue(os.path.exists(
+                os.path.join(path, url.split('/')[-1])
+            ))
+        self.assertEquals(1, storage.queue.count())
+        self.assertEquals(1, storage.queue.count('queued'))
+
+    def test_worker_gives_up_on_processes_crashing_at_startup(self):
+        """ Processes dying at startup are respawned with backoff """
+        worker = Worker(mock.Mock(), max_crashes=2)
+        worker.SUPERVISE_INTERVAL = 0.01
+        worker.RESPAWN_DELAY = 0.05
+        worker.warm = mock.Mock()
+        worker.child = lambda: os._exit(1)
+        spawn = mock.Mock(wraps=worker.spawn)
+        numbers = [signal.SIGTERM, signal.SIGINT]
+        handlers = [signal.getsignal(number) for number in numbers]
+        try:
+            with mock.patch.object(worker, 'spawn', spawn):
+                started = time.monotonic()
+                with assert_raises(x.WorkerCrashed):
+                    worker.run()
+                elapsed = time.monotonic() - started
+        finally:
+            for number, handler in zip(numbers, handlers):
+                signal.signal(number, handler)
+        self.assertEquals(3, spawn.call_count)
+        self.assertTrue(elapsed >= 0.1 + 0.2)
+        self.assertEquals(0.5, Worker(None).respawn_delay(0))
+        self.assertEquals(60, Worker(None).respawn_delay(10))
@@ -0,0 +1,98 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+from shiftmedia import utils
+from shiftmedia import exceptions as x
+from shiftmedia.paths import PathBuilder
+from shiftmedia.ladder import SizeLadder
+
+
+@attr('ladder')
+class SizeLadderTests(TestCase):
+    """ Size ladder tests """
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_ladder(self):
+        """ Instantiating size ladder """
+        ladder = SizeLadder(rungs=[640, 320, 320, 1280])
+        self.assertIsInstance(ladder, SizeLadder)
+        self.assertEquals([320, 640, 1280], ladder.rungs)
+
+    def test_ladder_requires_step_or_rungs(self):
+        """ Ladder raises on bad configuration """
+        with assert_raises(x.ConfigurationException):
+            SizeLadder()
+        with assert_raises(x.ConfigurationException):
+            SizeLadder(step=-0.1)
+        with assert_raises(x.ConfigurationException):
+            SizeLadder(rungs=[0, 100])
+
+    def test_geometric_ladder(self):
+        """ Geometric ladder grows by step between min and max size """
+        ladder = SizeLadder(step=0.08, min_size=100, max_size=1000)
+        self.assertEquals(100, ladder.rungs[0])
+        self.assertEquals(1000, ladder.rungs[-1])
+        self.assertEquals(108, ladder.rungs[1])
+        self.assertTrue(len(ladder.rungs) < 40)
+
+        small = SizeLadder(step=0.01, min_size=1, max_size=10)
+        self.assertEquals(list(range(1, 11)), small.rungs)
+
+    def test_snap_to_nearest_rung(self):
+        """ Dimensions snap to nearest rung and to ladder ends """
+        ladder = SizeLadder(rungs=[100, 200, 400])
+        self.assertEquals(100, ladder.snap(1))
+        self.assertEquals(100, ladder.snap(149))
+        self.assertEquals(200, ladder.snap(150))
+        self.assertEquals(200, ladder.snap(200))
+        self.assertEquals(400, ladder.snap(5000))
+
+    def test_snap_size_keeps_aspect_ratio(self):
+        """ Longer side snaps to a rung, the other keeps aspect ratio """
+        ladder = SizeLadder(rungs=[320, 640, 960, 1280, 1920])
+        self.assertEquals('1280x720', ladder.snap_size('1280x720'))
+        self.assertEquals('320x240', ladder.snap_size('400x300'))
+        self.assertEquals('1920x1080', ladder.snap_size('1900x1069'))
+        self.assertEquals('216x320', ladder.snap_size('270x400'))
+        self.assertEquals('320x320', ladder.snap_size('350x350'))
+        self.assertEquals('1920x1', ladder.snap_size('5000x1'))
+        self.assertTrue(ladder.contains(1280, 720))
+        self.assertFalse(ladder.contains(1200, 720))
+
+    def test_auto_crop_filenames_are_snapped(self):
+        """ Sizes of same aspect ratio a few pixels apart share a filename """
+        id = utils.generate_id('original.jpg')
+        ladder = SizeLadder(step=0.08)
+        pb = PathBuilder('12345', ladder=ladder)
+        filenames = set()
+        for width in range(300, 311):
+            size = '{}x{}'.format(width, round(width * 2 / 3))
+            filenames.add(pb.get_auto_crop_filename(id, size, 'fill'))
+        self.assertTrue(len(filenames) <= 2)
+        for filename in filenames:
+            params = pb.parse_filename(id, filename)
+            self.assertTrue(ladder.contains(params.width, params.height))
+
+    def test_strict_ladder_refuses_off_ladder_sizes(self):
+        """ Strict ladder rejects filenames with off-ladder sizes """
+        id = utils.generate_id('original.jpg')
+        unsnapped = PathBuilder('12345')
+        off = unsnapped.get_auto_crop_filename(id, '123x457', 'fill')
+        on = unsnapped.get_auto_crop_filename(id, '123x400', 'fill')
+
+        lenient = PathBuilder('12345', ladder=SizeLadder(rungs=[100, 400]))
+        self.assertEquals(123, lenient.parse_filename(id, off).width)
+
+        ladder = SizeLadder(rungs=[100, 400], strict=True)
+        pb = PathBuilder('12345', ladder=ladder)
+        self.assertEquals(123, pb.parse_filename(id, on).width)
+        with assert_raises(x.InvalidArgumentException):
+            pb.parse_filename(id, off)
+
+        # manual crops are not snapped
+        manual = pb.get_manual_crop_filename(id, '123x457', '123x457')
+        self.assertEquals(123, pb.parse_filename(id, manual).width)
@@ -0,0 +1,105 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os, json, time, multiprocessing
+from shiftmedia.locks import FileLockManager
+from shiftmedia import exceptions as x
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+def hold_lock(path, key, ready, release):
+    """ Acquire lock in a separate process and hold it until told """
+    locks = FileLockManager(path)
+    with locks.lock(key):
+        ready.set()
+        release.wait(5)
+
+
+@attr('locks')
+class FileLockManagerTests(TestCase, LocalStorageTestHelpers):
+    """ File lock manager tests """
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    @property
+    def locks_path(self):
+        return os.path.join(self.tmp_path, '.locks')
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_lock_manager(self):
+        """ Instantiating file lock manager """
+        locks = FileLockManager(self.locks_path)
+        self.assertIsInstance(locks, FileLockManager)
+
+    def test_acquire_and_release(self):
+        """ Acquiring and releasing lock """
+        locks = FileLockManager(self.locks_path)
+        lock = locks.acquire('id/filename.jpg')
+        path = locks.key_to_path('id/filename.jpg')
+        self.assertTrue(os.path.exists(path))
+        with open(path) as file:
+            self.assertEquals(lock.token, json.load(file)['token'])
+        locks.release(lock)
+        self.assertFalse(os.path.exists(path))
+
+    def test_acquire_times_out_when_held_by_another_process(self):
+        """ Lock held by another process can not be acquired """
+        ctx = multiprocessing.get_context('fork')
+        ready = ctx.Event()
+        release = ctx.Event()
+        key = 'id/filename.jpg'
+        args = (self.locks_path, key, ready, release)
+        process = ctx.Process(target=hold_lock, args=args)
+        process.start()
+        try:
+            self.assertTrue(ready.wait(5))
+            locks = FileLockManager(self.locks_path, poll=0.01)
+            with assert_raises(x.LockTimeout):
+                locks.acquire(key, timeout=0.1)
+        finally:
+            release.set()
+            process.join(5)
+
+        with locks.lock(key, timeout=1) as lock:
+            self.assertFalse(lock.expired)
+
+    def test_expired_lease_is_taken_over(self):
+        """ Expired lease left by another host is taken over """
+        locks = FileLockManager(self.locks_path)
+        key = 'id/filename.jpg'
+        lease = dict(token='other', expires=time.time() - 1, host='other')
+        with open(locks.key_to_path(key), 'w') as file:
+            json.dump(lease, file)
+        lock = locks.acquire(key, timeout=0.1)
+        self.assertNotEqual('other', lock.token)
+        locks.release(lock)
+
+    def test_live_lease_from_another_host_blocks(self):
+        """ Unexpired lease held on another host blocks acquisition """
+        locks = FileLockManager(self.locks_path, poll=0.01)
+        key = 'id/filename.jpg'
+        lease = dict(token='other', expires=time.time() + 60, host='other')
+        with open(locks.key_to_path(key), 'w') as file:
+            json.dump(lease, file)
+        with assert_raises(x.LockTimeout):
+            locks.acquire(key, timeout=0.05)
+
+    def test_refresh_extends_lease(self):
+        """ Refreshing lock extends its lease """
+        locks = FileLockManager(self.locks_path, lease=1)
+        lock = locks.acquire('key')
+        expires = lock.expires
+        time.sleep(0.01)
+        locks.refresh(lock)
+        self.assertTrue(lock.expires > expires)
+        locks.release(lock)
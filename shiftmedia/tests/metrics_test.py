@@ -0,0 +1,176 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os
+from shiftmedia import Storage, BackendLocal
+from shiftmedia import metrics
+from shiftmedia.cache import VariantCache
+from shiftmedia.server import ResizeServer
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('metrics')
+class MetricsTests(TestCase, LocalStorageTestHelpers):
+    """ Metrics instrumentation tests """
+
+    def setUp(self):
+        super().setUp()
+        self.registry = metrics.Registry()
+        self.previous = metrics.set_sink(self.registry)
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        metrics.set_sink(self.previous)
+        self.clean()
+        super().tearDown()
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_null_sink_is_default(self):
+        """ Metrics are dropped unless sink is configured """
+        metrics.set_sink(None)
+        self.assertIsInstance(metrics.get_sink(), metrics.NullSink)
+        self.assertFalse(metrics.enabled())
+        timer = metrics.timer('anything', stage='one')
+        self.assertIs(timer, metrics.timer('other'))
+        with timer:
+            metrics.increment('anything')
+
+    def test_registry_counts_and_times(self):
+        """ Registry keeps counters and timings per labels """
+        metrics.increment('jobs_total', result='ok')
+        metrics.increment('jobs_total', 2, result='ok')
+        metrics.increment('jobs_total', result='failed')
+        with metrics.timer('job_seconds', stage='one'):
+            pass
+        registry = self.registry
+        self.assertEquals(3, registry.get_counter('jobs_total', result='ok'))
+        timing = registry.get_timing('job_seconds', stage='one')
+        self.assertEquals(1, timing[0])
+        self.assertEquals((0, 0.0), registry.get_timing('job_seconds'))
+
+    def test_timer_records_failed_blocks(self):
+        """ Timer records duration when block raises """
+        with assert_raises(ValueError):
+            with metrics.timer('job_seconds'):
+                raise ValueError()
+        self.assertEquals(1, self.registry.get_timing('job_seconds')[0])
+
+    def test_render_prometheus_text(self):
+        """ Rendering registry in Prometheus text format """
+        registry = metrics.Registry(buckets=(0.1, 1))
+        registry.increment('files_total', 2, dict(kind='a"b'))
+        registry.timing('op_seconds', 0.5, dict(op='put'))
+        registry.timing('op_seconds', 2, dict(op='put'))
+        expected = '\n'.join([
+            '# TYPE files_total counter',
+            'files_total{kind="a\\"b"} 2',
+            '# TYPE op_seconds histogram',
+            'op_seconds_bucket{op="put",le="0.1"} 0',
+            'op_seconds_bucket{op="put",le="1"} 1',
+            'op_seconds_bucket{op="put",le="+Inf"} 2',
+            'op_seconds_sum{op="put"} 2.5',
+            'op_seconds_count{op="put"} 2',
+        ]) + '\n'
+        self.assertEquals(expected, registry.render())
+        registry.reset()
+        self.assertEquals('', registry.render())
+
+    def test_resize_stages_are_timed(self):
+        """ Creating resize reports every stage """
+        self.prepare_uploads()
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            variant_cache=VariantCache(1024 * 1024)
+        )
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        storage.create_resize(url)
+        storage.create_resize(url)
+
+        stages = [
+            'retrieve',
+            'decode',
+            'crop',
+            'encode',
+            'store',
+            'create_resize'
+        ]
+        for stage in stages:
+            timing = self.registry.get_timing(
+                metrics.STAGE_SECONDS,
+                stage=stage
+            )
+            self.assertEquals(1, timing[0], stage)
+
+        get = self.registry.get_counter
+        self.assertEquals(1, get(metrics.RESIZES, result='created'))
+        self.assertEquals(1, get(metrics.VARIANT_CACHE, result='hit'))
+        self.assertEquals(1, get(metrics.VARIANT_CACHE, result='miss'))
+
+        put = dict(backend='local', operation='put_variant')
+        self.assertEquals(2, self.registry.get_timing(
+            metrics.BACKEND_SECONDS,
+            **put
+        )[0])
+        self.assertTrue(get(metrics.BACKEND_BYTES, **put) > 0)
+        retrieved = get(
+            metrics.BACKEND_BYTES,
+            backend='local',
+            operation='retrieve_original'
+        )
+        self.assertTrue(retrieved > 0)
+
+    def test_resizes_are_uninstrumented_by_default(self):
+        """ Resizes collect stats with null sink only if asked for result """
+        metrics.set_sink(None)
+        self.prepare_uploads()
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        put_variant = backend.put_variant
+        instrumented = []
+
+        def put(*args, **kwargs):
+            instrumented.append(metrics.enabled())
+            return put_variant(*args, **kwargs)
+
+        with mock.patch.object(backend, 'put_variant', put):
+            storage.create_resize(url)
+            result = storage.create_resize(url, result=True)
+        self.assertEquals([False, True], instrumented)
+        self.assertIn('create_resize', result.durations)
+        self.assertTrue(result.elapsed > 0)
+
+    def test_server_exposes_metrics(self):
+        """ Resize server renders registry at metrics path """
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        metrics.increment('files_total')
+        app = ResizeServer(storage, metrics_path='/metrics')
+        environ = dict(PATH_INFO='/metrics', REQUEST_METHOD='GET')
+        start_response = mock.Mock()
+        body = b''.join(app(environ, start_response))
+        self.assertEquals('200 OK', start_response.call_args[0][0])
+        self.assertIn(b'files_total 1', body)
+
+        metrics.set_sink(None)
+        app(environ, start_response)
+        self.assertEquals('404 Not Found', start_response.call_args[0][0])
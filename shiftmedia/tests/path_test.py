@@ -3,7 +3,7 @@ from nose.plugins.attrib import attr
 from nose.tools import assert_raises
 
 from shiftmedia import utils
-from shiftmedia.paths import PathBuilder
+from shiftmedia.paths import PathBuilder, ResizeParams, ResizeMode
 from shiftmedia import exceptions as x
 
 
@@ -272,6 +272,68 @@ class PathBuilderTests(TestCase):
         self.assertEquals(params['quality'], result['quality'])
         self.assertEquals(params['upscale'], result['upscale'])
 
+    def test_add_preset(self):
+        """ Registering named preset """
+        pb = PathBuilder('12345')
+        pb.add_preset('card', '300x200', 'fill', quality=80)
+        id = utils.generate_id('test.jpg')
+        filename = pb.get_preset_filename(id, 'card')
+        signature = pb.generate_signature(id, 'card.jpg')
+        self.assertEquals('card-' + signature + '.jpg', filename)
+
+    def test_parse_preset_filename(self):
+        """ Parsing short preset filename gives preset parameters """
+        pb = PathBuilder('12345')
+        pb.add_preset('avatar@2x', '100x100', 'fit', 'PNG', False, 90)
+        id = utils.generate_id('test.jpg')
+        filename = pb.get_preset_filename(id, 'avatar@2x')
+        self.assertTrue(filename.startswith('avatar@2x-'))
+        self.assertTrue(filename.endswith('.png'))
+
+        params = pb.parse_filename(id, filename)
+        self.assertEquals('avatar@2x', params.preset)
+        self.assertEquals((100, 100), params.size)
+        self.assertEquals('fit', params.factor)
+        self.assertEquals(90, params.quality)
+        self.assertFalse(params.upscale)
+        self.assertEquals('png', params.output_format)
+
+        bad = [
+            filename.replace('avatar@2x', 'other'),
+            filename.replace('.png', '.jpg'),
+            'avatar@2x-' + '0' * 32 + '.png',
+        ]
+        for filename in bad:
+            with assert_raises(x.InvalidArgumentException):
+                pb.parse_filename(id, filename)
+
+    def test_strict_presets(self):
+        """ Strict path builder only parses preset filenames """
+        pb = PathBuilder('12345', strict_presets=True)
+        pb.add_preset('card', '300x200')
+        id = utils.generate_id('test.jpg')
+        pb.parse_filename(id, pb.get_preset_filename(id, 'card'))
+        filename = pb.get_auto_crop_filename(id, '300x200', 'fill')
+        with assert_raises(x.InvalidArgumentException):
+            pb.parse_filename(id, filename)
+
+    def test_add_preset_raises_on_bad_name_or_params(self):
+        """ Registering preset raises on bad name or parameters """
+        pb = PathBuilder('12345')
+        with assert_raises(x.InvalidArgumentException):
+            pb.add_preset('bad-name', '300x200')
+        with assert_raises(x.InvalidArgumentException):
+            pb.add_preset('card', '300xCRAP')
+        with assert_raises(x.InvalidArgumentException):
+            pb.add_preset('Card', '300x200')
+        self.assertEquals({}, pb.presets)
+
+    def test_get_preset_filename_raises_on_unknown_preset(self):
+        """ Getting filename for unknown preset raises """
+        pb = PathBuilder('12345')
+        with assert_raises(x.InvalidArgumentException):
+            pb.get_preset_filename(utils.generate_id('test.jpg'), 'nope')
+
     """
     PLEASE NOTE: the following is just for fun and is in fact excessive and
     redundant - it can never happen in real life because you can not
@@ -280,6 +342,26 @@ class PathBuilderTests(TestCase):
     simulate malformed but signed file names.
     """
 
+    def test_get_auto_crop_filenames_in_bulk(self):
+        """ Bulk filenames are the same as ones built one by one """
+        id = utils.generate_id('original.jpg')
+        pb = PathBuilder('12345')
+        sizes = ['100x200', '200x400', '300x600']
+        filenames = pb.get_auto_crop_filenames(id, sizes, 'fit', 'png')
+        expected = []
+        for size in sizes:
+            expected.append(pb.get_auto_crop_filename(id, size, 'fit', 'png'))
+        self.assertEquals(expected, filenames)
+        for filename in filenames:
+            self.assertTrue(pb.validate_signature(id, filename))
+
+    def test_get_auto_crop_filenames_validates_every_size(self):
+        """ Bulk filenames raise on any bad size """
+        id = utils.generate_id('original.jpg')
+        pb = PathBuilder('12345')
+        with assert_raises(x.InvalidArgumentException):
+            pb.get_auto_crop_filenames(id, ['100x200', '100xZ'], 'fit')
+
     def test_resize_filename_parser_raises_on_bad_mode(self):
         """ Resize filename parser raises if mode is neither manual nor auto """
         id = utils.generate_id('test.jpg')
@@ -334,11 +416,98 @@ class PathBuilderTests(TestCase):
         with assert_raises(x.InvalidArgumentException):
             pb.filename_to_resize_params(id, signed_filename)
 
-
-
-
-
-
-
-
+    def test_parse_filename_returns_typed_params(self):
+        """ Parsing filename returns typed resize parameters """
+        id = utils.generate_id('original.jpg')
+        pb = PathBuilder('12345')
+        filename = pb.get_auto_crop_filename(
+            id,
+            '100x200',
+            'fit',
+            'webp',
+            upscale=False,
+            quality=80
+        )
+        params = pb.parse_filename(id, filename)
+        self.assertIsInstance(params, ResizeParams)
+        self.assertIs(ResizeMode.AUTO, params.mode)
+        self.assertEquals((100, 200), params.size)
+        self.assertEquals('fit', params.factor)
+        self.assertEquals(80, params.quality)
+        self.assertFalse(params.upscale)
+        self.assertEquals('webp', params.output_format)
+        self.assertEquals('100x200', params['target_size'])
+        self.assertEquals(params.to_dict(), pb.filename_to_resize_params(
+            id,
+            filename
+        ))
+
+        manual = pb.get_manual_crop_filename(id, '200x400', '100x200')
+        params = pb.parse_filename(id, manual)
+        self.assertIs(ResizeMode.MANUAL, params.mode)
+        self.assertEquals('200x400', params.sample_size)
+
+    def test_parsed_params_are_immutable_and_memoized(self):
+        """ Parsed parameters are immutable and remembered """
+        id = utils.generate_id('original.jpg')
+        pb = PathBuilder('12345')
+        filename = pb.get_auto_crop_filename(id, '100x200', 'fill')
+        params = pb.parse_filename(id, filename)
+        self.assertIs(params, pb.parse_filename(id, filename))
+        with assert_raises(AttributeError):
+            params.width = 500
+        with assert_raises(AttributeError):
+            params.other = 'value'
+
+    def test_malformed_filenames_are_rejected_without_hashing(self):
+        """ Malformed filenames never reach the signer """
+        id = utils.generate_id('original.jpg')
+        signer = mock.MagicMock()
+        pb = PathBuilder('12345', signer=signer)
+        bad = [
+            '100x200-fill-65-upscale.jpg',
+            '100x200-stretch-65-upscale-abc123.jpg',
+            '100x0-fill-65-upscale-abc123.jpg',
+            '100x200-fill-65-upscale-abc123',
+            '../../etc/passwd',
+            '9' * 5000 + 'x1-fill-65-upscale-abc123.jpg',
+        ]
+        for filename in bad:
+            with assert_raises(x.InvalidArgumentException):
+                pb.parse_filename(id, filename)
+        signer.verify.assert_not_called()
+
+    def test_auto_crop_filenames_are_canonical(self):
+        """ Equivalent parameters produce the same filename """
+        id = utils.generate_id('original.jpg')
+        pb = PathBuilder('12345')
+        canonical = pb.get_auto_crop_filename(id, '100x200', 'fill')
+        same = [
+            pb.get_auto_crop_filename(id, '100X200', 'fill'),
+            pb.get_auto_crop_filename(id, '0100x0200', 'fill'),
+            pb.get_auto_crop_filename(id, '100x200', 'fill', 'jpg'),
+            pb.get_auto_crop_filename(id, '100x200', 'fill', 'JPEG'),
+        ]
+        for filename in same:
+            self.assertEquals(canonical, filename)
+
+        png = pb.get_auto_crop_filename(id, '100x200', 'fill', 'png', True, 10)
+        self.assertEquals(png, pb.get_auto_crop_filename(
+            id,
+            '100x200',
+            'fill',
+            'png',
+            True,
+            90
+        ))
+
+    def test_get_canonical_filename(self):
+        """ Getting canonical filename of a parsed resize """
+        id = utils.generate_id('original.jpg')
+        pb = PathBuilder('12345')
+        upscale = pb.get_auto_crop_filename(id, '100x200', 'fill')
+        no_upscale = pb.get_auto_crop_filename(id, '100x200', 'fill', None, 0)
+        params = pb.parse_filename(id, no_upscale)
+        self.assertEquals(no_upscale, pb.get_canonical_filename(params))
+        self.assertEquals(upscale, pb.get_canonical_filename(params, False))
 
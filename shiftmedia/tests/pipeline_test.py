@@ -0,0 +1,170 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os, time, threading
+from shiftmedia import Storage, BackendLocal
+from shiftmedia import exceptions as x
+from shiftmedia.index import VariantIndex
+from shiftmedia.jobs import Job
+from shiftmedia.pipeline import Pipeline
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+class BlockingPipeline(Pipeline):
+    """ Pipeline doing no work, with store stage blocked until released """
+
+    def __init__(self, *args, **kwargs):
+        self.release = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def fetch(self, task):
+        return False
+
+    def compute(self, task):
+        return False
+
+    def store(self, task):
+        self.release.wait(5)
+        return True
+
+
+@attr('pipeline')
+class PipelineTests(TestCase, LocalStorageTestHelpers):
+    """ Staged pipeline tests """
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    def get_storage(self, **kwargs):
+        """ Get storage with a test image put to it """
+        self.prepare_uploads()
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            **kwargs
+        )
+        storage.add_preset('card', '100x100', 'fill')
+        storage.add_preset('thumb', '40x40', 'fill')
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        return storage, storage.put(src)
+
+    def variant_path(self, storage, url):
+        """ Get local path of a variant """
+        id, filename = storage.backend.parse_url(url)
+        parts = storage.backend.id_to_path(id)
+        return os.path.join(self.path, *parts, filename)
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_pipeline(self):
+        """ Instantiating pipeline """
+        pipeline = Pipeline(mock.MagicMock())
+        self.assertIsInstance(pipeline, Pipeline)
+        pipeline.close()
+        with assert_raises(x.ConfigurationException):
+            pipeline.submit(Job(1, 'resize', dict()))
+        with assert_raises(x.ConfigurationException):
+            Pipeline(mock.MagicMock(), computers=0)
+
+    def test_process_jobs(self):
+        """ Pipeline processes resize and warmup jobs """
+        storage, id = self.get_storage()
+        resize = storage.get_auto_crop_url(id, '100x200', 'fill')
+        jobs = [
+            Job(1, 'resize', dict(url=resize)),
+            Job(2, 'warmup', dict(id=id, presets=['card', 'thumb'])),
+            Job(3, 'resize', dict(url=resize + 'CRAP')),
+            Job(4, 'unknown', dict()),
+        ]
+        done = dict()
+
+        def callback(job, error):
+            done[job.id] = error
+
+        pipeline = Pipeline(storage, fetchers=2, computers=2, storers=2)
+        for job in jobs:
+            pipeline.submit(job, callback)
+        self.assertTrue(pipeline.join(10))
+        pipeline.close()
+
+        self.assertIsNone(done[1])
+        self.assertIsNone(done[2])
+        self.assertIsInstance(done[3], Exception)
+        self.assertIsInstance(done[4], x.NotImplementedError)
+        stats = pipeline.stats()
+        self.assertEquals(2, stats['completed'])
+        self.assertEquals(2, stats['failed'])
+        self.assertEquals(0, stats['pending'])
+
+        urls = [
+            resize,
+            storage.get_preset_url(id, 'card'),
+            storage.get_preset_url(id, 'thumb')
+        ]
+        for url in urls:
+            self.assertTrue(os.path.exists(self.variant_path(storage, url)))
+
+        # scratch directories are cleaned up
+        root = storage.workspace.root
+        self.assertEquals([], os.listdir(root))
+
+    def test_resize_jobs_are_mapped_to_canonical_resizes(self):
+        """ Pipeline renders canonical resize and skips existing ones """
+        storage, id = self.get_storage()
+        storage.index = VariantIndex(storage.backend)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill', upscale=False)
+        canonical = storage.get_auto_crop_url(id, '100x200', 'fill')
+        self.assertNotEqual(url, canonical)
+
+        pipeline = Pipeline(storage)
+        pipeline.submit(Job(1, 'resize', dict(url=url)))
+        pipeline.join(10)
+        self.assertTrue(os.path.exists(self.variant_path(storage, canonical)))
+        self.assertFalse(os.path.exists(self.variant_path(storage, url)))
+
+        with mock.patch.object(storage, 'retrieve_original') as retrieve:
+            pipeline.submit(Job(2, 'resize', dict(url=canonical)))
+            pipeline.submit(Job(3, 'resize', dict(url=url)))
+            pipeline.join(10)
+            retrieve.assert_not_called()
+        pipeline.close()
+        self.assertEquals(3, pipeline.stats()['completed'])
+
+    def test_backpressure(self):
+        """ Slow stage eventually blocks submitting jobs """
+        pipeline = BlockingPipeline(
+            mock.MagicMock(),
+            fetchers=1,
+            computers=1,
+            storers=1,
+            depth=1
+        )
+
+        def submit():
+            for index in range(10):
+                pipeline.submit(Job(index, 'resize', dict()))
+
+        submitter = threading.Thread(target=submit, daemon=True)
+        submitter.start()
+        time.sleep(0.2)
+
+        # one job in every stage, one in front of every stage and one
+        # being submitted
+        self.assertTrue(submitter.is_alive())
+        stats = pipeline.stats()
+        self.assertEquals(7, stats['pending'])
+        self.assertEquals(7, stats['submitted'])
+        self.assertEquals(0, stats['completed'])
+
+        pipeline.release.set()
+        submitter.join(5)
+        self.assertTrue(pipeline.join(5))
+        pipeline.close()
+        self.assertEquals(10, pipeline.stats()['completed'])
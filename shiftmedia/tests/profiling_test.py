@@ -0,0 +1,148 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os, json
+from shiftmedia import Storage, BackendLocal
+from shiftmedia import profiling
+from shiftmedia import exceptions as x
+from shiftmedia.profiling import Profiler
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('profiling')
+class ProfilingTests(TestCase, LocalStorageTestHelpers):
+    """ Profiling hook tests """
+
+    def setUp(self):
+        super().setUp()
+        self.previous = profiling.set_profiler(None)
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        profiling.set_profiler(self.previous)
+        self.clean()
+        super().tearDown()
+
+    @property
+    def reports_path(self):
+        """ Get path to write profiling reports to """
+        return os.path.join(self.tmp_path, 'profiles')
+
+    def reports(self):
+        """ Load written reports """
+        if not os.path.isdir(self.reports_path):
+            return []
+        reports = []
+        for name in sorted(os.listdir(self.reports_path)):
+            if name.endswith('.json'):
+                with open(os.path.join(self.reports_path, name)) as file:
+                    reports.append(json.load(file))
+        return reports
+
+    def create_storage(self):
+        """ Create storage with a test image put to it """
+        self.prepare_uploads()
+        storage = Storage(
+            BackendLocal(self.path),
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        return storage, storage.put(src)
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_profiling_is_off_by_default(self):
+        """ Without profiler nothing is captured """
+        with profiling.profile('anything', a=1) as capture:
+            capture.annotate(b=2)
+            profiling.annotate(c=3)
+        self.assertEquals([], self.reports())
+
+    def test_fast_unsampled_calls_are_not_reported(self):
+        """ Calls neither sampled nor slow leave no reports """
+        profiler = Profiler(self.reports_path, sample_rate=0, threshold=10)
+        with profiler.profile('fast') as capture:
+            pass
+        self.assertFalse(capture.sampled)
+        self.assertIsNone(capture.report)
+        self.assertEquals(0, profiler.reports)
+
+    def test_slow_calls_are_always_reported(self):
+        """ Calls over threshold are reported with context """
+        profiler = Profiler(self.reports_path, sample_rate=0, threshold=0)
+        with profiler.profile('slow', dict(id='abc')) as capture:
+            with profiler.profile('nested', dict(filename='f.jpg')):
+                pass
+        reports = self.reports()
+        self.assertEquals(1, len(reports))
+        self.assertEquals('slow', reports[0]['name'])
+        self.assertTrue(reports[0]['slow'])
+        self.assertFalse(reports[0]['sampled'])
+        self.assertIsNone(reports[0]['stats'])
+        expected = dict(id='abc', filename='f.jpg')
+        self.assertEquals(expected, reports[0]['context'])
+
+    def test_sampled_calls_are_profiled(self):
+        """ Sampled calls get profiler and memory stats """
+        profiler = Profiler(
+            self.reports_path,
+            sample_rate=1,
+            threshold=10,
+            memory=True
+        )
+        with profiler.profile('sampled') as capture:
+            data = [bytes(1024) for i in range(100)]
+        report = self.reports()[0]
+        self.assertTrue(report['sampled'])
+        self.assertFalse(report['slow'])
+        self.assertIn('function calls', report['stats'])
+        self.assertTrue(os.path.isfile(report['profile']))
+        self.assertTrue(report['memory']['peak'] >= 100 * 1024)
+
+    def test_errors_are_reported(self):
+        """ Failed calls are reported with their error """
+        profiler = Profiler(self.reports_path, threshold=0)
+        with assert_raises(ValueError):
+            with profiler.profile('failing'):
+                raise ValueError('boom')
+        self.assertIn('boom', self.reports()[0]['error'])
+
+    def test_create_resize_is_captured_and_replayable(self):
+        """ Capturing resize with parameters and replaying it """
+        storage, id = self.create_storage()
+        profiler = Profiler(self.reports_path, threshold=0)
+        profiling.set_profiler(profiler)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        storage.create_resize(url)
+
+        reports = self.reports()
+        self.assertEquals(1, len(reports))
+        context = reports[0]['context']
+        self.assertEquals('create_resize', reports[0]['name'])
+        self.assertEquals(id, context['id'])
+        self.assertEquals('100x200', context['params']['target_size'])
+        self.assertEquals(248, context['source']['width'])
+        self.assertEquals(768, context['source']['height'])
+
+        report = os.path.join(
+            self.reports_path,
+            [n for n in os.listdir(self.reports_path) if n.endswith('json')][0]
+        )
+        replayed = profiler.replay(report, storage)
+        with open(replayed) as file:
+            replay = json.load(file)
+        self.assertTrue(replay['sampled'])
+        self.assertEquals(report, replay['context']['replay_of'])
+
+    def test_replay_requires_resize_report(self):
+        """ Replaying report without storage resize raises """
+        storage, id = self.create_storage()
+        profiler = Profiler(self.reports_path, threshold=0)
+        with profiler.profile('something') as capture:
+            pass
+        with assert_raises(x.InvalidArgumentException):
+            profiler.replay(capture.report, storage)
@@ -206,6 +206,29 @@ class AutocropIntegrationTests(TestCase, LocalStorageTestHelpers):
         self.assertEquals(300, result.size[1])
         # result.show()
 
+    def test_upscale_makes_no_difference_for_bigger_original(self):
+        """ Fill of a bigger original is identical with or without upscale """
+        img = self.files['vertical']  # 248x768
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, img['file'])
+        mode = Resizer.RESIZE_TO_FILL
+        for size in ['200x300', '123x457', '247x767']:
+            upscale = Resizer.auto_crop_img(src, size, mode, True)
+            no_upscale = Resizer.auto_crop_img(src, size, mode, False)
+            self.assertEquals(upscale.tobytes(), no_upscale.tobytes())
+            matters = Resizer.upscale_matters(img['size'], upscale.size, mode)
+            self.assertFalse(matters)
+
+    def test_upscale_matters(self):
+        """ Detecting whether upscale changes the result """
+        fill = Resizer.RESIZE_TO_FILL
+        fit = Resizer.RESIZE_TO_FIT
+        self.assertFalse(Resizer.upscale_matters((300, 300), (200, 200), fill))
+        self.assertTrue(Resizer.upscale_matters((300, 100), (200, 200), fill))
+        self.assertTrue(Resizer.upscale_matters((100, 100), (200, 200), fill))
+        self.assertFalse(Resizer.upscale_matters((300, 100), (200, 200), fit))
+        self.assertTrue(Resizer.upscale_matters((100, 100), (200, 200), fit))
+
     # ------------------------------------------------------------------------
     # Image manipulation tests: GIF animations
     # ------------------------------------------------------------------------
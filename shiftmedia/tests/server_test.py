@@ -0,0 +1,209 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import io, os, threading
+from wsgiref.util import setup_testing_defaults
+from shiftmedia import Storage, BackendLocal
+from shiftmedia.budget import MemoryBudget
+from shiftmedia.cache import VariantCache
+from shiftmedia.server import ResizeServer
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('server')
+class ResizeServerTests(TestCase, LocalStorageTestHelpers):
+    """ Resize server tests """
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    def create_storage(self, **kwargs):
+        """ Create storage with a test image put to it """
+        self.prepare_uploads()
+        backend = BackendLocal(self.path, url='http://localhost/media')
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            **kwargs
+        )
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        id = storage.put(src)
+        return storage, id
+
+    def request(self, app, path, method='GET', **headers):
+        """ Perform a request against wsgi app """
+        environ = dict(PATH_INFO=path, REQUEST_METHOD=method)
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper()] = value
+        setup_testing_defaults(environ)
+        response = dict()
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+
+        body = app(environ, start_response)
+        response['body'] = b''.join(body)
+        if hasattr(body, 'close'):
+            body.close()
+        return response
+
+    @staticmethod
+    def request_path(url):
+        """ Get request path from storage url """
+        return url.replace('http://localhost', '')
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_server(self):
+        """ Instantiating resize server """
+        server = ResizeServer(mock.MagicMock())
+        self.assertIsInstance(server, ResizeServer)
+
+    def test_render_resize_on_the_fly(self):
+        """ Missing resize is rendered and sent straight away """
+        storage, id = self.create_storage()
+        app = ResizeServer(storage, prefix='/media')
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+
+        response = self.request(app, self.request_path(url))
+        self.assertEquals('200 OK', response['status'])
+        self.assertEquals('image/jpeg', response['headers']['Content-Type'])
+        self.assertIn('immutable', response['headers']['Cache-Control'])
+        self.assertTrue(response['body'].startswith(b'\xff\xd8'))
+
+        parts = storage.backend.id_to_path(id)
+        local = os.path.join(self.path, *parts, url.split('/')[-1])
+        with open(local, 'rb') as file:
+            self.assertEquals(file.read(), response['body'])
+
+        # then served from storage
+        again = self.request(app, self.request_path(url))
+        self.assertEquals(response['body'], again['body'])
+        self.assertEquals(
+            response['headers']['ETag'],
+            again['headers']['ETag']
+        )
+
+    def test_not_modified(self):
+        """ Conditional request is answered without rendering """
+        storage, id = self.create_storage()
+        storage.get_resize = mock.MagicMock()
+        app = ResizeServer(storage, prefix='media')
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        etag = ResizeServer.etag(id, url.split('/')[-1])
+
+        response = self.request(app, self.request_path(url), if_none_match=etag)
+        self.assertEquals('304 Not Modified', response['status'])
+        self.assertEquals(b'', response['body'])
+        storage.get_resize.assert_not_called()
+
+    def test_any_tag_matches_existing_files_only(self):
+        """ Any tag is only answered with 304 once the file is found """
+        storage, id = self.create_storage()
+        app = ResizeServer(storage, prefix='/media')
+        url = storage.get_original_url(id)
+        response = self.request(app, self.request_path(url), if_none_match='*')
+        self.assertEquals('304 Not Modified', response['status'])
+
+        missing = self.request_path(url).replace('original_vertical', 'nope')
+        response = self.request(app, missing, if_none_match='*')
+        self.assertEquals('404 Not Found', response['status'])
+
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        response = self.request(app, self.request_path(url), if_none_match='*')
+        self.assertEquals('304 Not Modified', response['status'])
+        filename = url.split('/')[-1]
+        self.assertIn(filename, storage.backend.list_variants(id))
+
+    def test_range_requests(self):
+        """ Single byte ranges are supported """
+        storage, id = self.create_storage()
+        app = ResizeServer(storage, prefix='/media')
+        url = storage.get_original_url(id)
+        full = self.request(app, self.request_path(url))['body']
+
+        response = self.request(app, self.request_path(url), range='bytes=10-19')
+        self.assertEquals('206 Partial Content', response['status'])
+        self.assertEquals(full[10:20], response['body'])
+        expected = 'bytes 10-19/{}'.format(len(full))
+        self.assertEquals(expected, response['headers']['Content-Range'])
+
+        response = self.request(app, self.request_path(url), range='bytes=-5')
+        self.assertEquals(full[-5:], response['body'])
+
+        response = self.request(app, self.request_path(url), range='bytes=999999999-')
+        self.assertEquals('416 Range Not Satisfiable', response['status'])
+
+    def test_head_request_has_no_body(self):
+        """ HEAD responds with headers only """
+        storage, id = self.create_storage()
+        app = ResizeServer(storage, prefix='/media')
+        url = storage.get_original_url(id)
+        response = self.request(app, self.request_path(url), method='HEAD')
+        self.assertEquals('200 OK', response['status'])
+        self.assertEquals(b'', response['body'])
+        self.assertNotEqual('0', response['headers']['Content-Length'])
+
+    def test_bad_requests_are_rejected(self):
+        """ Bad paths, signatures and methods are rejected """
+        storage, id = self.create_storage()
+        app = ResizeServer(storage, prefix='/media')
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+
+        bad = self.request(app, self.request_path(url).replace('fill', 'fit'))
+        self.assertEquals('404 Not Found', bad['status'])
+        outside = self.request(app, '/elsewhere/file.jpg')
+        self.assertEquals('404 Not Found', outside['status'])
+        traversal = self.request(app, '/media/../../etc/passwd')
+        self.assertEquals('404 Not Found', traversal['status'])
+        post = self.request(app, self.request_path(url), method='POST')
+        self.assertEquals('405 Method Not Allowed', post['status'])
+
+    def test_over_budget_resizes_are_rejected(self):
+        """ Resizes over memory budget are rejected """
+        storage, id = self.create_storage()
+        storage.memory_budget = MemoryBudget(1024)
+        app = ResizeServer(storage, prefix='/media')
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        response = self.request(app, self.request_path(url))
+        self.assertEquals('413 Payload Too Large', response['status'])
+
+    def test_cold_resizes_are_previewed(self):
+        """ Previews of cold resizes are cached briefly and carry no ETag """
+        storage, id = self.create_storage(
+            variant_cache=VariantCache(1024 * 1024)
+        )
+        app = ResizeServer(storage, prefix='/media', previews=True)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        release = threading.Event()
+        revalidate = storage.revalidate
+
+        def blocked(*args, **kwargs):
+            release.wait(5)
+            return revalidate(*args, **kwargs)
+
+        with mock.patch.object(storage, 'revalidate', blocked):
+            response = self.request(app, self.request_path(url))
+            self.assertEquals('200 OK', response['status'])
+            self.assertTrue(response['body'].startswith(b'\xff\xd8'))
+            cache = response['headers']['Cache-Control']
+            self.assertEquals('public, max-age=5', cache)
+            self.assertNotIn('ETag', response['headers'])
+            release.set()
+            storage.wait(5)
+
+        # then the resize itself is served
+        again = self.request(app, self.request_path(url))
+        self.assertIn('immutable', again['headers']['Cache-Control'])
+        self.assertIn('ETag', again['headers'])
+        self.assertNotEqual(response['body'], again['body'])
@@ -0,0 +1,132 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os, struct, multiprocessing
+from shiftmedia.sharedcache import SharedVariantCache
+from shiftmedia import exceptions as x
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+def write_variant(path, data):
+    """ Write variant to shared cache from a separate process """
+    cache = SharedVariantCache(path, 1024, slots=16)
+    cache.set('id', 'resize.jpg', data)
+    cache.close()
+
+
+def write_forked(cache, data):
+    """ Write variant to shared cache inherited from parent process """
+    cache.set('id', 'resize.jpg', data)
+
+
+@attr('cache', 'shared')
+class SharedVariantCacheTests(TestCase, LocalStorageTestHelpers):
+    """ Shared memory-mapped variant cache tests """
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    @property
+    def slab(self):
+        return os.path.join(self.tmp_path, 'variants.slab')
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_cache(self):
+        """ Instantiating shared cache creates slab file """
+        cache = SharedVariantCache(self.slab, 1024, slots=16)
+        self.assertIsInstance(cache, SharedVariantCache)
+        self.assertTrue(os.path.exists(self.slab))
+        cache.close()
+
+    def test_header_and_slot_fields_are_aligned(self):
+        """ 8-byte fields read without locking are 8-byte aligned """
+        cache = SharedVariantCache(self.slab, 1024, slots=16)
+        cache._write_header(123, 456)
+        fields = struct.unpack_from('<QQI', cache._map, 16)
+        self.assertEquals((1024, 123, 456), fields)
+        self.assertEquals(0, cache.HEADER_SIZE % 8)
+        self.assertEquals(0, cache.SLOT.size % 8)
+        cache.close()
+
+    def test_raises_on_settings_mismatch(self):
+        """ Opening slab with different settings raises """
+        SharedVariantCache(self.slab, 1024, slots=16).close()
+        with assert_raises(x.ConfigurationException):
+            SharedVariantCache(self.slab, 2048, slots=16)
+
+    def test_set_get_and_view(self):
+        """ Putting variant to cache and reading it back """
+        cache = SharedVariantCache(self.slab, 1024, slots=16)
+        self.assertIsNone(cache.get('id', 'resize.jpg'))
+        self.assertTrue(cache.set('id', 'resize.jpg', b'variant'))
+        self.assertEquals(b'variant', cache.get('id', 'resize.jpg'))
+        view = cache.view('id', 'resize.jpg')
+        self.assertIsInstance(view, memoryview)
+        self.assertEquals(b'variant', view.tobytes())
+        view.release()
+        self.assertEquals(2, cache.stats()['hits'])
+        cache.close()
+
+    def test_visible_across_processes(self):
+        """ Variant written by one process is visible to another """
+        cache = SharedVariantCache(self.slab, 1024, slots=16)
+        ctx = multiprocessing.get_context('fork')
+        process = ctx.Process(target=write_variant, args=(self.slab, b'xyz'))
+        process.start()
+        process.join(5)
+        self.assertEquals(b'xyz', cache.get('id', 'resize.jpg'))
+        cache.close()
+
+    def test_forked_writers_lock_each_other_out(self):
+        """ Forked process doesn't share write lock with its parent """
+        cache = SharedVariantCache(self.slab, 1024, slots=16)
+        ctx = multiprocessing.get_context('fork')
+        process = ctx.Process(target=write_forked, args=(cache, b'xyz'))
+        with cache.write_lock():
+            process.start()
+            process.join(0.5)
+            self.assertTrue(process.is_alive())
+            self.assertIsNone(cache.get('id', 'resize.jpg'))
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+        self.assertEquals(0, process.exitcode)
+        self.assertEquals(b'xyz', cache.get('id', 'resize.jpg'))
+        cache.close()
+
+    def test_oldest_data_is_overwritten_over_budget(self):
+        """ Ring overwrites oldest variants once budget is exhausted """
+        cache = SharedVariantCache(self.slab, 100, slots=16)
+        cache.set('id', 'one.jpg', b'1' * 40)
+        cache.set('id', 'two.jpg', b'2' * 40)
+        cache.set('id', 'three.jpg', b'3' * 40)
+        self.assertIsNone(cache.get('id', 'one.jpg'))
+        self.assertEquals(b'2' * 40, cache.get('id', 'two.jpg'))
+        self.assertEquals(b'3' * 40, cache.get('id', 'three.jpg'))
+        self.assertFalse(cache.set('id', 'big.jpg', b'4' * 101))
+        cache.close()
+
+    def test_invalidate_and_clear(self):
+        """ Invalidating variants by id and clearing cache """
+        cache = SharedVariantCache(self.slab, 1024, slots=16)
+        cache.set('id1', 'one.jpg', b'1')
+        cache.set('id1', 'two.jpg', b'2')
+        cache.set('id2', 'one.jpg', b'3')
+        cache.invalidate('id1')
+        self.assertIsNone(cache.get('id1', 'one.jpg'))
+        self.assertIsNone(cache.get('id1', 'two.jpg'))
+        self.assertEquals(b'3', cache.get('id2', 'one.jpg'))
+        cache.clear()
+        self.assertIsNone(cache.get('id2', 'one.jpg'))
+        cache.set('id2', 'one.jpg', b'4')
+        self.assertEquals(b'4', cache.get('id2', 'one.jpg'))
+        cache.close()
@@ -0,0 +1,99 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import hashlib
+from shiftmedia import utils
+from shiftmedia import exceptions as x
+from shiftmedia.paths import PathBuilder
+from shiftmedia.signing import Md5Signer, HmacSigner, Blake2Signer
+
+
+@attr('signing')
+class SignerTests(TestCase):
+    """ Filename signers tests """
+
+    filename = '100x200-fill-80-upscale.jpg'
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_md5_signer_is_backwards_compatible(self):
+        """ MD5 signer produces legacy signatures """
+        id = utils.generate_id('original.jpg')
+        signer = Md5Signer('12345')
+        sign_me = bytes(id + self.filename + '12345', 'utf-8')
+        expected = hashlib.md5(sign_me).hexdigest()
+        self.assertEquals(expected, signer.sign(id, self.filename))
+        self.assertTrue(signer.verify(id, self.filename, expected))
+        self.assertFalse(signer.verify(id, self.filename, expected[:-1]))
+
+    def test_keyed_signers_sign_and_verify(self):
+        """ Keyed signers sign and verify """
+        id = utils.generate_id('original.jpg')
+        for signer in [HmacSigner('secret'), Blake2Signer('secret')]:
+            signature = signer.sign(id, self.filename)
+            self.assertEquals(64, len(signature))
+            self.assertTrue(signer.verify(id, self.filename, signature))
+            other = '200x200-fill-80-upscale.jpg'
+            self.assertFalse(signer.verify(id, other, signature))
+            self.assertFalse(signer.verify(id, self.filename, 'nope'))
+
+    def test_hmac_signature_matches_reference(self):
+        """ HMAC signer signs with HMAC-SHA256 """
+        import hmac
+        id = utils.generate_id('original.jpg')
+        message = bytes(id + '\0' + self.filename, 'utf-8')
+        expected = hmac.new(b'secret', message, hashlib.sha256).hexdigest()
+        signer = HmacSigner('secret')
+        self.assertEquals(expected, signer.sign(id, self.filename))
+
+    def test_truncated_signatures(self):
+        """ Signatures can be truncated """
+        id = utils.generate_id('original.jpg')
+        signer = Blake2Signer('secret', length=20)
+        signature = signer.sign(id, self.filename)
+        self.assertEquals(20, len(signature))
+        self.assertTrue(signer.verify(id, self.filename, signature))
+        with assert_raises(x.ConfigurationException):
+            HmacSigner('secret', length=8)
+        with assert_raises(x.ConfigurationException):
+            HmacSigner('secret', length=100)
+
+    def test_key_rotation(self):
+        """ Old keys keep verifying while the new key signs """
+        id = utils.generate_id('original.jpg')
+        old = HmacSigner('old-key')
+        rotated = HmacSigner(['new-key', 'old-key'])
+        signature = old.sign(id, self.filename)
+        self.assertTrue(rotated.verify(id, self.filename, signature))
+        self.assertNotEqual(signature, rotated.sign(id, self.filename))
+        self.assertFalse(old.verify(
+            id,
+            self.filename,
+            rotated.sign(id, self.filename)
+        ))
+
+    def test_sign_many_matches_sign(self):
+        """ Bulk signing gives the same signatures """
+        id = utils.generate_id('original.jpg')
+        filenames = [self.filename, '300x300-fit-65-noupscale.png']
+        signers = [Md5Signer('1'), HmacSigner('1', 32), Blake2Signer('1')]
+        for signer in signers:
+            expected = [signer.sign(id, name) for name in filenames]
+            self.assertEquals(expected, signer.sign_many(id, filenames))
+
+    def test_path_builder_uses_signer(self):
+        """ Path builder signs and parses with configured signer """
+        id = utils.generate_id('original.jpg')
+        pb = PathBuilder('12345', signer=Blake2Signer('secret', length=16))
+        filename = pb.get_auto_crop_filename(id, '100x200', 'fill')
+        signature = filename.split('-')[4].split('.')[0]
+        self.assertEquals(16, len(signature))
+        params = pb.filename_to_resize_params(id, filename)
+        self.assertEquals('100x200', params['target_size'])
+
+        legacy = PathBuilder('12345')
+        self.assertFalse(legacy.validate_signature(id, filename))
+        self.assertFalse(legacy.validate_signature(id, 'garbage'))
@@ -0,0 +1,110 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import threading, time
+from shiftmedia.singleflight import SingleFlight
+
+
+@attr('singleflight')
+class SingleFlightTests(TestCase):
+    """ Unit tests for request coalescing """
+
+    def test_instantiate_single_flight(self):
+        """ Instantiating single flight """
+        flights = SingleFlight()
+        self.assertIsInstance(flights, SingleFlight)
+
+    def test_do_returns_result(self):
+        """ Single flight returns result of the call """
+        flights = SingleFlight()
+        result = flights.do('key', lambda a, b: a + b, 1, b=2)
+        self.assertEquals(3, result)
+        self.assertEquals(1, flights.stats()['executions'])
+        self.assertFalse(flights.in_flight('key'))
+
+    def test_concurrent_calls_are_coalesced(self):
+        """ Concurrent calls with the same key run only once """
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        work = mock.MagicMock(return_value='result')
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return work()
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do('key', slow))
+        )
+        leader.start()
+        started.wait(5)
+
+        followers = []
+        for i in range(5):
+            thread = threading.Thread(
+                target=lambda: results.append(flights.do('key', slow))
+            )
+            thread.start()
+            followers.append(thread)
+
+        while flights.stats()['coalesced'] < 5:
+            time.sleep(0.01)
+        self.assertEquals(5, flights.stats()['waiting'])
+
+        release.set()
+        leader.join(5)
+        for thread in followers:
+            thread.join(5)
+
+        self.assertEquals(['result'] * 6, results)
+        self.assertEquals(1, work.call_count)
+        stats = flights.stats()
+        self.assertEquals(6, stats['calls'])
+        self.assertEquals(1, stats['executions'])
+        self.assertEquals(5, stats['coalesced'])
+        self.assertEquals(0, stats['in_flight'])
+        self.assertEquals(0, stats['waiting'])
+
+    def test_call_tells_whether_result_was_shared(self):
+        """ Followers learn that result was computed by the leader """
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flights.call('key', slow))
+        )
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(
+            target=lambda: results.append(flights.call('key', slow))
+        )
+        follower.start()
+        while flights.stats()['coalesced'] < 1:
+            time.sleep(0.01)
+
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEquals([('result', False), ('result', True)], results)
+
+    def test_exceptions_are_shared_and_key_released(self):
+        """ Exception is raised and key released for subsequent calls """
+        flights = SingleFlight()
+
+        def fail():
+            raise ValueError('nope')
+
+        with assert_raises(ValueError):
+            flights.do('key', fail)
+        self.assertEquals('ok', flights.do('key', lambda: 'ok'))
+        self.assertEquals(2, flights.stats()['executions'])
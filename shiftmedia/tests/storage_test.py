@@ -2,11 +2,17 @@ from unittest import mock, TestCase
 from nose.plugins.attrib import attr
 from nose.tools import assert_raises
 
-import os
+import os, time, threading
 import shutil
 from PIL import Image
 from shiftmedia import Storage, BackendLocal, utils
 from shiftmedia import exceptions as x
+from shiftmedia.locks import FileLockManager
+from shiftmedia.cache import OriginalsCache, DecodedCache, VariantCache
+from shiftmedia.sharedcache import SharedVariantCache
+from shiftmedia.index import VariantIndex
+from shiftmedia.ladder import SizeLadder
+from shiftmedia.results import ResizeResult, PutResult
 from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
 from pprint import pprint as pp
 
@@ -144,7 +150,7 @@ class StorageTests(TestCase, LocalStorageTestHelpers):
         self.assertTrue(url.startswith(base_url))
         url = url.replace(base_url, '').strip('/').split('/')
         self.assertEquals(filename, url[5])
-        self.assertTrue(url[6].startswith('100x200-fill-80-upscale'))
+        self.assertTrue(url[6].startswith('100x200-fill-100-upscale'))
         self.assertTrue(url[6].endswith('.gif'))
 
     def test_get_manual_crop_url(self):
@@ -169,7 +175,7 @@ class StorageTests(TestCase, LocalStorageTestHelpers):
         self.assertTrue(url.startswith(base_url))
         url = url.replace(base_url, '').strip('/').split('/')
         self.assertEquals(filename, url[5])
-        self.assertTrue(url[6].startswith('100x200-200x400-80-upscale'))
+        self.assertTrue(url[6].startswith('100x200-200x400-100-upscale'))
         self.assertTrue(url[6].endswith('.gif'))
 
     def test_create_auto_crop_from_filename(self):
@@ -205,21 +211,728 @@ class StorageTests(TestCase, LocalStorageTestHelpers):
         # assert put to storage
         self.assertTrue(os.path.exists(storage_resize))
 
+    def test_create_resize_under_variant_lock(self):
+        """ Creating resize while holding cross-process variant lock """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        locks = FileLockManager(os.path.join(self.tmp_path, '.locks'))
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            locks=locks,
+            lock_timeout=1
+        )
+
+        id = storage.put(src)
+        resize_url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        with mock.patch.object(locks, 'acquire', wraps=locks.acquire) as acq:
+            storage.create_resize(resize_url)
+            self.assertEquals(1, acq.call_count)
+
+        resize_filename = resize_url.split('/')[-1]
+        parts = backend.id_to_path(id)
+        storage_resize = os.path.join(self.path, *parts, resize_filename)
+        self.assertTrue(os.path.exists(storage_resize))
+        self.assertEquals([], os.listdir(locks.path))
+
+    def test_create_resizes_through_originals_cache(self):
+        """ Several resizes of the same original download it once """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        cache_path = os.path.join(self.tmp_path, '.originals')
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            originals_cache=OriginalsCache(cache_path, 1024 * 1024)
+        )
+
+        id = storage.put(src)
+        urls = [
+            storage.get_auto_crop_url(id, '100x200', 'fill'),
+            storage.get_auto_crop_url(id, '50x50', 'fit'),
+        ]
+        with mock.patch.object(
+            backend,
+            'retrieve_original',
+            wraps=backend.retrieve_original
+        ) as retrieve:
+            for url in urls:
+                storage.create_resize(url)
+            self.assertEquals(1, retrieve.call_count)
+
+        self.assertEquals(1, storage.originals_cache.stats()['hits'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_path, id)))
+
+    def test_create_resizes_from_decoded_cache(self):
+        """ Resizes of a cached decoded original skip retrieving it """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            decoded_cache=DecodedCache(1000 * 1000)
+        )
+
+        id = storage.put(src)
+        urls = [
+            storage.get_auto_crop_url(id, '100x200', 'fill'),
+            storage.get_auto_crop_url(id, '50x50', 'fit'),
+        ]
+        with mock.patch.object(
+            backend,
+            'retrieve_original',
+            wraps=backend.retrieve_original
+        ) as retrieve:
+            for url in urls:
+                storage.create_resize(url)
+            self.assertEquals(1, retrieve.call_count)
+
+        parts = backend.id_to_path(id)
+        for url in urls:
+            resize = os.path.join(self.path, *parts, url.split('/')[-1])
+            self.assertTrue(os.path.exists(resize))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_path, id)))
+
+    def test_rendered_variants_are_cached_in_memory(self):
+        """ Rendered variants are served from memory until invalidated """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            variant_cache=VariantCache(1000 * 1000)
+        )
+
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        self.assertIsNone(storage.get_variant(url))
+        storage.create_resize(url)
 
+        parts = backend.id_to_path(id)
+        stored = os.path.join(self.path, *parts, url.split('/')[-1])
+        with open(stored, 'rb') as file:
+            self.assertEquals(file.read(), storage.get_variant(url))
 
+        with mock.patch.object(backend, 'retrieve_original') as retrieve:
+            storage.create_resize(url)
+            retrieve.assert_not_called()
 
+        storage.clear_variants()
+        self.assertIsNone(storage.get_variant(url))
+        storage.create_resize(url)
+        storage.delete(id)
+        self.assertIsNone(storage.get_variant(url))
 
+    def test_rendered_variants_are_shared_between_storages(self):
+        """ Variant rendered by one storage is served to another """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        slab = os.path.join(self.tmp_path, 'variants.slab')
+        storages = [Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            shared_cache=SharedVariantCache(slab, 1024 * 1024, slots=64)
+        ) for i in range(2)]
 
+        id = storages[0].put(src)
+        url = storages[0].get_auto_crop_url(id, '100x200', 'fill')
+        storages[0].create_resize(url)
+        data = storages[1].get_variant(url)
+        self.assertTrue(data.startswith(b'\xff\xd8'))
 
+        storages[0].delete(id)
+        self.assertIsNone(storages[1].get_variant(url))
 
+    def test_existing_variants_are_not_recreated(self):
+        """ Existence index skips resizes that already exist """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            index=VariantIndex(backend)
+        )
 
+        with mock.patch.object(
+            backend,
+            'list_variants',
+            wraps=backend.list_variants
+        ) as listing:
+            id = storage.put(src)
+            url = storage.get_auto_crop_url(id, '100x200', 'fill')
+            storage.create_resize(url)
+            listing.assert_not_called()
+
+        with mock.patch.object(backend, 'retrieve_original') as retrieve:
+            storage.create_resize(url)
+            retrieve.assert_not_called()
+
+        storage.clear_variants()
+        storage.create_resize(url)
+        resize = os.path.join(
+            self.path,
+            *backend.id_to_path(id),
+            url.split('/')[-1]
+        )
+        self.assertTrue(os.path.exists(resize))
 
+    def test_put_renders_presets(self):
+        """ Putting file renders presets from local original """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        storage.add_preset('card', '100x200', 'fill')
+        storage.add_preset('avatar', '50x50', 'fill', output_format='png')
+
+        with mock.patch('shiftmedia.resizer.Image.open', wraps=Image.open) \
+                as open:
+            id = storage.put(src, presets=['card', 'avatar'])
+            self.assertEquals(1, open.call_count)
+
+        self.assertFalse(os.path.exists(src))
+        for name in ['card', 'avatar']:
+            url = storage.get_preset_url(id, name)
+            path = os.path.join(
+                self.path,
+                *backend.id_to_path(id),
+                url.split('/')[-1]
+            )
+            self.assertTrue(os.path.exists(path))
+        self.assertEquals([], os.listdir(self.tmp_path))
+
+    def test_put_renders_presets_in_background(self):
+        """ Putting file renders presets in background """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'countdown.gif')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        storage.add_preset('small', '20x20', 'fill')
+        storage.add_preset('large', '40x40', 'fit')
+
+        id = storage.put(src, presets=['small', 'large'], background=True)
+        storage.wait(10)
+        self.assertFalse(os.path.exists(src))
+        for name in ['small', 'large']:
+            url = storage.get_preset_url(id, name)
+            path = os.path.join(
+                self.path,
+                *backend.id_to_path(id),
+                url.split('/')[-1]
+            )
+            self.assertTrue(os.path.exists(path))
+            self.assertTrue(Image.open(path).is_animated)
+
+    def test_get_resize_returns_rendered_bytes(self):
+        """ Getting resize renders it and returns its bytes """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            index=VariantIndex(backend)
+        )
 
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        data = storage.get_resize(url)
 
+        filename = url.split('/')[-1]
+        parts = backend.id_to_path(id)
+        with open(os.path.join(self.path, *parts, filename), 'rb') as file:
+            self.assertEquals(file.read(), data)
+
+        # still returns bytes once index knows variant exists
+        self.assertEquals(len(data), len(storage.get_resize(url)))
+
+    def test_get_resize_reads_stored_variants(self):
+        """ Stored variants are read back, never rendered or stored """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            index=VariantIndex(backend)
+        )
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        data = storage.get_resize(url)
+
+        retrieve = mock.Mock(wraps=storage.retrieve_original)
+        put = mock.Mock(wraps=backend.put_variant)
+        with mock.patch.object(storage, 'retrieve_original', retrieve), \
+                mock.patch.object(backend, 'put_variant', put):
+            for _ in range(3):
+                result = storage.get_resize(url, result=True)
+                self.assertEquals(ResizeResult.EXISTS, result.status)
+                self.assertEquals(data, result.data)
+        retrieve.assert_not_called()
+        put.assert_not_called()
+
+        # backends that can't read variants back render without storing
+        with mock.patch.object(backend, 'get_variant', return_value=None), \
+                mock.patch.object(backend, 'put_variant', put):
+            self.assertEquals(len(data), len(storage.get_resize(url)))
+        put.assert_not_called()
+
+    def test_get_resize_joining_create_resize_gets_bytes(self):
+        """ Getting resize coalesced with create resize returns bytes """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            index=VariantIndex(backend)
+        )
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        filename = url.split('/')[-1]
+        data = storage.get_resize(url)
+        release = threading.Event()
+        resize = storage._resize
+
+        # create resize takes off once get resize found variant stored
+        creating = threading.Thread(target=storage.create_resize, args=(url,))
+        call = storage.flights.call
+
+        def blocked(*args, **kwargs):
+            if threading.current_thread() is creating:
+                release.wait(5)
+            return resize(*args, **kwargs)
+
+        def takeoff(key, *args, **kwargs):
+            flown = call(key, *args, **kwargs)
+            if creating.ident is None and key == (id, filename):
+                creating.start()
+                while not storage.flights.in_flight(key):
+                    time.sleep(0.01)
+            return flown
+
+        results = []
+        with mock.patch.object(storage, '_resize', blocked), \
+                mock.patch.object(storage.flights, 'call', takeoff):
+            getting = threading.Thread(
+                target=lambda: results.append(storage.get_resize(url))
+            )
+            getting.start()
+            deadline = time.time() + 5
+            while not storage.flights.coalesced and not results:
+                if time.time() > deadline:
+                    break
+                time.sleep(0.01)
+            release.set()
+            getting.join(5)
+            creating.join(5)
+        self.assertEquals([data], results)
+
+    def test_parsed_ids_are_cached(self):
+        """ Ids are parsed once for building urls """
+        backend = BackendLocal(self.path, url='http://media.example.com/')
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        id = utils.generate_id('original.jpg')
+        parsed = storage.parse_id(id)
+        self.assertIs(parsed, storage.parse_id(id))
+        self.assertEquals('original.jpg', parsed.original)
+        self.assertEquals('jpg', parsed.extension)
+        expected = 'http://media.example.com/' + '/'.join(parsed.parts) + '/'
+        self.assertEquals(expected, parsed.prefix)
+        with assert_raises(AttributeError):
+            parsed.other = 'value'
+
+    def test_get_srcset_with_widths(self):
+        """ Getting srcset with width descriptors """
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        id = utils.generate_id('original.jpg')
+        sizes = ['320x240', '640x480']
+        srcset = storage.get_srcset(id, sizes, 'fit', quality=80)
+        expected = ', '.join([
+            storage.get_auto_crop_url(id, '320x240', 'fit', quality=80) +
+            ' 320w',
+            storage.get_auto_crop_url(id, '640x480', 'fit', quality=80) +
+            ' 640w',
+        ])
+        self.assertEquals(expected, srcset)
+
+    def test_get_srcset_with_densities(self):
+        """ Getting srcset with density descriptors """
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        id = utils.generate_id('original.jpg')
+        srcset = storage.get_srcset(id, '100x50', densities=[1, 1.5, 2])
+        entries = srcset.split(', ')
+        self.assertEquals(3, len(entries))
+        self.assertTrue(entries[0].endswith(' 1x'))
+        self.assertIn('/150x75-fill-', entries[1])
+        self.assertTrue(entries[1].endswith(' 1.5x'))
+        self.assertIn('/200x100-fill-', entries[2])
+
+        with assert_raises(x.InvalidArgumentException):
+            storage.get_srcset(id, ['100x50', '200x100'], densities=[1, 2])
+
+    def test_get_srcset_snaps_to_ladder(self):
+        """ Srcset lists snapped sizes once """
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            ladder=SizeLadder(rungs=[240, 320, 640])
+        )
+        id = utils.generate_id('original.jpg')
+        sizes = ['318x240', '322x241', '600x480']
+        srcset = storage.get_srcset(id, sizes, 'fit')
+        expected = ', '.join([
+            storage.get_auto_crop_url(id, '318x240', 'fit') + ' 320w',
+            storage.get_auto_crop_url(id, '600x480', 'fit') + ' 640w',
+        ])
+        self.assertEquals(expected, srcset)
+
+    def test_create_resize_from_preset_url(self):
+        """ Creating resize from short preset url, strict mode """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            strict_presets=True
+        )
+        storage.add_preset('thumb', '40x40', 'fill')
+        id = storage.put(src)
 
+        url = storage.get_preset_url(id, 'thumb')
+        storage.create_resize(url)
+        filename = url.split('/')[-1]
+        path = os.path.join(self.path, *backend.id_to_path(id), filename)
+        self.assertEquals((40, 40), Image.open(path).size)
 
+        url = storage.get_auto_crop_url(id, '40x40', 'fill')
+        with assert_raises(x.InvalidArgumentException):
+            storage.create_resize(url)
 
+    def test_create_resize_maps_to_canonical_resize(self):
+        """ Equivalent resizes are created once under canonical name """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            index=VariantIndex(backend)
+        )
+        id = storage.put(src)  # 248x768
 
+        canonical = storage.get_auto_crop_url(id, '100x200', 'fill')
+        url = storage.get_auto_crop_url(id, '100x200', 'fill', upscale=False)
+        self.assertNotEqual(canonical, url)
+        self.assertEquals(canonical, storage.create_resize(url))
+        self.assertEquals(canonical, storage.create_resize(canonical))
 
+        # small original keeps requested resize
+        url = storage.get_auto_crop_url(id, '500x1000', 'fill', upscale=False)
+        self.assertEquals(url, storage.create_resize(url))
 
+        files = backend.list_variants(id)
+        self.assertEquals(3, len(files))
+        self.assertIn(canonical.split('/')[-1], files)
 
+        # requested resize can be stored too, to be served statically
+        alias = storage.get_auto_crop_url(id, '100x200', 'fill', upscale=False)
+        parts = backend.id_to_path(id)
+        os.remove(os.path.join(self.path, *parts, canonical.split('/')[-1]))
+        storage.index.invalidate(id)
+        storage.store_aliases = True
+        self.assertEquals(canonical, storage.create_resize(alias))
+        files = backend.list_variants(id)
+        self.assertIn(canonical.split('/')[-1], files)
+        self.assertIn(alias.split('/')[-1], files)
+
+    def test_put_returns_result(self):
+        """ Put returns structured result if asked """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        size = os.path.getsize(src)
+        storage = Storage(
+            BackendLocal(self.path),
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        storage.add_preset('card', '100x100')
+        result = storage.put(src, presets=['card'], result=True)
+        self.assertIsInstance(result, PutResult)
+        self.assertEquals(storage.get_original_url(result.id), result.url)
+        self.assertEquals('original_vertical.jpg', result.filename)
+        self.assertEquals(size, result.bytes)
+        self.assertEquals((248, 768), result.size)
+        self.assertEquals('JPEG', result.format)
+        self.assertEquals(1, result.frames)
+        card = storage.paths.get_preset_filename(result.id, 'card')
+        self.assertEquals([card], result.presets)
+        self.assertFalse(result.background)
+        for stage in ['upload', 'put_variant', 'decode', 'encode', 'store']:
+            self.assertIn(stage, result.durations)
+        self.assertTrue(result.elapsed >= result.durations['upload'])
+
+    def test_create_resize_returns_result(self):
+        """ Create resize returns structured result if asked """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            variant_cache=VariantCache(1024 * 1024),
+            index=VariantIndex(backend)
+        )
+        size = os.path.getsize(src)
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill', upscale=False)
+        canonical = storage.get_auto_crop_url(id, '100x200', 'fill')
+
+        result = storage.create_resize(url, result=True)
+        self.assertIsInstance(result, ResizeResult)
+        self.assertEquals(ResizeResult.CREATED, result.status)
+        self.assertTrue(result.rendered)
+        self.assertEquals(canonical, result.url)
+        self.assertTrue(result.canonical)
+        self.assertEquals((248, 768), result.source_size)
+        self.assertEquals(size, result.source_bytes)
+        self.assertEquals((100, 200), result.size)
+        self.assertEquals('jpg', result.format)
+        self.assertTrue(result.bytes > 0)
+        self.assertIsNone(result.data)
+        for stage in ['retrieve', 'decode', 'crop', 'encode', 'store']:
+            self.assertIn(stage, result.durations)
+        self.assertEquals(result.durations['create_resize'], result.elapsed)
+
+        cached = storage.create_resize(canonical, result=True)
+        self.assertEquals(ResizeResult.CACHED, cached.status)
+        self.assertEquals(result.bytes, cached.bytes)
+
+        storage.variant_cache.clear()
+        exists = storage.create_resize(canonical, result=True)
+        self.assertEquals(ResizeResult.EXISTS, exists.status)
+        self.assertFalse(exists.rendered)
+
+        data = storage.get_resize(canonical, result=True)
+        self.assertEquals(result.bytes, len(data.data))
+        self.assertEquals((100, 200), data.size)
+
+
+    def test_get_preview_of_cold_resize(self):
+        """ Cold resize is previewed while rendered in background """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            variant_cache=VariantCache(1024 * 1024),
+            index=VariantIndex(backend)
+        )
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        filename = url.split('/')[-1]
+        release = threading.Event()
+        revalidate = storage.revalidate
+
+        def blocked(*args, **kwargs):
+            release.wait(5)
+            return revalidate(*args, **kwargs)
+
+        with mock.patch.object(storage, 'revalidate', blocked):
+            preview = storage.get_preview(url, result=True)
+            self.assertEquals(ResizeResult.PREVIEW, preview.status)
+            self.assertTrue(preview.provisional)
+            self.assertEquals(url, preview.url)
+            self.assertEquals((100, 200), preview.size)
+            self.assertTrue(preview.data.startswith(b'\xff\xd8'))
+            self.assertFalse(storage.index.exists(id, filename))
+
+            # readers get the same preview until resize is stored
+            with mock.patch.object(storage, 'retrieve_original') as retrieve:
+                self.assertEquals(preview.data, storage.get_preview(url))
+                retrieve.assert_not_called()
+
+            release.set()
+            storage.wait(5)
+
+        self.assertTrue(storage.index.exists(id, filename))
+        result = storage.get_preview(url, result=True)
+        self.assertEquals(ResizeResult.CACHED, result.status)
+        self.assertFalse(result.provisional)
+        self.assertNotEqual(preview.data, result.data)
+        self.assertTrue(preview.bytes < result.bytes)
+
+        # scratch holding original is cleaned up
+        self.assertEquals([], os.listdir(storage.workspace.root))
+
+    def test_get_preview_reads_stored_resize(self):
+        """ Previewing a stored resize reads it back from storage """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            index=VariantIndex(backend)
+        )
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        data = storage.get_resize(url)
+
+        retrieve = mock.Mock(wraps=storage.retrieve_original)
+        put = mock.Mock(wraps=backend.put_variant)
+        with mock.patch.object(storage, 'retrieve_original', retrieve), \
+                mock.patch.object(backend, 'put_variant', put):
+            for _ in range(2):
+                result = storage.get_preview(url, result=True)
+                self.assertEquals(ResizeResult.EXISTS, result.status)
+                self.assertFalse(result.provisional)
+                self.assertEquals(url, result.url)
+                self.assertEquals(data, result.data)
+        retrieve.assert_not_called()
+        put.assert_not_called()
+
+    def test_get_preview_without_cache_renders_resize(self):
+        """ Storage that can't find stored resizes doesn't preview """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        storage = Storage(
+            BackendLocal(self.path),
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        with mock.patch.object(storage, 'run_in_background') as background:
+            result = storage.get_preview(url, result=True)
+            background.assert_not_called()
+        self.assertFalse(result.provisional)
+        self.assertEquals((100, 200), result.size)
+
+    def test_index_notices_variants_cleared_elsewhere(self):
+        """ Index of one storage notices variants cleared by another """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storages = [
+            Storage(
+                backend,
+                secret_key=self.config.SECRET_KEY,
+                local_temp=self.config.LOCAL_TEMP,
+                index=VariantIndex(backend, ttl=0.05)
+            ) for _ in range(2)
+        ]
+        id = storages[0].put(src)
+        url = storages[0].get_auto_crop_url(id, '100x200', 'fill')
+        created = storages[0].create_resize(url, result=True)
+        self.assertEquals(ResizeResult.CREATED, created.status)
+        exists = storages[0].create_resize(url, result=True)
+        self.assertEquals(ResizeResult.EXISTS, exists.status)
+
+        storages[1].clear_variants()
+        time.sleep(0.1)
+        result = storages[0].create_resize(url, result=True)
+        self.assertEquals(ResizeResult.CREATED, result.status)
+
+    def test_mapped_resize_is_not_rendered_again(self):
+        """ Second request for a mapped resize does no render """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        backend = BackendLocal(self.path)
+        storage = Storage(
+            backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            index=VariantIndex(backend)
+        )
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill', upscale=False)
+        canonical = storage.get_auto_crop_url(id, '100x200', 'fill')
+        created = storage.create_resize(url, result=True)
+        self.assertEquals(ResizeResult.CREATED, created.status)
+
+        retrieve = mock.Mock(wraps=storage.retrieve_original)
+        put = mock.Mock(wraps=backend.put_variant)
+        with mock.patch.object(storage, 'retrieve_original', retrieve), \
+                mock.patch.object(backend, 'put_variant', put):
+            for _ in range(2):
+                result = storage.create_resize(url, result=True)
+                self.assertEquals(ResizeResult.EXISTS, result.status)
+        retrieve.assert_not_called()
+        put.assert_not_called()
+
+        # only canonical resize is stored
+        filename = url.split('/')[-1]
+        self.assertNotIn(filename, backend.list_variants(id))
+
+        # canonical resize existing already is remembered too
+        storage.index.invalidate(id)
+        with mock.patch.object(storage, 'retrieve_original', retrieve):
+            self.assertEquals(canonical, storage.create_resize(url))
+            self.assertEquals(canonical, storage.create_resize(url))
+        self.assertEquals(0, retrieve.call_count)
+
+    def test_mapped_resize_is_served_from_cache_without_index(self):
+        """ Mapped resize is found in variant cache under canonical name """
+        self.prepare_uploads()
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        storage = Storage(
+            BackendLocal(self.path),
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            variant_cache=VariantCache(1024 * 1024)
+        )
+        id = storage.put(src)
+        url = storage.get_auto_crop_url(id, '100x200', 'fill', upscale=False)
+        data = storage.get_resize(url)
+        with mock.patch.object(storage, 'retrieve_original') as retrieve:
+            result = storage.get_resize(url, result=True)
+            retrieve.assert_not_called()
+        self.assertEquals(ResizeResult.CACHED, result.status)
+        self.assertEquals(data, result.data)
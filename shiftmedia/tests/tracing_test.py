@@ -0,0 +1,120 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os
+from shiftmedia import Storage, BackendLocal
+from shiftmedia import tracing
+from shiftmedia import exceptions as x
+from shiftmedia.tracing import LocalTracer, InMemoryExporter
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('tracing')
+class TracingTests(TestCase, LocalStorageTestHelpers):
+    """ Tracing hooks tests """
+
+    def setUp(self):
+        super().setUp()
+        self.exporter = InMemoryExporter()
+        self.previous = tracing.set_tracer(LocalTracer(self.exporter))
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        tracing.set_tracer(self.previous)
+        self.clean()
+        super().tearDown()
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_noop_tracer_is_default(self):
+        """ Spans are not recorded unless tracer is configured """
+        tracing.set_tracer(None)
+        self.assertFalse(tracing.enabled())
+        with tracing.span('anything', a=1) as span:
+            self.assertFalse(span.is_recording())
+            tracing.set_attributes(b=2)
+        self.assertEquals([], self.exporter.spans)
+
+    def test_spans_nest_and_record_attributes(self):
+        """ Child spans share trace with parent """
+        with tracing.span('parent', a=1, skipped=None) as parent:
+            with tracing.span('child') as child:
+                tracing.set_attributes(b=2)
+        self.assertEquals([child, parent], self.exporter.spans)
+        self.assertEquals(dict(a=1), parent.attributes)
+        self.assertEquals(dict(b=2), child.attributes)
+        self.assertEquals(parent.trace_id, child.trace_id)
+        self.assertEquals(parent.span_id, child.parent_id)
+        self.assertIsNone(parent.parent_id)
+        self.assertTrue(parent.duration >= child.duration)
+
+    def test_exceptions_are_recorded(self):
+        """ Failed span records exception and error status """
+        with assert_raises(ValueError):
+            with tracing.span('failing'):
+                raise ValueError('boom')
+        span = self.exporter.get('failing')[0]
+        self.assertEquals('error', span.status)
+        self.assertEquals('exception', span.events[0][0])
+
+    def test_opentelemetry_adapter_delegates(self):
+        """ OpenTelemetry adapter passes spans to given tracer """
+        otel = mock.Mock()
+        tracer = tracing.OpenTelemetryTracer(otel)
+        tracer.start_as_current_span('name', dict(a=1))
+        otel.start_as_current_span.assert_called_with(
+            'name',
+            attributes=dict(a=1)
+        )
+
+    def test_put_and_resize_are_traced(self):
+        """ Ingest and resize paths record spans with attributes """
+        self.prepare_uploads()
+        storage = Storage(
+            BackendLocal(self.path),
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP
+        )
+        src = os.path.join(self.upload_path, 'original_vertical.jpg')
+        size = os.path.getsize(src)
+        id = storage.put(src)
+
+        put = self.exporter.get('storage.put')[0]
+        self.assertEquals(id, put.attributes['id'])
+        self.assertEquals(size, put.attributes['bytes'])
+        upload = self.exporter.get('backend.put_variant')[0]
+        self.assertEquals(put.span_id, upload.parent_id)
+        self.assertEquals('local', upload.attributes['backend'])
+        self.assertEquals(size, upload.attributes['bytes'])
+
+        self.exporter.clear()
+        url = storage.get_auto_crop_url(id, '100x200', 'fill')
+        storage.create_resize(url)
+
+        resize = self.exporter.get('storage.create_resize')[0]
+        self.assertEquals(248 * 768, resize.attributes['pixels'])
+        self.assertEquals(1, resize.attributes['frames'])
+        self.assertTrue(resize.attributes['bytes'] > 0)
+
+        expected = [
+            'paths.parse_filename',
+            'backend.retrieve_original',
+            'resizer.decode',
+            'resizer.crop',
+            'resizer.encode',
+            'resizer.auto_crop',
+            'backend.put_variant',
+        ]
+        for name in expected:
+            spans = self.exporter.get(name)
+            self.assertEquals(1, len(spans), name)
+            self.assertEquals(resize.trace_id, spans[0].trace_id)
+
+        decode = self.exporter.get('resizer.decode')[0]
+        self.assertEquals(248 * 768, decode.attributes['pixels'])
+        encode = self.exporter.get('resizer.encode')[0]
+        size = encode.attributes['bytes']
+        self.assertEquals(resize.attributes['bytes'], size)
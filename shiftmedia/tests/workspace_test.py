@@ -0,0 +1,122 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os, time, threading
+from shiftmedia import exceptions as x
+from shiftmedia.workspace import Workspace, Scratch
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('workspace')
+class WorkspaceTests(TestCase, LocalStorageTestHelpers):
+    """ Local scratch workspace tests """
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.clean()
+        super().tearDown()
+
+    def write(self, scratch, name, size):
+        """ Write file of given size to scratch """
+        path = scratch.join(name)
+        with open(path, 'wb') as file:
+            file.write(b'0' * size)
+        return path
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_workspace(self):
+        """ Instantiating workspace """
+        workspace = Workspace(self.tmp_path)
+        self.assertIsInstance(workspace, Workspace)
+        self.assertTrue(os.path.isdir(self.tmp_path))
+
+    def test_scratches_are_unique_and_removed(self):
+        """ Every operation gets its own scratch that is removed after """
+        workspace = Workspace(self.tmp_path)
+        with workspace.scratch() as one, workspace.scratch() as two:
+            self.assertIsInstance(one, Scratch)
+            self.assertNotEqual(one.path, two.path)
+            self.assertTrue(os.path.isdir(one.path))
+            self.write(one, 'file.jpg', 10)
+        self.assertFalse(os.path.exists(one.path))
+        self.assertFalse(os.path.exists(two.path))
+
+    def test_concurrent_scratches_do_not_collide(self):
+        """ Concurrent threads work in separate scratches """
+        workspace = Workspace(self.tmp_path)
+        paths = []
+        errors = []
+
+        def work():
+            try:
+                with workspace.scratch() as scratch:
+                    paths.append(scratch.path)
+                    self.write(scratch, 'same-name.jpg', 100)
+                    time.sleep(0.01)
+                    self.assertEquals(100, os.path.getsize(
+                        scratch.join('same-name.jpg')
+                    ))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals([], errors)
+        self.assertEquals(8, len(set(paths)))
+        self.assertEquals([], os.listdir(self.tmp_path))
+
+    def test_quota_is_enforced_and_released(self):
+        """ Going over quota raises and cleanup returns bytes """
+        workspace = Workspace(self.tmp_path, quota=150)
+        with workspace.scratch() as scratch:
+            scratch.track(self.write(scratch, 'one', 100))
+            self.assertEquals(100, workspace.used)
+            with assert_raises(x.QuotaExceeded):
+                scratch.track(self.write(scratch, 'two', 100))
+            self.assertFalse(os.path.exists(scratch.join('two')))
+        self.assertEquals(0, workspace.used)
+
+    def test_sweep_removes_scratches_of_dead_processes(self):
+        """ Sweeping removes scratches left by dead processes """
+        workspace = Workspace(self.tmp_path)
+        live = workspace.scratch()
+        dead = os.path.join(
+            self.tmp_path,
+            'scratch-{}-{}-abc'.format(workspace.host, 2 ** 22 + 1)
+        )
+        os.makedirs(dead)
+        unrelated = os.path.join(self.tmp_path, 'something')
+        os.makedirs(unrelated)
+
+        def kill(pid, signal):
+            if pid != os.getpid():
+                raise ProcessLookupError
+
+        with mock.patch('os.kill', side_effect=kill):
+            removed = workspace.sweep()
+
+        self.assertEquals(1, removed)
+        self.assertFalse(os.path.exists(dead))
+        self.assertTrue(os.path.exists(live.path))
+        self.assertTrue(os.path.exists(unrelated))
+        live.cleanup()
+
+    def test_sweep_removes_old_scratches(self):
+        """ Sweeping removes scratches older than max age """
+        workspace = Workspace(self.tmp_path, max_age=60)
+        scratch = workspace.scratch()
+        old = time.time() - 120
+        os.utime(scratch.path, (old, old))
+        Workspace(self.tmp_path, max_age=60)
+        self.assertFalse(os.path.exists(scratch.path))
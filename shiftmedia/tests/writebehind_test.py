@@ -0,0 +1,302 @@
+from unittest import mock, TestCase
+from nose.plugins.attrib import attr
+from nose.tools import assert_raises
+
+import os, time, threading
+from shiftmedia import Storage, BackendLocal
+from shiftmedia import exceptions as x
+from shiftmedia.index import VariantIndex
+from shiftmedia.writebehind import WriteBehind
+from shiftmedia.testing.localstorage_testhelpers import LocalStorageTestHelpers
+
+
+@attr('writebehind')
+class WriteBehindTests(TestCase, LocalStorageTestHelpers):
+    """ Write-behind upload tests """
+
+    def setUp(self):
+        super().setUp()
+        self.backend = BackendLocal(self.path)
+        self.spill_path = os.path.join(self.tmp_path, 'spill')
+        self.release = threading.Event()
+        self.put_variant = self.backend.put_variant
+
+    def tearDown(self):
+        """ Clean up after yourself """
+        self.release.set()
+        self.clean()
+        super().tearDown()
+
+    def blocked(self, *args, **kwargs):
+        """ Put variant once released """
+        self.release.wait(5)
+        return self.put_variant(*args, **kwargs)
+
+    def variant_path(self, id, filename):
+        """ Get local path of a variant """
+        parts = self.backend.id_to_path(id)
+        return os.path.join(self.path, *parts, filename)
+
+    def spilled(self):
+        """ Get spilled upload descriptions """
+        return [f for f in os.listdir(self.spill_path) if f.endswith('.json')]
+
+    # ------------------------------------------------------------------------
+    # Tests
+    # ------------------------------------------------------------------------
+
+    def test_instantiate_write_behind(self):
+        """ Instantiating write-behind """
+        writer = WriteBehind(self.backend, self.spill_path)
+        self.assertIsInstance(writer, WriteBehind)
+        self.assertTrue(os.path.isdir(self.spill_path))
+        writer.close()
+        with assert_raises(x.ConfigurationException):
+            WriteBehind(self.backend, self.spill_path, workers=0)
+
+    def test_pending_bytes_are_readable(self):
+        """ Variant bytes are served until uploaded """
+        writer = WriteBehind(self.backend, self.spill_path)
+        callback = mock.Mock()
+        with mock.patch.object(self.backend, 'put_variant', self.blocked):
+            writer.put('id-file.jpg', 'resize.jpg', b'bytes', callback)
+            pending = writer.get('id-file.jpg', 'resize.jpg')
+            self.assertEquals(b'bytes', pending)
+            self.assertEquals(1, writer.count())
+            self.assertFalse(writer.flush(0.05))
+            callback.assert_not_called()
+
+            self.release.set()
+            self.assertTrue(writer.flush(5))
+
+        self.assertIsNone(writer.get('id-file.jpg', 'resize.jpg'))
+        callback.assert_called_once_with('id-file.jpg', 'resize.jpg')
+        with open(self.variant_path('id-file.jpg', 'resize.jpg'), 'rb') as f:
+            self.assertEquals(b'bytes', f.read())
+        self.assertEquals(1, writer.stats()['uploaded'])
+        writer.close()
+
+    def test_failed_uploads_are_retried(self):
+        """ Failed uploads are retried """
+        writer = WriteBehind(self.backend, self.spill_path, retry_delay=0)
+        failures = [x.S3Error('one'), x.S3Error('two')]
+
+        def flaky(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return self.put_variant(*args, **kwargs)
+
+        with mock.patch.object(self.backend, 'put_variant', flaky):
+            writer.put('id-file.jpg', 'resize.jpg', b'bytes')
+            self.assertTrue(writer.flush(5))
+        self.assertTrue(os.path.exists(
+            self.variant_path('id-file.jpg', 'resize.jpg')
+        ))
+        stats = writer.stats()
+        self.assertEquals(1, stats['uploaded'])
+        self.assertEquals(0, stats['spilled'])
+        writer.close()
+
+    def test_spilled_uploads_are_recovered(self):
+        """ Uploads failing for good are spilled and recovered later """
+        writer = WriteBehind(
+            self.backend,
+            self.spill_path,
+            retries=2,
+            retry_delay=0
+        )
+        failing = mock.Mock(side_effect=x.S3Error('down'))
+        with mock.patch.object(self.backend, 'put_variant', failing):
+            writer.put('id-file.jpg', 'resize.jpg', b'bytes')
+            self.assertTrue(writer.flush(5))
+        self.assertEquals(2, failing.call_count)
+        self.assertEquals(1, writer.stats()['failed'])
+        self.assertEquals(1, len(self.spilled()))
+        writer.close()
+
+        recovered = WriteBehind(self.backend, self.spill_path)
+        self.assertTrue(recovered.flush(5))
+        self.assertEquals(1, recovered.stats()['recovered'])
+        self.assertEquals([], os.listdir(self.spill_path))
+        self.assertTrue(os.path.exists(
+            self.variant_path('id-file.jpg', 'resize.jpg')
+        ))
+        recovered.close()
+
+    def test_spills_are_kept_until_uploaded(self):
+        """ Recovered spills are removed only after upload succeeds """
+        writer = WriteBehind(self.backend, self.spill_path, workers=1)
+        with mock.patch.object(self.backend, 'put_variant', self.blocked):
+            writer.put('id-file.jpg', 'resize.jpg', b'bytes')
+            self.assertEquals(1, writer.close(timeout=0.05))
+            self.release.set()
+
+        # spill is claimed while uploading and released on failure
+        failing = mock.Mock(side_effect=x.S3Error('down'))
+        with mock.patch.object(self.backend, 'put_variant', failing):
+            recovered = WriteBehind(
+                self.backend,
+                self.spill_path,
+                retries=1
+            )
+            self.assertTrue(recovered.flush(5))
+            recovered.close()
+        self.assertEquals(1, len(self.spilled()))
+        data = [f for f in os.listdir(self.spill_path) if f.endswith('.data')]
+        self.assertEquals(1, len(data))
+
+        # a process that died while uploading leaves its claim behind
+        spill = os.path.join(self.spill_path, self.spilled()[0])
+        os.rename(spill, spill[:-len('.json')] + '.999999999-dead.claim')
+        self.assertEquals([], self.spilled())
+
+        taken_over = WriteBehind(self.backend, self.spill_path)
+        self.assertTrue(taken_over.flush(5))
+        spills = [
+            f for f in os.listdir(self.spill_path)
+            if f.startswith('spill-')
+        ]
+        self.assertEquals([], spills)
+        self.assertTrue(os.path.exists(
+            self.variant_path('id-file.jpg', 'resize.jpg')
+        ))
+        taken_over.close()
+
+    def test_spilled_uploads_are_served_and_retried(self):
+        """ Spilled variants are served and retried while running """
+        writer = WriteBehind(
+            self.backend,
+            self.spill_path,
+            retries=1,
+            retry_interval=0.05
+        )
+        callback = mock.Mock()
+        failing = mock.Mock(side_effect=x.S3Error('down'))
+        with mock.patch.object(self.backend, 'put_variant', failing):
+            writer.put('id-file.jpg', 'resize.jpg', b'bytes', callback)
+            self.assertTrue(writer.flush(5))
+            self.assertEquals(1, writer.stats()['spilled'])
+            data = writer.get('id-file.jpg', 'resize.jpg')
+            self.assertEquals(b'bytes', data)
+            time.sleep(0.2)
+            callback.assert_not_called()
+
+        path = self.variant_path('id-file.jpg', 'resize.jpg')
+        deadline = time.time() + 5
+        while not callback.called and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertTrue(writer.flush(5))
+        callback.assert_called_once_with('id-file.jpg', 'resize.jpg')
+        self.assertTrue(os.path.exists(path))
+        self.assertIsNone(writer.get('id-file.jpg', 'resize.jpg'))
+        self.assertEquals([], os.listdir(self.spill_path))
+        writer.close()
+
+    def test_close_spills_pending_uploads(self):
+        """ Uploads not done on close are spilled """
+        writer = WriteBehind(self.backend, self.spill_path, workers=1)
+        with mock.patch.object(self.backend, 'put_variant', self.blocked):
+            writer.put('id-file.jpg', 'one.jpg', b'one')
+            writer.put('id-file.jpg', 'two.jpg', b'two')
+            self.assertEquals(2, writer.close(timeout=0.05))
+            self.assertEquals(2, len(self.spilled()))
+            self.release.set()
+
+        recovered = WriteBehind(self.backend, self.spill_path)
+        self.assertTrue(recovered.flush(5))
+        for filename in ['one.jpg', 'two.jpg']:
+            path = self.variant_path('id-file.jpg', filename)
+            self.assertTrue(os.path.exists(path))
+        recovered.close()
+
+    def test_discard_pending_uploads(self):
+        """ Discarding pending uploads of a file """
+        writer = WriteBehind(self.backend, self.spill_path, workers=1)
+        with mock.patch.object(self.backend, 'put_variant', self.blocked):
+            writer.put('id-file.jpg', 'one.jpg', b'one')
+            writer.put('id-file.jpg', 'two.jpg', b'two')
+            writer.put('other-file.jpg', 'one.jpg', b'one')
+            self.assertEquals(2, writer.discard('id-file.jpg'))
+            self.assertIsNone(writer.get('id-file.jpg', 'two.jpg'))
+            self.release.set()
+            self.assertTrue(writer.flush(5))
+        self.assertFalse(os.path.exists(
+            self.variant_path('id-file.jpg', 'two.jpg')
+        ))
+        self.assertTrue(os.path.exists(
+            self.variant_path('other-file.jpg', 'one.jpg')
+        ))
+        writer.close()
+
+    def test_clearing_variants_drops_pending_uploads(self):
+        """ Clearing variants drops pending uploads and previews """
+        self.prepare_uploads()
+        writer = WriteBehind(self.backend, self.spill_path, workers=1)
+        storage = Storage(
+            self.backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            write_behind=writer
+        )
+        id = storage.put(os.path.join(self.upload_path, 'test.jpg'))
+        with mock.patch.object(self.backend, 'put_variant', self.blocked):
+            writer.put(id, 'one.jpg', b'one')
+            writer.put(id, 'two.jpg', b'two')
+            storage._previews[(id, 'two.jpg')] = b'preview'
+            storage.clear_variants()
+            self.assertIsNone(writer.get(id, 'two.jpg'))
+            self.assertEquals({}, storage._previews)
+            self.release.set()
+            self.assertTrue(writer.flush(5))
+        self.assertFalse(os.path.exists(self.variant_path(id, 'two.jpg')))
+        storage.close()
+
+    def test_storage_wait_shares_timeout(self):
+        """ Storage waits for background work and uploads within timeout """
+        writer = WriteBehind(self.backend, self.spill_path, workers=1)
+        storage = Storage(
+            self.backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            write_behind=writer
+        )
+        with mock.patch.object(self.backend, 'put_variant', self.blocked):
+            writer.put('id-file.jpg', 'one.jpg', b'one')
+            storage.run_in_background(self.release.wait, 5)
+            started = time.monotonic()
+            storage.wait(0.3)
+            self.assertLess(time.monotonic() - started, 0.5)
+            self.release.set()
+        storage.close()
+
+    def test_storage_returns_resize_before_upload(self):
+        """ Storage hands resize back while it is being uploaded """
+        self.prepare_uploads()
+        writer = WriteBehind(self.backend, self.spill_path)
+        storage = Storage(
+            self.backend,
+            secret_key=self.config.SECRET_KEY,
+            local_temp=self.config.LOCAL_TEMP,
+            index=VariantIndex(self.backend),
+            write_behind=writer
+        )
+        id = storage.put(os.path.join(self.upload_path, 'test.jpg'))
+        url = storage.get_auto_crop_url(id, '100x100', 'fill')
+        filename = url.split('/')[-1]
+
+        with mock.patch.object(self.backend, 'put_variant', self.blocked):
+            data = storage.get_resize(url)
+            self.assertTrue(data.startswith(b'\xff\xd8'))
+            self.assertFalse(os.path.exists(self.variant_path(id, filename)))
+            self.assertFalse(storage.index.exists(id, filename))
+
+            # concurrent readers get pending bytes
+            self.assertEquals(data, storage.get_variant(url))
+            self.assertEquals(data, storage.get_resize(url))
+
+            self.release.set()
+            storage.close()
+
+        self.assertTrue(os.path.exists(self.variant_path(id, filename)))
+        self.assertTrue(storage.index.exists(id, filename))
+        self.assertIsNone(storage.get_variant(url))
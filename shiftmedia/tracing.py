@@ -0,0 +1,320 @@
+import os, time, functools, threading, contextvars
+from contextlib import contextmanager
+from shiftmedia import exceptions as x
+
+
+class Span:
+    """
+    Span
+    A timed operation with attributes, recorded by local tracer. Mirrors
+    the part of OpenTelemetry span api instrumented code uses.
+    """
+
+    def __init__(self, name, trace_id, span_id, parent_id=None):
+        """
+        Span constructor
+        :param name: string - operation name
+        :param trace_id: string - id shared by all spans of a trace
+        :param span_id: string - id of this span
+        :param parent_id: string - id of parent span or None for root
+        """
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = dict()
+        self.events = []
+        self.status = 'unset'
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    def __repr__(self):
+        return '<Span {} {}>'.format(self.name, self.span_id)
+
+    @property
+    def duration(self):
+        """ Get span duration in seconds """
+        if self.end_time is None:
+            return None
+        return (self.end_time - self.start_time) / 1e9
+
+    def is_recording(self):
+        return self.end_time is None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name, attributes=None):
+        self.events.append((name, time.time_ns(), dict(attributes or {})))
+
+    def record_exception(self, exception):
+        self.add_event('exception', {
+            'exception.type': type(exception).__name__,
+            'exception.message': str(exception),
+        })
+
+    def set_status(self, status, description=None):
+        self.status = status
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+
+
+class NoopSpan:
+    """ Span that records nothing """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def is_recording(self):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+    def set_status(self, status, description=None):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class NoopTracer:
+    """
+    Noop tracer
+    Default tracer. Hands out a shared span doing nothing, so tracing
+    costs next to nothing unless configured.
+    """
+
+    enabled = False
+
+    def start_as_current_span(self, name, attributes=None):
+        return NOOP_SPAN
+
+    def get_current_span(self):
+        return NOOP_SPAN
+
+
+class InMemoryExporter:
+    """
+    In-memory exporter
+    Keeps finished spans of local tracer in memory. Good for tests.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        """
+        Export
+        Accepts a finished span
+        :param span: shiftmedia.tracing.Span
+        :return: None
+        """
+        with self._lock:
+            self.spans.append(span)
+
+    def get(self, name):
+        """
+        Get
+        Returns finished spans with given name
+        :param name: string - span name
+        :return: list
+        """
+        with self._lock:
+            return [span for span in self.spans if span.name == name]
+
+    def clear(self):
+        """ Forget finished spans """
+        with self._lock:
+            self.spans = []
+
+
+class LocalTracer:
+    """
+    Local tracer
+    Records spans in process and hands finished ones to an exporter.
+    Current span is tracked with context variables, so that spans nest
+    properly across threads and coroutines.
+    """
+
+    enabled = True
+
+    def __init__(self, exporter=None):
+        """
+        Local tracer constructor
+        :param exporter: object with export(span), in-memory by default
+        """
+        self.exporter = exporter or InMemoryExporter()
+        self._current = contextvars.ContextVar('span', default=None)
+
+    @staticmethod
+    def new_id(size):
+        """ Generate random hex id of given size in bytes """
+        return os.urandom(size).hex()
+
+    def get_current_span(self):
+        """
+        Get current span
+        :return: shiftmedia.tracing.Span or noop span
+        """
+        return self._current.get() or NOOP_SPAN
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        """
+        Start as current span
+        Context manager starting a child of current span (or a new trace)
+        and making it current. Exceptions are recorded on the span.
+        :param name: string - operation name
+        :param attributes: dict - span attributes
+        :return: shiftmedia.tracing.Span
+        """
+        parent = self._current.get()
+        span = Span(
+            name,
+            trace_id=parent.trace_id if parent else self.new_id(16),
+            span_id=self.new_id(8),
+            parent_id=parent.span_id if parent else None
+        )
+        if attributes:
+            span.set_attributes(attributes)
+
+        token = self._current.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status('error', str(e))
+            raise
+        finally:
+            self._current.reset(token)
+            span.end()
+            self.exporter.export(span)
+
+
+class OpenTelemetryTracer:
+    """
+    OpenTelemetry tracer
+    Adapter reporting spans to OpenTelemetry, so that they join request
+    traces of your application. Requires opentelemetry-api, configure
+    the sdk and exporters as usual.
+    """
+
+    enabled = True
+
+    def __init__(self, tracer=None):
+        """
+        OpenTelemetry tracer constructor
+        :param tracer: opentelemetry tracer, global 'shiftmedia' by default
+        """
+        if tracer is None:
+            try:
+                from opentelemetry import trace
+            except ImportError:
+                err = 'OpenTelemetry tracing requires opentelemetry-api'
+                raise x.ConfigurationException(err)
+            tracer = trace.get_tracer('shiftmedia')
+        self.tracer = tracer
+
+    def start_as_current_span(self, name, attributes=None):
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+
+    def get_current_span(self):
+        from opentelemetry import trace
+        return trace.get_current_span()
+
+
+# current tracer, records nothing unless configured
+_tracer = NoopTracer()
+
+
+def get_tracer():
+    """
+    Get tracer
+    Returns tracer instrumented code currently reports to
+    :return: tracer
+    """
+    return _tracer
+
+
+def set_tracer(tracer):
+    """
+    Set tracer
+    Sets tracer for all instrumented code. Pass None to disable.
+    :param tracer: LocalTracer, OpenTelemetryTracer or compatible
+    :return: previous tracer
+    """
+    global _tracer
+    previous = _tracer
+    _tracer = tracer or NoopTracer()
+    return previous
+
+
+def enabled():
+    """ Check whether spans are being recorded """
+    return _tracer.enabled
+
+
+def clean(attributes):
+    """ Drop attributes without value, OpenTelemetry doesn't accept them """
+    return {k: v for k, v in attributes.items() if v is not None}
+
+
+def span(name, **attributes):
+    """
+    Span
+    Returns context manager recording a span with current tracer
+    :param name: string - operation name
+    :return: context manager
+    """
+    if not _tracer.enabled:
+        return NOOP_SPAN
+    return _tracer.start_as_current_span(name, clean(attributes) or None)
+
+
+def set_attributes(**attributes):
+    """
+    Set attributes
+    Adds attributes to current span
+    :return: None
+    """
+    if _tracer.enabled:
+        _tracer.get_current_span().set_attributes(clean(attributes))
+
+
+def traced(name):
+    """
+    Traced
+    Decorator recording a span for every call
+    :param name: string - operation name
+    :return: decorator
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _tracer.start_as_current_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
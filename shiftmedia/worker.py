@@ -0,0 +1,280 @@
+import os, time, signal, importlib, threading, traceback
+import multiprocessing
+from PIL import Image
+from shiftmedia import exceptions as x
+
+
+def load_factory(path):
+    """
+    Load factory
+    Imports storage factory callable given as 'module.path:callable'
+    :param path: string - import path
+    :return: callable
+    """
+    module, sep, name = path.partition(':')
+    if not sep or not module or not name:
+        err = 'Factory must be given as module.path:callable'
+        raise x.ConfigurationException(err)
+    return getattr(importlib.import_module(module), name)
+
+
+class Worker:
+    """
+    Worker
+    Processes resize and warmup jobs from storage job queue. Runs a number
+    of preforked worker processes that share everything imported before
+    forking (Pillow plugins, storage factory module), restarts processes
+    that die and shuts down gracefully letting current jobs finish.
+    Processes dying right after start are restarted with exponential
+    backoff, and the worker gives up if they keep doing so.
+    """
+
+    # seconds between checks of worker processes
+    SUPERVISE_INTERVAL = 0.5
+
+    # seconds to wait before restarting a process, doubled on every crash
+    RESPAWN_DELAY = 0.5
+    MAX_RESPAWN_DELAY = 60
+
+    def __init__(
+        self,
+        factory,
+        concurrency=1,
+        poll=1.0,
+        lease=300,
+        grace=30,
+        pipeline=None,
+        min_uptime=5,
+        max_crashes=5
+    ):
+        """
+        Worker constructor
+        :param factory: callable - returns configured Storage with a queue
+        :param concurrency: int - number of worker processes
+        :param poll: float - seconds to sleep when queue is empty
+        :param lease: float - seconds a job is reserved for
+        :param grace: float - seconds to wait for jobs on shutdown
+        :param pipeline: dict - process jobs in a staged pipeline created
+                         with these options (see shiftmedia.pipeline)
+        :param min_uptime: float - seconds a process must live for its exit
+                           not to count as a crash at startup
+        :param max_crashes: int - crashes at startup in a row after which
+                            worker gives up
+        """
+        self.factory = factory
+        self.concurrency = concurrency
+        self.poll = poll
+        self.lease = lease
+        self.grace = grace
+        self.pipeline = pipeline
+        self.min_uptime = min_uptime
+        self.max_crashes = max_crashes
+        self.stopping = False
+        self.processed = 0
+        self.failed = 0
+        self.processes = []
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """
+        Warm
+        Imports everything worker processes need before forking, so that
+        children don't pay for imports and share loaded code pages.
+        :return: None
+        """
+        Image.init()
+        storage = self.factory()
+        if not storage.queue:
+            raise x.ConfigurationException('Storage has no job queue')
+
+    def stop(self, *args):
+        """
+        Stop
+        Asks worker to stop after current job
+        :return: None
+        """
+        self.stopping = True
+
+    def work(self, max_jobs=None):
+        """
+        Work
+        Reserves and processes jobs until stopped. This is what every worker
+        process runs, but can also be used to process jobs inline.
+        :param max_jobs: int - stop after this many jobs, None for no limit
+        :return: int - number of jobs processed
+        """
+        storage = self.factory()
+        if self.pipeline is not None:
+            return self.work_pipelined(storage, max_jobs)
+
+        queue = storage.queue
+        processed = 0
+        while not self.stopping:
+            if max_jobs is not None and processed >= max_jobs:
+                break
+
+            job = queue.reserve(self.lease)
+            if not job:
+                if max_jobs is not None:
+                    break
+                time.sleep(self.poll)
+                continue
+
+            processed += 1
+            try:
+                storage.process_job(job)
+            except Exception:
+                self.failed += 1
+                queue.fail(job, traceback.format_exc(limit=5))
+            else:
+                self.processed += 1
+                queue.complete(job)
+
+        storage.close()
+        return processed
+
+    def work_pipelined(self, storage, max_jobs=None):
+        """
+        Work pipelined
+        Reserves jobs and submits them to a staged pipeline until stopped,
+        then lets submitted jobs finish. Jobs are reserved only as fast as
+        the pipeline takes them, but reserved ones may wait in pipeline
+        queues, so keep lease well above time it takes to process the
+        number of jobs fitting in them.
+        :param storage: shiftmedia.storage.Storage
+        :param max_jobs: int - stop after this many jobs, None for no limit
+        :return: int - number of jobs processed
+        """
+        from shiftmedia.pipeline import Pipeline
+        queue = storage.queue
+        pipeline = Pipeline(storage, **self.pipeline)
+
+        def done(job, error):
+            if error is None:
+                queue.complete(job)
+                with self._lock:
+                    self.processed += 1
+                return
+
+            trace = traceback.format_exception(
+                type(error),
+                error,
+                error.__traceback__,
+                limit=5
+            )
+            queue.fail(job, ''.join(trace))
+            with self._lock:
+                self.failed += 1
+
+        processed = 0
+        try:
+            while not self.stopping:
+                if max_jobs is not None and processed >= max_jobs:
+                    break
+
+                job = queue.reserve(self.lease)
+                if not job:
+                    if max_jobs is not None:
+                        break
+                    time.sleep(self.poll)
+                    continue
+
+                processed += 1
+                pipeline.submit(job, done)
+        finally:
+            pipeline.close()
+
+        storage.close()
+        return processed
+
+    def child(self):
+        """
+        Child
+        Worker process entry point
+        :return: None
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.work()
+
+    def spawn(self):
+        """
+        Spawn
+        Forks a new worker process
+        :return: multiprocessing.Process
+        """
+        ctx = multiprocessing.get_context('fork')
+        process = ctx.Process(target=self.child, daemon=False)
+        process.start()
+        return process
+
+    def respawn_delay(self, crashes):
+        """
+        Respawn delay
+        Returns seconds to wait before restarting a dead process
+        :param crashes: int - crashes at startup in a row
+        :return: float
+        """
+        return min(self.RESPAWN_DELAY * 2 ** crashes, self.MAX_RESPAWN_DELAY)
+
+    def run(self):
+        """
+        Run
+        Warms up, forks worker processes and supervises them until stopped
+        by SIGTERM or SIGINT. Raises an exception if processes keep
+        crashing at startup.
+        :return: None
+        """
+        self.warm()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.processes = [self.spawn() for i in range(self.concurrency)]
+        started = [time.monotonic() for process in self.processes]
+        crashes = [0 for process in self.processes]
+        respawn = [None for process in self.processes]
+
+        try:
+            while not self.stopping:
+                now = time.monotonic()
+                for index, process in enumerate(self.processes):
+                    if process.is_alive():
+                        continue
+                    if respawn[index] is None:
+                        process.join()
+                        if now - started[index] < self.min_uptime:
+                            crashes[index] += 1
+                        else:
+                            crashes[index] = 0
+                        if crashes[index] > self.max_crashes:
+                            err = 'Worker process exited {} times in a ' \
+                                  'row right after start (exit code {})'
+                            raise x.WorkerCrashed(
+                                err.format(crashes[index], process.exitcode)
+                            )
+                        delay = self.respawn_delay(crashes[index])
+                        respawn[index] = now + delay
+                    if now >= respawn[index]:
+                        self.processes[index] = self.spawn()
+                        started[index] = time.monotonic()
+                        respawn[index] = None
+                time.sleep(self.SUPERVISE_INTERVAL)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Shutdown
+        Asks worker processes to finish current jobs and kills those that
+        did not finish within grace period.
+        :return: None
+        """
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.grace
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
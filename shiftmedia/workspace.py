@@ -0,0 +1,193 @@
+import os, time, uuid, shutil, socket, hashlib, threading
+from shiftmedia import exceptions as x
+
+
+class Scratch:
+    """
+    Scratch
+    A unique per-operation directory inside workspace. Nothing else ever
+    writes to it, so concurrent operations (even on the same storage id)
+    never collide, and it is removed as a whole when operation is done.
+    """
+
+    def __init__(self, workspace, path):
+        """
+        Scratch constructor
+        :param workspace: shiftmedia.workspace.Workspace
+        :param path: string - path to scratch directory
+        """
+        self.workspace = workspace
+        self.path = path
+        self.used = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    def join(self, *parts):
+        """
+        Join
+        Returns path inside scratch directory
+        :return: string
+        """
+        return os.path.join(self.path, *parts)
+
+    def track(self, path):
+        """
+        Track
+        Accounts for a file written to scratch directory against workspace
+        quota. Sizes of originals and resizes aren't known until they are
+        written, so this happens right after the write: a file that goes
+        over quota is removed and an exception is raised.
+        :param path: string - path to file
+        :return: int - file size
+        """
+        size = os.path.getsize(path)
+        try:
+            self.workspace.reserve(size)
+        except x.QuotaExceeded:
+            os.remove(path)
+            raise
+        self.used += size
+        return size
+
+    def cleanup(self):
+        """
+        Cleanup
+        Removes scratch directory and releases its quota
+        :return: None
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.workspace.release(self.used)
+        self.used = 0
+
+
+class Workspace:
+    """
+    Workspace
+    Local temp space for storage operations. Hands out unique scratch
+    directories to every operation, enforces an optional byte quota across
+    them and sweeps scratch directories left behind by crashed processes.
+    Can be backed by RAM (tmpfs) when available.
+    """
+
+    PREFIX = 'scratch-'
+    RAM_ROOT = '/dev/shm'
+
+    def __init__(
+        self,
+        root,
+        quota=None,
+        ram=False,
+        max_age=24 * 60 * 60,
+        sweep=True
+    ):
+        """
+        Workspace constructor
+        :param root: string - path to local temp directory
+        :param quota: int - max bytes used by all scratches, None for no limit
+        :param ram: bool - put scratches on tmpfs if one is available
+        :param max_age: float - seconds after which scratches are stale
+        :param sweep: bool - sweep stale scratches upon creation
+        """
+        if ram and os.path.isdir(self.RAM_ROOT):
+            name = 'shiftmedia-' + hashlib.sha1(
+                bytes(os.path.realpath(root), 'utf-8')
+            ).hexdigest()[:12]
+            root = os.path.join(self.RAM_ROOT, name)
+
+        self.root = root
+        self.quota = quota
+        self.max_age = max_age
+        self.used = 0
+        self.host = hashlib.sha1(
+            bytes(socket.gethostname(), 'utf-8')
+        ).hexdigest()[:8]
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        if sweep:
+            self.sweep()
+
+    def scratch(self):
+        """
+        Scratch
+        Creates a new unique scratch directory. Use as context manager to
+        have it removed automatically.
+        :return: shiftmedia.workspace.Scratch
+        """
+        name = '{}{}-{}-{}'.format(
+            self.PREFIX,
+            self.host,
+            os.getpid(),
+            uuid.uuid4().hex
+        )
+        path = os.path.join(self.root, name)
+        os.makedirs(path)
+        return Scratch(self, path)
+
+    def reserve(self, size):
+        """
+        Reserve
+        Accounts for bytes written to scratch space
+        :param size: int - number of bytes
+        :return: None
+        """
+        with self._lock:
+            if self.quota is not None and self.used + size > self.quota:
+                msg = 'Scratch space quota of {} bytes exceeded'
+                raise x.QuotaExceeded(msg.format(self.quota))
+            self.used += size
+
+    def release(self, size):
+        """
+        Release
+        Returns bytes to the quota
+        :param size: int - number of bytes
+        :return: None
+        """
+        with self._lock:
+            self.used = max(0, self.used - size)
+
+    def is_stale(self, name, mtime):
+        """
+        Is stale
+        Checks whether scratch directory was left behind: its owner
+        process on this host is gone or it is older than max age.
+        :param name: string - scratch directory name
+        :param mtime: float - modification time
+        :return: bool
+        """
+        if time.time() - mtime > self.max_age:
+            return True
+
+        parts = name[len(self.PREFIX):].split('-')
+        if len(parts) != 3 or parts[0] != self.host:
+            return False
+        try:
+            os.kill(int(parts[1]), 0)
+        except ProcessLookupError:
+            return True
+        except (ValueError, PermissionError):
+            pass
+        return False
+
+    def sweep(self):
+        """
+        Sweep
+        Removes stale scratch directories
+        :return: int - number of directories removed
+        """
+        removed = 0
+        for entry in os.scandir(self.root):
+            if not entry.name.startswith(self.PREFIX) or not entry.is_dir():
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if self.is_stale(entry.name, mtime):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        return removed
@@ -0,0 +1,489 @@
+import os, json, time, uuid, queue, threading
+from shiftmedia import metrics
+from shiftmedia import exceptions as x
+
+
+class Upload:
+    """
+    Upload
+    Variant bytes waiting to be put to storage
+    """
+    __slots__ = ('id', 'filename', 'data', 'callback', 'spill')
+
+    def __init__(self, id, filename, data, callback=None, spill=None):
+        """
+        Upload constructor
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :param data: bytes - variant bytes
+        :param callback: callable - called with id and filename once stored
+        :param spill: tuple - spill file name and claim of recovered upload
+        """
+        self.id = id
+        self.filename = filename
+        self.data = data
+        self.callback = callback
+        self.spill = spill
+
+    @property
+    def key(self):
+        return self.id, self.filename
+
+
+class WriteBehind:
+    """
+    Write-behind
+    Puts rendered variants to storage asynchronously, so that callers get
+    variant bytes without waiting for the upload. Uploads go through a
+    bounded queue to a pool of threads, and until they are done their
+    bytes are served to readers (see get). Failed uploads are retried
+    with exponential backoff.
+
+    Nothing is lost when uploads keep failing or on shutdown: whatever is
+    not uploaded is spilled to a local directory and recovered the next
+    time write-behind is created with the same directory. Spilled files
+    are only removed once their upload succeeds. Meanwhile, variants this
+    write-behind spilled are still served to readers from disk, and idle
+    upload threads retry them every retry interval.
+    """
+
+    # tells upload threads to exit
+    STOP = object()
+
+    def __init__(
+        self,
+        backend,
+        path,
+        workers=2,
+        max_pending=64,
+        retries=3,
+        retry_delay=0.5,
+        recover=True,
+        retry_interval=30
+    ):
+        """
+        Write-behind constructor
+        :param backend: shiftmedia.backend.Backend - backend to upload to
+        :param path: string - directory to spill pending uploads to
+        :param workers: int - upload threads
+        :param max_pending: int - queued uploads, putting more blocks
+        :param retries: int - attempts before upload is spilled
+        :param retry_delay: float - seconds before first retry, doubles
+        :param recover: bool - upload variants spilled earlier
+        :param retry_interval: float - seconds between retries of spilled
+                               uploads
+        """
+        if workers < 1 or max_pending < 1 or retries < 1:
+            err = 'Write-behind needs at least one worker, slot and attempt'
+            raise x.ConfigurationException(err)
+
+        self.backend = backend
+        self.path = path
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_interval = retry_interval
+        self.uploaded = 0
+        self.failed = 0
+        self.spilled = 0
+        self.recovered = 0
+        self.closed = False
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = dict()
+        self._spilled = dict()
+        self._idle = threading.Condition()
+        self._threads = []
+        self._owner = '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+        os.makedirs(path, exist_ok=True)
+
+        for index in range(workers):
+            thread = threading.Thread(
+                target=self.run,
+                name='shiftmedia-upload-{}'.format(index),
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        if recover:
+            self.recover()
+
+    def put(self, id, filename, data, callback=None):
+        """
+        Put
+        Queues variant bytes for upload and returns straight away, unless
+        the queue is full, in which case blocks until there's room. Once
+        closed, uploads in the calling thread.
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :param data: bytes - variant bytes
+        :param callback: callable - called with id and filename once stored
+        :return: None
+        """
+        self.enqueue(Upload(id, filename, data, callback))
+
+    def enqueue(self, upload, block=True):
+        """
+        Enqueue
+        Queues an upload, see put
+        :param upload: shiftmedia.writebehind.Upload
+        :param block: bool - wait for room in the queue, raise queue.Full
+                      otherwise
+        :return: None
+        """
+        if self.closed:
+            if self.upload(upload):
+                self.forget(upload)
+            else:
+                self.spill(upload)
+            return
+
+        with self._idle:
+            self._pending[upload.key] = upload
+        try:
+            self._queue.put(upload, block=block)
+        except queue.Full:
+            with self._idle:
+                if self._pending.get(upload.key) is upload:
+                    del self._pending[upload.key]
+            raise
+
+    def get(self, id, filename):
+        """
+        Get
+        Returns bytes of a variant that is not uploaded yet, pending or
+        spilled
+        :param id: string - storage id
+        :param filename: string - variant filename
+        :return: bytes or None
+        """
+        with self._idle:
+            upload = self._pending.get((id, filename))
+            spilled = self._spilled.get((id, filename))
+        if upload:
+            return upload.data
+        if spilled:
+            try:
+                with open(spilled[0] + '.data', 'rb') as file:
+                    return file.read()
+            except OSError:
+                pass  # uploaded in the meantime
+        return None
+
+    def discard(self, id=None):
+        """
+        Discard
+        Drops pending and spilled uploads of a deleted file, or of every
+        file when variants are cleared. An upload in progress can't be
+        stopped and might still finish.
+        :param id: string - storage id, None for all
+        :return: int - number of dropped pending uploads
+        """
+        def matches(key):
+            return id is None or key[0] == id
+
+        with self._idle:
+            keys = [key for key in self._pending if matches(key)]
+            dropped = [self._pending.pop(key) for key in keys]
+            spilled = [key for key in self._spilled if matches(key)]
+            names = [self._spilled.pop(key)[0] for key in spilled]
+            self._idle.notify_all()
+        for upload in dropped:
+            self.forget(upload)
+        for name in names:
+            for path in (name + '.json', name + '.data'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # claimed for recovery, dropped with the upload
+        return len(keys)
+
+    def count(self):
+        """
+        Count
+        Returns number of variants not uploaded yet
+        :return: int
+        """
+        with self._idle:
+            return len(self._pending)
+
+    def flush(self, timeout=None):
+        """
+        Flush
+        Waits for pending uploads to be done, successfully or not
+        :param timeout: float - seconds to wait, None to wait forever
+        :return: bool - whether all uploads are done
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def close(self, timeout=None):
+        """
+        Close
+        Lets pending uploads finish within timeout, spills the rest to
+        disk and stops upload threads. Uploads put after closing are done
+        by calling threads.
+        :param timeout: float - seconds to wait, None to wait forever
+        :return: int - number of spilled uploads
+        """
+        if self.closed:
+            return 0
+        self.closed = True
+        self.flush(timeout)
+        with self._idle:
+            left = list(self._pending.values())
+            self._pending.clear()
+            self._idle.notify_all()
+        for upload in left:
+            self.spill(upload)
+
+        for thread in self._threads:
+            self._queue.put(self.STOP)
+        for thread in self._threads:
+            thread.join(1)
+        return len(left)
+
+    def run(self):
+        """
+        Run
+        Upload thread loop: uploads queued variants unless they were
+        discarded or replaced in the meantime, and retries spilled ones
+        when idle for retry interval
+        :return: None
+        """
+        while True:
+            try:
+                upload = self._queue.get(timeout=self.retry_interval)
+            except queue.Empty:
+                with self._idle:
+                    retry = bool(self._spilled) and not self.closed
+                if retry:
+                    self.recover(block=False)
+                continue
+            if upload is self.STOP:
+                return
+            with self._idle:
+                current = self._pending.get(upload.key) is upload
+            if not current:
+                self.forget(upload)  # superseded by a newer upload
+                continue
+
+            if self.upload(upload):
+                self.forget(upload)
+                with self._idle:
+                    self._spilled.pop(upload.key, None)
+            else:
+                self.spill(upload)
+            with self._idle:
+                if self._pending.get(upload.key) is upload:
+                    del self._pending[upload.key]
+                self._idle.notify_all()
+
+    def upload(self, upload):
+        """
+        Upload
+        Puts variant to storage, retrying with exponential backoff
+        :param upload: shiftmedia.writebehind.Upload
+        :return: bool - whether upload succeeded
+        """
+        for attempt in range(self.retries):
+            if attempt:
+                metrics.increment(metrics.WRITE_BEHIND, result='retried')
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self.write(upload)
+            except Exception:
+                continue
+
+            with self._idle:
+                self.uploaded += 1
+            metrics.increment(metrics.WRITE_BEHIND, result='uploaded')
+            if upload.callback:
+                try:
+                    upload.callback(upload.id, upload.filename)
+                except Exception:
+                    pass  # variant is stored, never fail the upload
+            return True
+
+        with self._idle:
+            self.failed += 1
+        metrics.increment(metrics.WRITE_BEHIND, result='failed')
+        return False
+
+    def write(self, upload):
+        """
+        Write
+        Puts variant to storage through a temporary local file
+        :param upload: shiftmedia.writebehind.Upload
+        :return: None
+        """
+        path = os.path.join(self.path, 'upload-' + uuid.uuid4().hex)
+        try:
+            with open(path, 'wb') as file:
+                file.write(upload.data)
+            try:
+                self.backend.put_variant(
+                    path,
+                    upload.id,
+                    upload.filename,
+                    force=True
+                )
+            except x.FileExists:
+                pass
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def spill(self, upload):
+        """
+        Spill
+        Writes upload to spill directory: variant bytes first and its
+        description last, so that only complete uploads are recovered.
+        Recovered uploads are still there, they are only released.
+        :param upload: shiftmedia.writebehind.Upload
+        :return: None
+        """
+        if upload.spill:
+            name, claim = upload.spill
+            try:
+                os.replace(claim, name + '.json')
+            except OSError:
+                pass  # already released or removed
+            self.spilled_as(upload, name)
+            return
+
+        name = os.path.join(self.path, 'spill-' + uuid.uuid4().hex)
+        with open(name + '.data', 'wb') as file:
+            file.write(upload.data)
+            file.flush()
+            os.fsync(file.fileno())
+        meta = dict(id=upload.id, filename=upload.filename)
+        with open(name + '.tmp', 'w') as file:
+            json.dump(meta, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(name + '.tmp', name + '.json')
+        with self._idle:
+            self.spilled += 1
+        self.spilled_as(upload, name)
+        metrics.increment(metrics.WRITE_BEHIND, result='spilled')
+
+    def spilled_as(self, upload, name):
+        """
+        Spilled as
+        Remembers where an upload was spilled to, so that its bytes are
+        served and its callback called once it's retried successfully
+        :param upload: shiftmedia.writebehind.Upload
+        :param name: string - spill file name, without extension
+        :return: None
+        """
+        with self._idle:
+            self._spilled[upload.key] = (name, upload.callback)
+
+    def forget(self, upload):
+        """
+        Forget
+        Removes spill files of a recovered upload once it is uploaded,
+        superseded or discarded
+        :param upload: shiftmedia.writebehind.Upload
+        :return: None
+        """
+        if not upload.spill:
+            return
+        name, claim = upload.spill
+        for path in (claim, name + '.data'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def alive(pid):
+        """
+        Alive
+        Checks whether a process exists
+        :param pid: int - process id
+        :return: bool
+        """
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def recover(self, block=True):
+        """
+        Recover
+        Queues uploads spilled earlier, by this or another process that
+        used the same directory. Spilled uploads are claimed by renaming
+        their description, so that no other process recovers them too,
+        and removed once uploaded. Claims of processes that died are
+        taken over.
+        :param block: bool - wait for room in the queue, otherwise stop
+                      recovering once it's full
+        :return: int - number of recovered uploads
+        """
+        with self._idle:
+            callbacks = dict(self._spilled.values())
+        recovered = 0
+        for entry in sorted(os.listdir(self.path)):
+            if not entry.startswith('spill-'):
+                continue
+            if entry.endswith('.json'):
+                name = os.path.join(self.path, entry[:-len('.json')])
+            elif entry.endswith('.claim'):
+                base, owner = entry[:-len('.claim')].rsplit('.', 1)
+                pid = owner.split('-')[0]
+                if not pid.isdigit() or self.alive(int(pid)):
+                    continue
+                name = os.path.join(self.path, base)
+            else:
+                continue
+
+            claim = '{}.{}.claim'.format(name, self._owner)
+            try:
+                os.rename(os.path.join(self.path, entry), claim)
+                with open(claim) as file:
+                    meta = json.load(file)
+                with open(name + '.data', 'rb') as file:
+                    data = file.read()
+            except (OSError, ValueError):
+                continue  # taken by another process or broken
+            upload = Upload(
+                meta['id'],
+                meta['filename'],
+                data,
+                callbacks.get(name),
+                spill=(name, claim)
+            )
+            try:
+                self.enqueue(upload, block)
+            except queue.Full:
+                self.spill(upload)
+                break
+            recovered += 1
+
+        with self._idle:
+            self.recovered += recovered
+        if recovered:
+            metrics.increment(
+                metrics.WRITE_BEHIND,
+                recovered,
+                result='recovered'
+            )
+        return recovered
+
+    def stats(self):
+        """
+        Stats
+        Returns upload counters and number of pending uploads
+        :return: dict
+        """
+        with self._idle:
+            return dict(
+                pending=len(self._pending),
+                uploaded=self.uploaded,
+                failed=self.failed,
+                spilled=self.spilled,
+                recovered=self.recovered
+            )